@@ -5,7 +5,29 @@
 # https://github.com/raspberrypipress/Code-the-Classics-Vol2.git
 # https://store.rpipress.cc/products/code-the-classics-volume-ii
 
-import pygame, pgzero, pgzrun, math, sys, time, platform
+import os, sys
+
+# Running the game with the --race-farm command line option runs lots of CPU-only races as fast as possible, without
+# displaying anything or playing any sound - see run_race_farm. SDL (the library which Pygame is built on) must be told
+# not to use a real display or audio device before Pygame Zero initialises it
+# The --convert-track option saves the track to a track file, rather than running the game - see save_track_file
+# The --benchmark option measures how long it takes to draw the track, see run_benchmark
+# The --collision-check option checks that the two players' cars are pushed apart correctly, see run_collision_check
+RACE_FARM = "--race-farm" in sys.argv
+CONVERT_TRACK = "--convert-track" in sys.argv
+BENCHMARK = "--benchmark" in sys.argv
+COLLISION_CHECK = "--collision-check" in sys.argv
+if RACE_FARM or CONVERT_TRACK or BENCHMARK or COLLISION_CHECK:
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+import pygame, pgzero, pgzrun, math, time, platform, random
+import mmap, struct, csv, hashlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate, chain
 from abc import ABC, abstractmethod
 from enum import Enum
 from random import randint, uniform, choice
@@ -22,9 +44,29 @@ from pygame.math import Vector3, Vector2
 # module. See further down for more performance options
 USE_GFXDRAW = False
 
-if USE_GFXDRAW:
+# The benchmark may turn USE_GFXDRAW on (see BENCHMARK_SETTINGS), so it needs the module too
+if USE_GFXDRAW or BENCHMARK:
     import pygame.gfxdraw
 
+# NumPy is an optional extra, which can be installed using the command 'pip3 install numpy'. If it's available, the
+# positions of all the visible track pieces are transformed into screen positions in one go, using NumPy arrays, which
+# is much faster than transforming them one point at a time in Python. Set this to False to not use NumPy even if it's
+# installed - the game will look exactly the same either way
+USE_NUMPY = True
+
+if USE_NUMPY:
+    try:
+        import numpy
+    except ImportError:
+        USE_NUMPY = False
+
+# Enable this to draw the track, rumble strips, stripes and trackside the way classic pseudo-3D racing games did, rather
+# than as polygons. Each row of the screen is filled with spans of colour worked out from the edges of the track, and the
+# rows are written straight into the screen's pixels in bulk using NumPy - see TrackScanlines. Scenery and cars are still
+# drawn on top as images. This needs NumPy, and is only used when the trackside is shown and polygons are filled.
+# Press F5 during the game to switch between this and polygons
+SCANLINE_ROAD = False
+
 # Check Python version number. sys.version_info gives version as a tuple, e.g. if (3,7,2,'final',0) for version 3.7.2.
 # Unlike many languages, Python can compare two tuples in the same way that you can compare numbers.
 if sys.version_info < (3,6):
@@ -65,11 +107,46 @@ else:
     OUTLINE_W = 1                   # Change to 1 for unfilled polygons, which are a bit faster to draw
     VIEW_DISTANCE = 150             # This is in units of number of track pieces, try 60 for a better frame rate, try 2000 for a bad frame rate but impressive draw distance
 
-CLIPPING_PLANE = -0.25          # too close to 0 = frame rate issues (drawing huge polygons which are mostly off-screen), too far = stuff just in front of camera not being drawn
+CLIPPING_PLANE = -0.25          # Track pieces closer than this aren't projected. The track in front of them is still drawn up to this distance, clipped to the screen (see TrackProjection.clip_near_plane and clip_polygon)
 CLIPPING_PLANE_CARS = -0.08     # bring closer to zero to fix occasional flickering of CPU cars when very close to the camera, at the potential cost of frame rate
 SCALE_FUNC = pygame.transform.scale     # Which scale function to use - pygame.transform.smoothscale is better quality but slower
 MAX_SCENERY_SCALED_WIDTH = WIDTH * 2    # When scaling scenery based on distance from camera, don't try to draw anything that would be scaled to wider than this
 MAX_CAR_SCALED_WIDTH = WIDTH * 1        # As above but for cars
+SCALED_IMAGE_CACHE_MAX_BYTES = 64 * 1024 * 1024     # Maximum memory used to keep scaled scenery and car images for reuse
+USE_MIPMAPS = True              # Scale distant scenery and cars from pre-shrunk copies of their images - faster and less blocky
+MERGE_TRACK_POLYGONS = True     # Draw runs of track pieces of the same colour as one polygon, instead of one per piece
+TRACK_FILE = "tracks/leadingedge.track"    # Track file to load, see Track. It's made from make_track_lap if needed
+HILL_OCCLUSION_CULLING = True   # Don't draw track pieces, scenery and cars which are hidden behind a hill crest
+SCENERY_DRAW_DISTANCE_SCALE = 1 # Multiplies the distance at which each piece of scenery starts being drawn
+
+# Adaptive detail - automatically turn the level of detail down if frames are taking too long, and back up if there's
+# time to spare - see DetailController. The game starts with the settings above, and when enabled, they're changed as
+# the level of detail goes up or down
+ADAPTIVE_DETAIL = False
+
+# Each level of detail is a set of values for the settings above, from best looking to fastest. Level 1 is the normal
+# settings, and the last level is the same as PERFORMANCE_MODE but with a shorter view distance. The starting level is
+# replaced with the settings above, so any changes made to those are kept until the level of detail first changes
+DETAIL_LEVELS = [
+    {"VIEW_DISTANCE": 300, "SCENERY_DRAW_DISTANCE_SCALE": 1.5, "SHOW_SCENERY": True, "SHOW_TRACKSIDE": True,
+     "SHOW_RUMBLE_STRIPS": True, "SHOW_YELLOW_LINES": True, "OUTLINE_W": 0, "SCALE_FUNC": pygame.transform.smoothscale},
+    {"VIEW_DISTANCE": 200, "SCENERY_DRAW_DISTANCE_SCALE": 1, "SHOW_SCENERY": True, "SHOW_TRACKSIDE": True,
+     "SHOW_RUMBLE_STRIPS": True, "SHOW_YELLOW_LINES": True, "OUTLINE_W": 0, "SCALE_FUNC": pygame.transform.scale},
+    {"VIEW_DISTANCE": 170, "SCENERY_DRAW_DISTANCE_SCALE": 0.8, "SHOW_SCENERY": True, "SHOW_TRACKSIDE": True,
+     "SHOW_RUMBLE_STRIPS": True, "SHOW_YELLOW_LINES": False, "OUTLINE_W": 0, "SCALE_FUNC": pygame.transform.scale},
+    {"VIEW_DISTANCE": 140, "SCENERY_DRAW_DISTANCE_SCALE": 0.6, "SHOW_SCENERY": True, "SHOW_TRACKSIDE": True,
+     "SHOW_RUMBLE_STRIPS": False, "SHOW_YELLOW_LINES": False, "OUTLINE_W": 0, "SCALE_FUNC": pygame.transform.scale},
+    {"VIEW_DISTANCE": 110, "SCENERY_DRAW_DISTANCE_SCALE": 0.4, "SHOW_SCENERY": True, "SHOW_TRACKSIDE": False,
+     "SHOW_RUMBLE_STRIPS": False, "SHOW_YELLOW_LINES": False, "OUTLINE_W": 0, "SCALE_FUNC": pygame.transform.scale},
+    {"VIEW_DISTANCE": 90, "SCENERY_DRAW_DISTANCE_SCALE": 0.4, "SHOW_SCENERY": False, "SHOW_TRACKSIDE": False,
+     "SHOW_RUMBLE_STRIPS": False, "SHOW_YELLOW_LINES": False, "OUTLINE_W": 1, "SCALE_FUNC": pygame.transform.scale},
+]
+DETAIL_START_LEVEL = len(DETAIL_LEVELS) - 1 if PERFORMANCE_MODE else 1
+DETAIL_STEP_DOWN_MS = 13            # Go to a lower level if frames take longer than this (on average)...
+DETAIL_STEP_DOWN_FRAMES = 30        # ...for this many frames in a row
+DETAIL_STEP_UP_MS = 8               # Go to a higher level if frames take less time than this...
+DETAIL_STEP_UP_FRAMES = 180         # ...for this many frames in a row
+DETAIL_CHANGE_WAIT_FRAMES = 60      # After changing level, wait this many frames before measuring again
 
 # Constants for track
 SPACING = 1
@@ -103,19 +180,55 @@ HIGH_ACCEL_THRESHOLD = 30
 CORNER_OFFSET_MULTIPLIER = 5.8      # Higher = harder to corner
 STEERING_STRENGTH = 72              # Higher = steering has a stronger effect
 
+# Car collision settings. Note - axes are not uniform in scale (1 unit in X axis is much smaller than 1 unit in Z axis),
+# so we can't do a normal distance calculation. Instead we just check X and Z differences separately (Y is irrelevant
+# as cars are always on the ground)
+COLLIDE_DISTANCE_X = 260
+COLLIDE_FRONT_DISTANCE_Z = 0.6      # Max distance to the car in front, when colliding with its back
+COLLIDE_BACK_DISTANCE_Z = 1.2       # Max distance to the car behind, when it collides with our back
+COLLIDE_SIDE_DISTANCE_Z = 0.2       # Z distances below this count as side collisions
+
 # Min/max CPU car target speeds - see also track generation, some track pieces have target speed overrides set
 CPU_CAR_MIN_TARGET_SPEED = 40
 CPU_CAR_MAX_TARGET_SPEED = 65
+CPU_CAR_SPEED_ZONE_OFFSET = 0       # Added to the CPU car target speed limits of the track pieces which have them
+
+# When a CPU car changes lane, it picks a target X position at least CPU_CAR_LANE_GAP_X away from the X positions of
+# other cars within CPU_CAR_LANE_CHECK_DISTANCE_Z of it, to avoid cars driving through each other
+CPU_CAR_LANE_CHECK_DISTANCE_Z = 20
+CPU_CAR_LANE_GAP_X = 300
+CPU_CAR_MIN_TARGET_X = -1000
+CPU_CAR_MAX_TARGET_X = 1000
+
+# Game.get_cars_in_z_range uses car positions from the start of the current update. Cars can't move further than this
+# during one update, so we look this much further either side to make sure we don't miss any
+NEIGHBOUR_QUERY_MARGIN_Z = 5
 
 NUM_LAPS = 5
 NUM_CARS = 20
 
 GRID_CAR_SPACING = 0.55     # How spaced out the cars are on the starting grid
+GRID_LANES = 2              # Number of cars side by side on the starting grid
+GRID_LANE_SPACING = 800     # Distance between the lanes on the starting grid
+
+# Update all CPU cars together using NumPy arrays, rather than one at a time - see CPUCarFleet. Has no effect if NumPy
+# isn't available
+USE_CPU_CAR_FLEET = True
+
+# Set to True for a 'mass start' demo race on the title screen, with lots of CPU cars. Works best with
+# USE_CPU_CAR_FLEET, and you may want to reduce VIEW_DISTANCE to keep the frame rate up
+MASS_START_DEMO = False
+MASS_START_NUM_CARS = 200
+MASS_START_GRID_LANES = 4
 
 # Half-width and height used during point transform, to save having to calculate them each time
 HALF_WIDTH = WIDTH // 2
 HALF_HEIGHT = HEIGHT // 2
 
+# Everything is drawn at this size, relative to a normal full-window view. In split screen mode, each half of the
+# window shows the same view as a full window would, shrunk to fit (see View)
+PROJECTION_SCALE = 1
+
 # Skid sound starts fading in when grip goes below this level
 SKID_SOUND_START_GRIP = 0.8
 
@@ -126,8 +239,32 @@ SHOW_CPU_CAR_SPEEDS = False
 SHOW_DEBUG_TEXT = False
 SHOW_PROFILE_TIMINGS = False
 
+# Frame profile overlay - shows how long each part of each frame has been taking, see FrameProfile.
+# Press F3 during the game to show or hide it, and F4 to save the recorded timings to a CSV file
+SHOW_PROFILE_OVERLAY = False
+PROFILE_HISTORY_SECONDS = 5         # Timings are kept for roughly this many seconds of frames
+PROFILE_OVERLAY_REFRESH_FRAMES = 30 # Figures on the overlay are updated this often, so they're readable
+FRAME_BUDGET_MS = 1000 / 60         # To run at 60 frames per second, each frame must take no longer than this
+
 FIXED_TIMESTEP = 1/60
 
+# The game is updated at a fixed rate of 60 times per second, which doesn't necessarily line up with the frames being
+# drawn. With INTERPOLATE_RENDERING, each frame shows the camera and cars part way between their positions at the last
+# two updates, depending on how much time has passed since the last update - see Game.draw.
+# If the game falls behind, e.g. because drawing is taking too long, it catches up by updating several times in one
+# frame. But the extra updates make that frame take even longer, so the game could fall further and further behind.
+# To prevent this, no more than MAX_UPDATES_PER_FRAME updates are done in one frame - the game will run in slow motion
+# instead
+INTERPOLATE_RENDERING = True
+MAX_UPDATES_PER_FRAME = 4
+
+# With RENDER_THREAD enabled, the work of deciding what to draw each frame (projecting the track, and scaling the
+# scenery and car images) is done on a separate thread, while the main thread draws the previous frame - see
+# Game.draw_pipelined. Normally Python can only run one thread at a time, but Pygame lets other threads run while it's
+# scaling or drawing images, so on a computer with more than one CPU core, the two can partly happen at the same time.
+# This adds one frame of delay between the game updating and the result appearing on the screen
+RENDER_THREAD = False
+
 # These symbols substitute for the controller button images when displaying text.
 # The symbols representing these images must be ones that aren't actually used themselves, e.g. we don't use the
 # percent sign in text
@@ -153,6 +290,307 @@ class Profiler:
     def __str__(self):
         return f"{self.name}: {self.get_ms()}ms"
 
+# FrameProfile records how long each part of the update and drawing code (e.g. drawing the background, the track, the
+# cars) took on each frame, for the most recent frames. For each of these categories, it keeps a deque - a list which
+# can efficiently have items added to one end and removed from the other. Given a maximum length, a deque
+# automatically throws away its oldest item when a new one is added, so it acts as a 'ring buffer' which always holds
+# the latest PROFILE_HISTORY_SECONDS worth of frames.
+# The overlay shows the 50th, 95th and 99th percentiles for each category - for example, the 95th percentile is the
+# time which 95% of frames came in under. The average time taken isn't very useful on its own, as the occasional slow
+# frame shows up as a stutter even if the average is well within the frame budget. The worst frame is shown as well,
+# along with the track piece the camera was at on that frame, so that we can see which parts of the track are slow
+# to draw.
+class FrameProfile:
+    # The TOTAL column is the sum of all the categories. The INTERVAL column is the actual time between the end of
+    # one frame and the end of the next, which also includes time spent outside our code, e.g. by Pygame Zero
+    TOTAL = "total"
+    INTERVAL = "interval"
+
+    def __init__(self, max_frames):
+        self.max_frames = max_frames
+        self.history = {}
+        self.frame_numbers = deque(maxlen=max_frames)
+        self.track_piece_indices = deque(maxlen=max_frames)
+        self.frame_counter = 0
+        self.last_frame_end_time = None
+        self.last_frame_ms = 0
+
+        # Times are added to the current frame's entry during the frame, then stored by end_frame. The track piece
+        # index is set by Game.draw
+        self.current_times = {}
+        self.track_piece_idx = 0
+
+        # Figures for the overlay, updated every PROFILE_OVERLAY_REFRESH_FRAMES frames
+        self.overlay_rows = []
+        self.overlay_worst = ""
+
+    def add_time(self, category, ms):
+        self.current_times[category] = self.current_times.get(category, 0) + ms
+
+    def add_times(self, times):
+        for category, ms in times.items():
+            self.add_time(category, ms)
+
+    def end_frame(self):
+        now = time.perf_counter()
+        interval = (now - self.last_frame_end_time) * 1000 if self.last_frame_end_time is not None else 0
+        self.last_frame_end_time = now
+
+        times = self.current_times
+        times[FrameProfile.TOTAL] = sum(times.values())
+        times[FrameProfile.INTERVAL] = interval
+
+        # A category which hasn't been seen before gets a new deque, filled with zeros for the earlier frames, so that
+        # the entries in every deque line up with the entries in frame_numbers
+        for category in times:
+            if category not in self.history:
+                self.history[category] = deque([0] * len(self.frame_numbers), maxlen=self.max_frames)
+        for category, values in self.history.items():
+            values.append(times.get(category, 0))
+        self.frame_numbers.append(self.frame_counter)
+        self.track_piece_indices.append(self.track_piece_idx)
+        self.last_frame_ms = times[FrameProfile.TOTAL]
+
+        self.current_times = {}
+        self.frame_counter += 1
+
+        if SHOW_PROFILE_OVERLAY and (self.frame_counter % PROFILE_OVERLAY_REFRESH_FRAMES == 0
+                                     or not self.overlay_rows):
+            self.update_overlay()
+
+    def get_stats(self, category):
+        # Returns the 50th, 95th and 99th percentiles and the maximum of the times for a category
+        values = sorted(self.history[category])
+        if not values:
+            return 0, 0, 0, 0
+        last = len(values) - 1
+        percentiles = [values[min(last, int(len(values) * percentile))] for percentile in (0.5, 0.95, 0.99)]
+        return tuple(percentiles) + (values[-1],)
+
+    def update_overlay(self):
+        # Categories are listed in order of their 95th percentile time, slowest first, with the total and interval
+        # rows at the bottom
+        rows = [(category, self.get_stats(category)) for category in self.history
+                if category not in (FrameProfile.TOTAL, FrameProfile.INTERVAL)]
+        rows.sort(key=lambda row: row[1][1], reverse=True)
+        rows += [(category, self.get_stats(category)) for category in (FrameProfile.TOTAL, FrameProfile.INTERVAL)
+                 if category in self.history]
+        self.overlay_rows = rows
+
+        totals = self.history.get(FrameProfile.TOTAL)
+        if totals:
+            worst_idx = max(range(len(totals)), key=totals.__getitem__)
+            self.overlay_worst = (f"worst: {totals[worst_idx]:.1f}ms, frame {self.frame_numbers[worst_idx]}, "
+                                  f"track piece {self.track_piece_indices[worst_idx]}")
+
+    def draw(self):
+        columns = ("", "p50", "p95", "p99", "max")
+        column_x = (10, 190, 260, 330, 400)
+        row_height = 18
+        top = 10
+
+        # Darken the area behind the text so that it's readable
+        height = (len(self.overlay_rows) + 2) * row_height + 10
+        screen.surface.blit(profile_overlay_background, (0, 0), pygame.Rect(0, 0, 470, height))
+
+        for x, heading in zip(column_x, columns):
+            screen.draw.text(heading, (x, top), fontsize=20)
+        for i, (category, stats) in enumerate(self.overlay_rows):
+            y = top + (i + 1) * row_height
+            # Show times in red if they're over the frame budget
+            screen.draw.text(category, (column_x[0], y), fontsize=20)
+            for x, ms in zip(column_x[1:], stats):
+                colour = (255, 80, 80) if ms > FRAME_BUDGET_MS else (255, 255, 255)
+                screen.draw.text(f"{ms:.2f}", (x, y), fontsize=20, color=colour)
+        screen.draw.text(self.overlay_worst, (column_x[0], top + (len(self.overlay_rows) + 1) * row_height),
+                         fontsize=20)
+
+    def save_csv(self, filename):
+        # Saves one row per frame, with the time taken by each category
+        categories = list(self.history)
+        with open(filename, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["frame", "track_piece"] + categories)
+            for i in range(len(self.frame_numbers)):
+                writer.writerow([self.frame_numbers[i], self.track_piece_indices[i]]
+                                + [f"{self.history[category][i]:.3f}" for category in categories])
+
+frame_profile = FrameProfile(int(PROFILE_HISTORY_SECONDS / FIXED_TIMESTEP))
+
+# Semi-transparent black image drawn behind the frame profile overlay
+profile_overlay_background = pygame.Surface((WIDTH, HEIGHT))
+profile_overlay_background.set_alpha(160)
+
+
+# Scaling an image is one of the slowest things we do when drawing each frame, and the scenery and cars usually only
+# change size by a tiny amount from one frame to the next. So instead of scaling the images every frame, we keep the
+# scaled images we've made recently, and reuse them if they're needed again at the same size, or very nearly the same.
+# To make it more likely that a scaled image can be reused, widths from 64 up to 255 pixels are rounded down to an even
+# number, so the size is never more than 1 pixel off. Smaller images are cheap to scale, so their sizes are kept exact.
+# So are larger ones - they're close to the camera, where they grow quickly so are rarely reused, and any rounding would
+# make them visibly jump between sizes as they approach.
+# The cache uses an OrderedDict to keep track of which images were used least recently. When the total size of the
+# cached images goes over the limit, the least recently used ones are thrown away (known as 'LRU eviction').
+class ScaledImageCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes_used = 0
+        self.scaled_images = OrderedDict()
+
+        # Count how many times we found the image we wanted (a 'hit'), or had to scale it (a 'miss')
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def round_size(size):
+        size = int(size)
+        if 64 <= size < 256:
+            return size - size % 2
+        return size
+
+    def get(self, image, width, height):
+        # Return a version of the image scaled to width x height pixels, or very nearly. If the width was rounded, the
+        # height is adjusted to keep the image's shape
+        rounded_width = self.round_size(width)
+        if rounded_width != int(width):
+            rounded_height = int(height * rounded_width / width)
+        else:
+            rounded_height = int(height)
+        key = (image, rounded_width, rounded_height)
+
+        scaled = self.scaled_images.get(key)
+        if scaled is not None:
+            # Mark as most recently used
+            self.scaled_images.move_to_end(key)
+            self.hits += 1
+            return scaled
+
+        self.misses += 1
+        source = mipmap_pyramids.get_level(image, rounded_width, rounded_height) if USE_MIPMAPS else image
+        scaled = SCALE_FUNC(source, (rounded_width, rounded_height))
+        self.scaled_images[key] = scaled
+        self.bytes_used += self.get_bytes(scaled)
+
+        # Throw away least recently used images until we're back under the memory limit
+        while self.bytes_used > self.max_bytes and len(self.scaled_images) > 1:
+            _, oldest = self.scaled_images.popitem(last=False)
+            self.bytes_used -= self.get_bytes(oldest)
+
+        return scaled
+
+    @staticmethod
+    def get_bytes(image):
+        return image.get_width() * image.get_height() * image.get_bytesize()
+
+    def clear(self):
+        self.scaled_images.clear()
+        self.bytes_used = 0
+
+# When a large image is scaled down to a small size, most of the original pixels are skipped over, so it's slow and
+# the result looks blocky and flickers as it moves (this is known as aliasing). A common solution is to use mipmaps:
+# a 'pyramid' of copies of the image, each half the width and height of the one before. These are made once using
+# smoothscale, which gives good quality results. When we need the image at a particular size, we start from the
+# smallest copy which is still at least as big as the size we want, so there's only a small amount of scaling left to
+# do. The pyramid for an image is only created the first time it's needed.
+class MipmapPyramids:
+    # Don't make copies smaller than this
+    MIN_SIZE = 8
+
+    def __init__(self):
+        self.pyramids = {}
+
+    def get_pyramid(self, image):
+        pyramid = self.pyramids.get(image)
+        if pyramid is None:
+            pyramid = [image]
+            while pyramid[-1].get_width() // 2 >= self.MIN_SIZE and pyramid[-1].get_height() // 2 >= self.MIN_SIZE:
+                previous = pyramid[-1]
+                pyramid.append(pygame.transform.smoothscale(previous, (previous.get_width() // 2,
+                                                                       previous.get_height() // 2)))
+            self.pyramids[image] = pyramid
+        return pyramid
+
+    def get_level(self, image, width, height):
+        # Return the smallest copy of the image which is at least width x height pixels, or the original image if
+        # we want it at a larger size than the original
+        best = image
+        for level in self.get_pyramid(image):
+            if level.get_width() < width or level.get_height() < height:
+                break
+            best = level
+        return best
+
+mipmap_pyramids = MipmapPyramids()
+
+scaled_image_cache = ScaledImageCache(SCALED_IMAGE_CACHE_MAX_BYTES)
+
+# DetailController adjusts the level of detail based on how long each frame takes to update and draw, to keep the
+# frame rate up on slower computers while still looking as good as possible on faster ones. It changes the settings
+# at the top of this file, using the values from DETAIL_LEVELS.
+# The time taken varies from frame to frame, so we use a smoothed value, known as an exponential moving average: each
+# frame, it moves 10% of the way towards the latest time. A level change only happens after the smoothed time has been
+# too high or too low for a number of frames in a row, and the thresholds for going down and up are a long way apart.
+# This is known as hysteresis - without it, the detail level could keep flicking between two levels, which would be
+# very noticeable. We're also quicker to turn the detail down than up, as a low frame rate is worse than a slightly
+# less detailed view.
+class DetailController:
+    SMOOTHING = 0.1
+
+    def __init__(self, levels, start_level):
+        # Start with the current values of the settings, rather than the ones in the starting level
+        self.levels = list(levels)
+        self.levels[start_level] = {name: globals()[name] for name in levels[start_level]}
+        self.level = None
+        self.set_level(start_level)
+
+    def set_level(self, level):
+        settings = self.levels[level]
+
+        # Images scaled with the previous scale function shouldn't be reused
+        if settings["SCALE_FUNC"] is not SCALE_FUNC:
+            scaled_image_cache.clear()
+
+        # Change the settings at the top of this file. globals gives us a dictionary of all the variables which are
+        # defined outside of functions and classes
+        globals().update(settings)
+
+        self.level = level
+        self.smoothed_ms = None
+        self.slow_frames = 0
+        self.fast_frames = 0
+        self.wait_frames = DETAIL_CHANGE_WAIT_FRAMES
+
+    def update(self, frame_ms):
+        # Frames just after a level change aren't counted, as they'll include the time taken to scale images which
+        # weren't needed at the previous level
+        if self.wait_frames > 0:
+            self.wait_frames -= 1
+            return
+
+        if self.smoothed_ms is None:
+            self.smoothed_ms = frame_ms
+        else:
+            self.smoothed_ms += (frame_ms - self.smoothed_ms) * DetailController.SMOOTHING
+
+        self.slow_frames = self.slow_frames + 1 if self.smoothed_ms > DETAIL_STEP_DOWN_MS else 0
+        self.fast_frames = self.fast_frames + 1 if self.smoothed_ms < DETAIL_STEP_UP_MS else 0
+
+        if self.slow_frames >= DETAIL_STEP_DOWN_FRAMES and self.level < len(self.levels) - 1:
+            self.set_level(self.level + 1)
+        elif self.fast_frames >= DETAIL_STEP_UP_FRAMES and self.level > 0:
+            self.set_level(self.level - 1)
+
+detail_controller = DetailController(DETAIL_LEVELS, DETAIL_START_LEVEL) if ADAPTIVE_DETAIL else None
+
+# Thread used to build draw commands when RENDER_THREAD is enabled. This is None until get_render_thread first needs
+# it, so that the thread isn't made at all when RENDER_THREAD is off, or in the race farm's processes
+render_thread = None
+
+def get_render_thread():
+    global render_thread
+    if render_thread is None:
+        render_thread = ThreadPoolExecutor(max_workers=1)
+    return render_thread
 
 # Utility functions
 
@@ -224,6 +662,355 @@ def draw_text(text, x, y, centre=False, font="font"):
             screen.blit(image, (x, y))
         x += width + TEXT_GAP_X[font]
 
+def draw_polygon(points, col):
+    if USE_GFXDRAW:
+        if OUTLINE_W == 0:
+            pygame.gfxdraw.filled_polygon(screen.surface, points, col)
+        else:
+            pygame.gfxdraw.polygon(screen.surface, points, col)
+    else:
+        pygame.draw.polygon(screen.surface, col, points, OUTLINE_W)
+
+def clip_polygon(points, width, height):
+    # Clips a polygon to the area from (0, 0) to (width, height), using the Sutherland-Hodgman algorithm. The polygon is
+    # clipped against each edge of the area in turn: going around the polygon, points on the inside of the edge are
+    # kept, and wherever a side of the polygon crosses the edge, the point where it crosses is added. Returns the
+    # clipped polygon's points, which will be fewer than 3 if the polygon was entirely outside the area
+    # Each edge is given as the axis (0 for X, 1 for Y), the position of the edge on that axis, and 1 if points with
+    # greater positions are inside or -1 if points with smaller positions are
+    for axis, limit, direction in ((1, height, -1), (1, 0, 1), (0, 0, 1), (0, width, -1)):
+        clipped = []
+        prev = points[-1] if points else None
+        for point in points:
+            inside = (point[axis] - limit) * direction >= 0
+            if inside != ((prev[axis] - limit) * direction >= 0):
+                fraction = (limit - prev[axis]) / (point[axis] - prev[axis])
+                crossing = [prev[0] + (point[0] - prev[0]) * fraction, prev[1] + (point[1] - prev[1]) * fraction]
+                crossing[axis] = limit
+                clipped.append(tuple(crossing))
+            if inside:
+                clipped.append(point)
+            prev = point
+        points = clipped
+    return points
+
+def draw_spans(pixel_rows, rows):
+    # Writes whole rows of pixels (a 2D NumPy array, one row for each entry in rows) straight into the screen.
+    # pixels2d gives an array which shares its memory with the screen, indexed by X then Y. The screen is locked while
+    # the array exists, so we delete it as soon as we've finished
+    pixels = pygame.surfarray.pixels2d(screen.surface)
+    pixels[:, rows] = pixel_rows.T
+    del pixels
+
+# Instead of drawing track pieces etc as we come across them, Game.draw stores draw commands in a DrawCommandBuffer.
+# Then once it's finished going through the track pieces, the commands are executed in reverse order, so that track
+# pieces, cars and scenery in the distance are drawn before things which are closer.
+# Each command is stored as one entry in each of several lists (known as 'parallel arrays') rather than as a separate
+# object, as creating thousands of objects every frame is slow and makes more work for Python's garbage collector. The
+# lists are emptied and reused each frame.
+class DrawCommandBuffer:
+    # Opcodes, which say what type of command each entry is
+    POLYGON = 0         # Polygon, using an entry in colours, and points from vertices
+    BLIT = 1            # Image, using entries in surfaces and positions
+    TEXT = 2            # Text in the game's font. The text is stored in surfaces, as it takes the place of an image
+    DEBUG_TEXT = 3      # Text in Pygame Zero's default font
+    FILL = 4            # Fill the whole screen with a colour, using the entry in colours
+    SPANS = 5           # Rows of pixels from the scanline renderer, using entries in surfaces (the pixel values) and
+                        # positions (the screen rows to write them to) - see TrackScanlines
+
+    def __init__(self):
+        self.ops = []
+        self.categories = []        # Name used to group together the time taken by commands, for profiling
+        self.colours = []
+        self.vertex_starts = []     # Index in vertices of the first point of each polygon
+        self.vertices = []          # Points for all of the polygons, one after another
+        self.surfaces = []
+        self.positions = []
+
+    def clear(self):
+        for values in (self.ops, self.categories, self.colours, self.vertex_starts, self.vertices, self.surfaces,
+                       self.positions):
+            values.clear()
+
+    def add(self, op, category, colour=None, points=(), surface=None, pos=None):
+        self.ops.append(op)
+        self.categories.append(category)
+        self.colours.append(colour)
+        self.vertex_starts.append(len(self.vertices))
+        self.vertices.extend(points)
+        self.surfaces.append(surface)
+        self.positions.append(pos)
+
+    def add_polygon(self, points, colour, category):
+        self.add(DrawCommandBuffer.POLYGON, category, colour=colour, points=points)
+
+    def add_blit(self, surface, pos, category):
+        self.add(DrawCommandBuffer.BLIT, category, surface=surface, pos=pos)
+
+    def add_text(self, text, pos, category="text", debug=False):
+        self.add(DrawCommandBuffer.DEBUG_TEXT if debug else DrawCommandBuffer.TEXT, category, surface=text, pos=pos)
+
+    def add_fill(self, colour, category):
+        self.add(DrawCommandBuffer.FILL, category, colour=colour)
+
+    def add_spans(self, pixel_rows, rows, category):
+        self.add(DrawCommandBuffer.SPANS, category, surface=pixel_rows, pos=rows)
+
+    def set_spans(self, command, pixel_rows, rows):
+        # Fill in the rows for a SPANS command which was added before they were worked out, see TrackScanlines
+        self.surfaces[command] = pixel_rows
+        self.positions[command] = rows
+
+    def execute(self, times):
+        # Run all of the commands, starting from the last one. Rather than timing each command separately, we time
+        # each run of consecutive commands which are in the same category, and add the result to times
+        category = None
+        start_time = time.perf_counter()
+
+        # The points of a polygon go from its entry in vertex_starts, up to the start of the next command's points
+        vertex_end = len(self.vertices)
+
+        for i in range(len(self.ops) - 1, -1, -1):
+            if self.categories[i] != category:
+                now = time.perf_counter()
+                if category is not None:
+                    times[category] = times.get(category, 0) + (now - start_time) * 1000
+                category = self.categories[i]
+                start_time = now
+
+            op = self.ops[i]
+            vertex_start = self.vertex_starts[i]
+            if op == DrawCommandBuffer.POLYGON:
+                draw_polygon(self.vertices[vertex_start:vertex_end], self.colours[i])
+            elif op == DrawCommandBuffer.BLIT:
+                screen.blit(self.surfaces[i], self.positions[i])
+            elif op == DrawCommandBuffer.TEXT:
+                draw_text(self.surfaces[i], self.positions[i][0], self.positions[i][1])
+            elif op == DrawCommandBuffer.FILL:
+                screen.fill(self.colours[i])
+            elif op == DrawCommandBuffer.SPANS:
+                draw_spans(self.surfaces[i], self.positions[i])
+            else:
+                screen.draw.text(self.surfaces[i], self.positions[i])
+            vertex_end = vertex_start
+
+        if category is not None:
+            times[category] = times.get(category, 0) + (time.perf_counter() - start_time) * 1000
+
+# Neighbouring track pieces are often the same colour - the track itself is almost always the same colour, while the
+# rumble strips and trackside alternate colours every few track pieces. Rather than drawing a separate polygon for
+# each track piece, TrackStrips joins up the polygons of consecutive track pieces into longer strips, each of which
+# can be drawn with a single polygon - which is much faster, as each call to draw a polygon has quite a bit of
+# overhead.
+# There's a catch: if the track goes over a hill crest, the track pieces on the far side may be drawn on top of the
+# pieces in front of the hill (before being covered up again by the pieces in front). A strip which folds back on
+# itself like that would not be drawn properly, and would mess up the order in which things are drawn. So Game.draw
+# only joins up pieces while the track keeps going up the screen, and flushes the strips into the draw command buffer
+# when that's no longer the case.
+class TrackStrips:
+    # Layers, in the order that their polygons are added to the draw command buffer. As the buffer is executed in
+    # reverse order, the last layer is drawn first, and the others are drawn on top of it. The layer names are also
+    # used as profiling categories
+    LAYERS = ("stripe", "yellow line L", "yellow line R", "track", "rumble L", "rumble R", "trackside left",
+              "trackside right")
+
+    def __init__(self):
+        # For each layer, the strip which is currently being built, or None. A strip is a list containing the colour,
+        # the index of the last track piece added, and two lists of points along each side of the strip
+        self.current = {layer: None for layer in TrackStrips.LAYERS}
+
+        # For each layer, a list of strips which are complete but haven't yet been added to the draw command buffer
+        self.finished = {layer: [] for layer in TrackStrips.LAYERS}
+
+    def add(self, layer, track_piece_idx, col, prev_a, prev_b, a, b):
+        # Add the polygon for a track piece, which joins points a and b to the points prev_a and prev_b from the
+        # previous track piece. If possible, this extends the current strip, otherwise it starts a new one. A strip
+        # can only be extended if it's the same colour, and ends on the previous track piece (if the previous track
+        # piece wasn't added, for example because it was off the screen, there would be a gap)
+        strip = self.current[layer]
+
+        # A polygon which goes off the top or bottom of the screen is clipped to the screen (see clip_polygon), and
+        # drawn on its own. Pygame fills polygons one row at a time, so drawing the polygon just in front of the camera,
+        # which can reach thousands of pixels below the screen, would otherwise take a lot of time for nothing. Polygons
+        # which only go off the sides of the screen are cheap to draw, as Pygame skips the part of each row which is
+        # off the screen
+        if not (0 <= prev_a[1] <= HEIGHT and 0 <= a[1] <= HEIGHT):
+            if strip is not None:
+                self.finished[layer].append(strip)
+                self.current[layer] = None
+            points = clip_polygon([prev_a, a, b, prev_b], WIDTH, HEIGHT)
+            if len(points) >= 3:
+                self.finished[layer].append([col, track_piece_idx, points, []])
+            return
+
+        # Polygons are only joined up if they're filled - joining up outlined polygons would change how they look
+        if strip is not None and (strip[0] != col or strip[1] != track_piece_idx - 1 or not MERGE_TRACK_POLYGONS
+                                  or OUTLINE_W != 0):
+            self.finished[layer].append(strip)
+            strip = None
+
+        if strip is None:
+            self.current[layer] = [col, track_piece_idx, [prev_a, a], [prev_b, b]]
+        else:
+            strip[1] = track_piece_idx
+            strip[2].append(a)
+            strip[3].append(b)
+
+    def flush(self, draw_commands):
+        # Add all strips to the draw command buffer, and start afresh
+        for layer in TrackStrips.LAYERS:
+            finished = self.finished[layer]
+            if self.current[layer] is not None:
+                finished.append(self.current[layer])
+                self.current[layer] = None
+            for col, _, side_a, side_b in finished:
+                # The polygon goes along side a, then back along side b
+                side_b.reverse()
+                draw_commands.add_polygon(side_a + side_b, col, layer)
+            finished.clear()
+
+# TrackScanlines is used instead of TrackStrips when SCANLINE_ROAD is enabled. Rather than drawing polygons, it works out
+# the colour of every pixel in each row of the screen that the track covers, in the way that classic pseudo-3D racing
+# games drew their roads.
+# The polygons joining a track piece to the previous one all go between the same two rows of the screen, and within
+# each row the edges of the trackside, rumble strips, track, yellow lines and stripe always appear in the same order from
+# left to right. So each row is just a series of spans of colour. For every row, we find the X positions of the edges by
+# interpolating between the two track pieces, then numpy.repeat repeats each span's colour for the length of the span,
+# giving the whole row of pixels. The rows are written into the screen by a single draw command for each flush (see
+# draw_spans), instead of hundreds of polygons.
+# Flushing works in the same way as for TrackStrips, so the rows are drawn in the correct order with the scenery and cars.
+# Each flush only adds a draw command, and the rows for all of them are worked out in one go by add_rows once all of the
+# track pieces have been added, as NumPy is much faster at one big job than at lots of small ones
+class TrackScanlines:
+    # The edges within each row, from left to right on the screen, as indices into TrackProjection.screen_x: left
+    # rumble strip outer edge, left edge of track, left yellow line outer/inner edges, stripe left/right edges, right
+    # yellow line inner/outer edges, right edge of track, right rumble strip outer edge. The spans between them (and the
+    # sides of the screen) are, from left to right: trackside, rumble strip, track, yellow line, track, stripe, track,
+    # yellow line, track, rumble strip, trackside
+    EDGE_ORDER = [4, 0, 6, 7, 2, 3, 9, 8, 1, 5]
+
+    # How each edge is rounded to a whole pixel, to match the polygons (see add_rows). Pygame rounds an edge down if
+    # it's on the first side of a polygon, and up if it's on the second side. Where two polygons meet, the one drawn
+    # later covers the pixel they share. EDGE_ROUND_DOWN says whether each edge is rounded down, and EDGE_AFTER is 1
+    # where the span on the left of the edge is drawn on top of the one on its right, so the edge's pixel belongs to
+    # the left span
+    EDGE_ROUND_DOWN = numpy.array([True, True, True, False, True, False, False, True, False, True]) if USE_NUMPY else None
+    EDGE_AFTER = numpy.array([0, 0, 0, 1, 0, 1, 0, 1, 1, 1]) if USE_NUMPY else None
+
+    def __init__(self, projection, surface):
+        # The screen positions of the rows for every track piece in the projection. Each piece's polygons join its row
+        # to the previous row, so the rows are stored one place further on, and the first visible piece's previous
+        # row is where the track crosses the clipping plane (see TrackProjection.clip_near_plane). That way the
+        # previous row for the piece at position i in the projection is always at i in these arrays
+        self.screen_y = numpy.empty(len(projection.screen_y) + 1)
+        self.screen_y[1:] = projection.screen_y
+        self.edges_x = numpy.empty((len(projection.screen_y) + 1, len(TrackScanlines.EDGE_ORDER)))
+        self.edges_x[1:] = numpy.array(projection.screen_x).T[:, TrackScanlines.EDGE_ORDER]
+        if projection.near_screen_y is not None:
+            self.screen_y[projection.first_visible] = projection.near_screen_y
+            self.edges_x[projection.first_visible] = numpy.array(projection.near_screen_x)[TrackScanlines.EDGE_ORDER]
+
+        # Pygame drops the fractional part of each point's position when drawing a polygon, so we do the same
+        numpy.trunc(self.screen_y, out=self.screen_y)
+        numpy.trunc(self.edges_x, out=self.edges_x)
+
+        self.surface = surface
+        self.pixel_values = {}          # Colours converted to the pixel format of the surface, see map_colour
+
+        # Position in the projection of each track piece to be drawn, and the pixel value for each of its spans
+        self.pieces = []
+        self.colours = []
+
+        # For each flush, the position in self.pieces of its first track piece, and its draw command's index in the
+        # draw command buffer
+        self.flush_starts = []
+        self.flush_commands = []
+
+    def map_colour(self, col):
+        pixel = self.pixel_values.get(col)
+        if pixel is None:
+            pixel = self.pixel_values[col] = self.surface.map_rgb(col)
+        return pixel
+
+    def add(self, proj_i, track_col, show_stripe, rumble_col, trackside_col):
+        # Add the rows joining a track piece to the previous one. Where something isn't drawn, e.g. the stripe, which is
+        # only on every other few track pieces, its span is given the colour of whatever is underneath it
+        track = self.map_colour(track_col)
+        trackside = self.map_colour(trackside_col)
+        rumble = self.map_colour(rumble_col) if SHOW_RUMBLE_STRIPS else trackside
+        yellow_line = self.map_colour(YELLOW_LINE_COL) if SHOW_YELLOW_LINES else track
+        stripe = self.map_colour(STRIPE_COLOUR) if show_stripe else track
+        self.pieces.append(proj_i)
+        self.colours.append((trackside, rumble, track, yellow_line, track, stripe, track, yellow_line, track, rumble,
+                             trackside))
+
+    def flush(self, draw_commands):
+        # Add a draw command for the track pieces added since the last flush. Its rows are filled in by add_rows
+        start = self.flush_starts[-1] if self.flush_starts else 0
+        if len(self.pieces) > start:
+            self.flush_starts.append(len(self.pieces))
+            self.flush_commands.append(len(draw_commands.ops))
+            draw_commands.add_spans(None, None, "track")
+
+    def add_rows(self, draw_commands):
+        # Work out the rows for all of the flushes, and give each flush's draw command its rows
+        if not self.pieces:
+            return
+        pieces = numpy.array(self.pieces)
+        prev_y, y = self.screen_y[pieces], self.screen_y[pieces + 1]
+        colours = numpy.array(self.colours, dtype=numpy.uint32)
+
+        # Each track piece covers the same rows as its polygons would. Pygame fills every row from a polygon's top
+        # point to its bottom point, including both. The track usually goes up the screen, but the piece after a hill
+        # crest may go down, so we don't assume which is higher
+        first_row = numpy.clip(numpy.minimum(prev_y, y), 0, HEIGHT).astype(int)
+        end_row = numpy.clip(numpy.maximum(prev_y, y) + 1, 0, HEIGHT).astype(int)
+
+        # So each track piece shares its bottom row with the piece in front of it, and near the horizon, where the track
+        # pieces are less than a pixel apart, many pieces can share the same row. The nearer piece is drawn last, so
+        # it's the one which ends up on the screen. The pieces are nearest first, and each flush only has pieces
+        # which keep going up the screen, so a piece's rows end where those of the piece before it in the same flush
+        # begin
+        same_flush = numpy.ones(len(pieces), dtype=bool)
+        same_flush[self.flush_starts[:-1]] = False
+        end_row[1:] = numpy.where(same_flush[1:], numpy.minimum(end_row[1:], first_row[:-1]), end_row[1:])
+        num_rows = numpy.maximum(end_row - first_row, 0)
+
+        # Make a list of the rows, saying which track piece each one belongs to
+        piece = numpy.repeat(numpy.arange(len(pieces)), num_rows)
+        rows = first_row[piece] + numpy.arange(len(piece)) - numpy.repeat(numpy.cumsum(num_rows) - num_rows, num_rows)
+
+        # Interpolate the edges for each row in the same way as Pygame does for the polygons, then round them as
+        # described above EDGE_ROUND_DOWN. A track piece which is only one row high is drawn by Pygame as a line
+        # covering all of its points. Edges off the side of the screen are moved to the side, and an edge which would
+        # be left of the one before (e.g. on a track piece too narrow for its yellow lines) is moved onto it
+        prev_x, x = self.edges_x[pieces[piece]], self.edges_x[pieces[piece] + 1]
+        prev_row = prev_y[piece]
+        height = y[piece] - prev_row
+        flat = height == 0
+        if flat.any():
+            height[flat] = 1
+        row_edges_x = prev_x + (x - prev_x) * ((rows - prev_row) / height)[:, None]
+        row_edges_x = numpy.where(TrackScanlines.EDGE_ROUND_DOWN, numpy.floor(row_edges_x), numpy.ceil(row_edges_x))
+        if flat.any():
+            row_edges_x[flat] = numpy.where(TrackScanlines.EDGE_AFTER, numpy.maximum(prev_x[flat], x[flat]),
+                                            numpy.minimum(prev_x[flat], x[flat]))
+        row_edges_x += TrackScanlines.EDGE_AFTER
+        row_edges_x = numpy.clip(row_edges_x, 0, WIDTH).astype(int)
+        numpy.maximum.accumulate(row_edges_x, axis=1, out=row_edges_x)
+
+        # The widths of the spans in each row add up to WIDTH, so repeating each span's colour for its width gives all
+        # of the rows' pixels, one row after another
+        widths = numpy.diff(row_edges_x, axis=1, prepend=0, append=WIDTH)
+        pixel_rows = numpy.repeat(colours[piece].ravel(), widths.ravel()).reshape(-1, WIDTH)
+
+        # Each flush's rows follow on from the previous flush's
+        flush_ends = numpy.cumsum(num_rows)[numpy.array(self.flush_starts) - 1].tolist()
+        start = 0
+        for command, end in zip(self.flush_commands, flush_ends):
+            draw_commands.set_spans(command, pixel_rows[start:end], rows[start:end])
+            start = end
+
 class Controls(ABC):
     NUM_BUTTONS = 2
 
@@ -266,6 +1053,22 @@ class KeyboardControls(Controls):
         elif button == 1:
             return keyboard.lshift or keyboard.x
 
+# In a two player game, the second player uses A and D to steer, W to accelerate and S to brake
+class Player2KeyboardControls(Controls):
+    def get_x(self):
+        if keyboard.a:
+            return -1
+        elif keyboard.d:
+            return 1
+        else:
+            return 0
+
+    def button_down(self, button):
+        if button == 0:
+            return keyboard.w
+        elif button == 1:
+            return keyboard.s
+
 class JoystickControls(Controls):
     def __init__(self, joystick):
         super().__init__()
@@ -349,46 +1152,156 @@ class LampRight(Scenery):
 # The X and Y offsets are the offsets from the previous track piece, so if, for example, track pieces 0 to 5 have an
 # X offset of zero and track piece 6 has a very large offset of 1000, it's while moving from 5 to 6 that the car
 # will start to move to the left
+# TrackPiece objects are only used to define the track - once it's been defined, the track is converted into a more
+# compact form, see Track
 class TrackPiece:
-    def __init__(self, scenery=(), offset_x=0, offset_y=0, cpu_max_target_speed=None, col=TRACK_COLOUR, width=TRACK_W):
-        self.scenery = scenery
+    def __init__(self, scenery=None, offset_x=0, offset_y=0, cpu_max_target_speed=None, col=TRACK_COLOUR, width=TRACK_W,
+                 start_line=False):
+        self.scenery = scenery      # Name of scenery group, see get_scenery_group
+        self.start_line = start_line
         self.offset_x = offset_x
         self.offset_y = offset_y
         self.cpu_max_target_speed = cpu_max_target_speed
         self.col = col
         self.width = width
-        self.cars = []  # Cars currently on this track piece
 
 class TrackPieceStartLine(TrackPiece):
     def __init__(self):
-        super().__init__(scenery = [StartGantry()], col=(255,255,255))
+        super().__init__(scenery="start gantry", col=(255,255,255), start_line=True)
+
+# Car and explosion sprites are identified by a number (a 'handle'), rather than by the name of the image file, which
+# would have to be built as a string each time the sprite changed, and then looked up in Pygame Zero's images object.
+# The sprites are numbered in order of car letter, then angle, then animation frame, followed by the explosion frames,
+# so the handle for a sprite can be worked out with a little arithmetic. SpriteTable loads all of the images once, at
+# startup, and keeps them in a list in the same order, so the handle is the position of the image in the list.
+CAR_LETTERS = "abcde"
+CAR_SPRITE_MAX_ANGLE = 4            # Angles go from -4 to 4
+CAR_SPRITE_ANGLES = CAR_SPRITE_MAX_ANGLE * 2 + 1
+CAR_SPRITE_FRAMES = 6
+EXPLOSION_SPRITE_FRAMES = 16
+EXPLOSION_SPRITE_START = len(CAR_LETTERS) * CAR_SPRITE_ANGLES * CAR_SPRITE_FRAMES
+
+# After the explosion frames come see-through copies of the player car's sprites, followed by the explosion frames
+# again, for the ghost cars in time trial mode (see GhostCar)
+PLAYER_CAR_LETTER = 'a'
+GHOST_SPRITE_START = EXPLOSION_SPRITE_START + EXPLOSION_SPRITE_FRAMES
+GHOST_SPRITE_ALPHA = 110        # 0 = invisible, 255 = fully opaque
+
+def get_car_sprite_base(car_letter):
+    # Returns the handle of the first sprite (angle -4, frame 0) for a car
+    return CAR_LETTERS.index(car_letter) * CAR_SPRITE_ANGLES * CAR_SPRITE_FRAMES
+
+def get_ghost_sprite(handle):
+    # Returns the handle of the see-through copy of a player car or explosion sprite
+    if handle >= EXPLOSION_SPRITE_START:
+        return GHOST_SPRITE_START + CAR_SPRITE_ANGLES * CAR_SPRITE_FRAMES + handle - EXPLOSION_SPRITE_START
+    return GHOST_SPRITE_START + handle - get_car_sprite_base(PLAYER_CAR_LETTER)
+
+class SpriteTable:
+    def __init__(self):
+        self.images = []
+
+    def get_names(self):
+        # Returns the image names for all of the sprites, in handle order
+        names = [f"car_{car_letter}_{angle}_{frame}" for car_letter in CAR_LETTERS
+                 for angle in range(-CAR_SPRITE_MAX_ANGLE, CAR_SPRITE_MAX_ANGLE + 1)
+                 for frame in range(CAR_SPRITE_FRAMES)]
+        names += [f"explode{frame:02}" for frame in range(EXPLOSION_SPRITE_FRAMES)]
+        return names
+
+    def load(self):
+        # Load all of the sprite images. If an image is missing, this raises an exception straight away, rather than
+        # in the middle of a race
+        if not self.images:
+            self.images = [getattr(images, name) for name in self.get_names()]
+
+            # Make the ghost sprites. Multiplying every pixel by a colour with an alpha value below 255, using
+            # BLEND_RGBA_MULT, leaves the colours as they are but makes the whole image partly transparent
+            player_base = get_car_sprite_base(PLAYER_CAR_LETTER)
+            ghost_sources = self.images[player_base:player_base + CAR_SPRITE_ANGLES * CAR_SPRITE_FRAMES] \
+                            + self.images[EXPLOSION_SPRITE_START:EXPLOSION_SPRITE_START + EXPLOSION_SPRITE_FRAMES]
+            for image in ghost_sources:
+                ghost = image.copy()
+                ghost.fill((255, 255, 255, GHOST_SPRITE_ALPHA), special_flags=pygame.BLEND_RGBA_MULT)
+                self.images.append(ghost)
+
+    def __getitem__(self, handle):
+        return self.images[handle]
+
+sprite_table = SpriteTable()
 
 class Car:
     def __init__(self, pos, car_letter):
         self.pos = pos
-        self.image = f"car_{car_letter}_0_0"
+        self.sprite_base = get_car_sprite_base(car_letter)
+        self.sprite = self.sprite_base + CAR_SPRITE_MAX_ANGLE * CAR_SPRITE_FRAMES
         self.speed = 0
         self.grip = 1
-        self.car_letter = car_letter
-        self.track_piece = None
         self.tyre_rotation = 0
 
+        # Position in the race, indexed from 0 - kept up to date by RaceOrder
+        self.race_position = None
+
     def update(self, delta_time):
         self.pos.z -= self.speed * delta_time
-        self.update_current_track_piece()
         self.tyre_rotation += delta_time * self.speed * 0.75
 
-    def update_current_track_piece(self):
-        # Which track piece are we on?
-        current_track_piece = self.track_piece
-        idx = game.get_track_piece_for_z(self.pos.z)
-        if idx is not None:
-            self.track_piece = game.track[idx]
-            if self.track_piece is not current_track_piece:
-                # Remove myself from the old track piece, add myself to the new one
-                if current_track_piece is not None:
-                    current_track_piece.cars.remove(self)
-                self.track_piece.cars.append(self)
+    def is_visible(self):
+        # Cars which aren't visible aren't drawn - see GhostCar
+        return True
+
+    def can_collide(self):
+        return True
+
+    def collide(self, car):
+        # Check for a collision with another car, and if there is one, push the cars apart and adjust their speeds.
+        # Returns "side", "front" (we hit the back of the car in front) or "back" (the car behind hit us), or None if
+        # there was no collision
+        # Y is irrelevant as cars are always on the ground, so we only look at the X and Z differences
+        vec_z = self.pos.z - car.pos.z
+        if -COLLIDE_BACK_DISTANCE_Z < vec_z < COLLIDE_FRONT_DISTANCE_Z:
+            vec_x = self.pos.x - car.pos.x
+            if abs(vec_x) >= COLLIDE_DISTANCE_X:
+                return None
+
+            midpoint = vec_z / 2 + car.pos.z
+            # Which side did we collide on?
+            # An alternative way to do this would be to use the speed difference, e.g. if our speed is faster, we hit
+            # the car in front
+            if abs(vec_z) < COLLIDE_SIDE_DISTANCE_Z:
+                # Side collision
+                self.pos.x += sign(vec_x) * 50
+                car.pos.x -= sign(vec_x) * 50
+                return "side"
+
+            elif vec_z > 0:
+                # Colliding with the back of the car in front
+                self.speed = max(car.speed - 3, 0)
+                car.speed = max(car.speed, self.speed + 3)
+                if isinstance(car, CPUCar):
+                    car.target_speed = car.speed
+
+                # A CPU car which hit the car in front also has to slow down, otherwise it will accelerate straight
+                # back into it and keep bumping into it
+                if isinstance(self, CPUCar):
+                    self.target_speed = self.speed
+
+                # Shift us back and other car forward so we're not longer overlapping
+                self.pos.z = midpoint + COLLIDE_FRONT_DISTANCE_Z * 0.6
+                car.pos.z = midpoint - COLLIDE_FRONT_DISTANCE_Z * 0.6
+                return "front"
+
+            else:
+                # Car behind collided with us - get a speed boost
+                self.speed = max(self.speed, car.speed + 3)
+                car.speed = max(self.speed - 3, 0)
+
+                # Shift other car back and us forward so we're not longer overlapping
+                self.pos.z = midpoint - COLLIDE_BACK_DISTANCE_Z * 0.6
+                car.pos.z = midpoint + COLLIDE_BACK_DISTANCE_Z * 0.6
+                return "back"
+
+        return None
 
     def update_sprite(self, angle, braking, boost=False):
         if self.speed == 0:
@@ -399,7 +1312,7 @@ class Car:
             frame = int(self.tyre_rotation % 2) + 4
         else:
             frame = int(self.tyre_rotation % 2) + 1
-        self.image = f"car_{self.car_letter}_{angle}_{frame}"
+        self.sprite = self.sprite_base + (angle + CAR_SPRITE_MAX_ANGLE) * CAR_SPRITE_FRAMES + frame
 
 
 class CPUCar(Car):
@@ -411,9 +1324,6 @@ class CPUCar(Car):
         self.target_speed = speed
         self.target_x = pos.x
 
-        # Set based on track curvature, so we can display an angled variant of the car sprite
-        self.steering = 0
-
         self.change_speed_timer = uniform(2, 4)
 
     def update(self, delta_time):
@@ -426,44 +1336,266 @@ class CPUCar(Car):
         super().update(delta_time)
 
         track_piece_idx, _ = game.get_first_track_piece_ahead(self.pos.z)
-        if track_piece_idx is not None:
-            self.steering = game.track[track_piece_idx].offset_x
 
         # Every few seconds we'll change target speed by a random amount, but upwards on average, so that slow cars
         # have a chance to catch up, and so that we can see CPU cars overtaking each other
         self.change_speed_timer -= delta_time
         if self.change_speed_timer <= 0 and not game.race_complete:
-            self.target_speed += uniform(-4, 6)
-            self.target_speed = min(max(self.target_speed, CPU_CAR_MIN_TARGET_SPEED), CPU_CAR_MAX_TARGET_SPEED)
-
-            # If we're on a sharp corner and speed is above a certain level, reduce target speed
-            if track_piece_idx is not None:
-                target_speed_override = game.track[track_piece_idx].cpu_max_target_speed
-                if target_speed_override is not None and self.target_speed > target_speed_override:
-                    # Make it slightly random
-                    self.target_speed = uniform(target_speed_override-3, target_speed_override)
-
-            # Also change target X pos to a random value
-            # Ensure not too close to values for nearby cars, to avoid cars driving through each other
-
-            def is_target_x_too_close_to_nearby_cars():
-                for car in game.cars:
-                    if car is not self and abs(self.pos.z - car.pos.z) < 20 and abs(self.target_x - car.pos.x) < 300:
-                        return True
-                return False
-
-            # Limit number of attempts to ensure no chance of infinite loop
-            for attempt in range(0,20):
-                self.target_x = uniform(-1000, 1000)
-                if not is_target_x_too_close_to_nearby_cars():
-                    break
+            self.change_target_speed_and_x(track_piece_idx)
 
             # Reset timer
             self.change_speed_timer = uniform(2, 4)
 
+    @property
+    def steering(self):
+        # Based on the track curvature just ahead of the car, so we can display an angled variant of the car sprite.
+        # This is only needed when the car is drawn, so it's worked out then rather than in every update. Cars beyond
+        # the end of the track use the last track piece
+        track_piece_idx, _ = game.get_first_track_piece_ahead(self.pos.z)
+        if track_piece_idx is None:
+            track_piece_idx = len(game.track) - 1
+        return game.track.offset_x[track_piece_idx % game.track.lap_length]
+
+    def change_target_speed_and_x(self, track_piece_idx):
+        # Change target speed by a random amount, and choose a new target X position
+        self.target_speed += uniform(-4, 6)
+        self.target_speed = min(max(self.target_speed, CPU_CAR_MIN_TARGET_SPEED), CPU_CAR_MAX_TARGET_SPEED)
+
+        # If we're on a sharp corner and speed is above a certain level, reduce target speed
+        if track_piece_idx is not None:
+            target_speed_override = game.track.get_cpu_max_target_speed(track_piece_idx)
+            if target_speed_override is not None:
+                target_speed_override += CPU_CAR_SPEED_ZONE_OFFSET
+            if target_speed_override is not None and self.target_speed > target_speed_override:
+                # Make it slightly random
+                self.target_speed = uniform(target_speed_override-3, target_speed_override)
+
+        # Also change target X pos to a random value
+        # Ensure not too close to values for nearby cars, to avoid cars driving through each other
+        self.target_x = self.choose_target_x()
+
+    def choose_target_x(self):
+        # Each nearby car blocks off a range of X positions around it. Merge the blocked ranges, and collect the gaps
+        # between them which are free to drive in
+        nearby_cars = game.get_cars_in_z_range(self.pos.z - CPU_CAR_LANE_CHECK_DISTANCE_Z,
+                                               self.pos.z + CPU_CAR_LANE_CHECK_DISTANCE_Z)
+        blocked = sorted((car.pos.x - CPU_CAR_LANE_GAP_X, car.pos.x + CPU_CAR_LANE_GAP_X)
+                         for car in nearby_cars if car is not self)
+        gaps = []
+        gap_start = CPU_CAR_MIN_TARGET_X
+        for blocked_start, blocked_end in blocked:
+            if blocked_start > gap_start:
+                gaps.append((gap_start, min(blocked_start, CPU_CAR_MAX_TARGET_X)))
+            gap_start = max(gap_start, blocked_end)
+            if gap_start >= CPU_CAR_MAX_TARGET_X:
+                break
+        if gap_start < CPU_CAR_MAX_TARGET_X:
+            gaps.append((gap_start, CPU_CAR_MAX_TARGET_X))
+
+        # If the whole width of the track is blocked, just go anywhere
+        total_width = sum(gap_end - gap_start for gap_start, gap_end in gaps)
+        if total_width <= 0:
+            return uniform(CPU_CAR_MIN_TARGET_X, CPU_CAR_MAX_TARGET_X)
+
+        # Pick a random point along the combined width of the gaps, so that every free X position is equally likely,
+        # then find which gap it's in
+        x = uniform(0, total_width)
+        for gap_start, gap_end in gaps:
+            if x <= gap_end - gap_start:
+                return gap_start + x
+            x -= gap_end - gap_start
+        return gaps[-1][1]
+
+# CPUCarFleet updates all of the CPU cars together. Instead of each car updating itself in turn, the values which the
+# update works with (such as the positions and speeds) are stored in NumPy arrays, with one element per car - this
+# is known as a 'structure of arrays'. NumPy can then update all of the cars at once, using operations on whole arrays
+# which run much faster than the equivalent Python code would. The cars themselves are FleetCPUCar objects, which
+# don't store these values - they look them up in the fleet's arrays, so the arrays are the only copy of each value,
+# and anything which changes a car (such as a collision) changes the arrays. The only part of the update which is
+# still done one car at a time is choosing a new target speed and X position, which each car only does every few
+# seconds.
+# The update has the same effect as calling CPUCar.update for each car, apart from the order in which random numbers
+# are generated
+class CPUCarFleet:
+    def __init__(self, num_cars):
+        # The arrays are created at full size, and are filled in as the cars are added
+        self.cars = []
+
+        # Speeds and X positions are both moved towards target values at a limited rate, so they're stored in the two
+        # rows of one array, which lets NumPy update both of them with the same operations. speed and pos_x are views
+        # of the rows, so they can also be used as separate arrays
+        self.motion = numpy.zeros((2, num_cars))
+        self.speed, self.pos_x = self.motion
+        self.motion_targets = numpy.zeros((2, num_cars))
+        self.target_speed, self.target_x = self.motion_targets
+
+        # How quickly the values in each row of motion can change, per second
+        self.motion_rates = numpy.zeros((2, num_cars))
+        self.accel = self.motion_rates[0]
+        self.motion_rates[1] = 400
+
+        self.pos_z = numpy.zeros(num_cars)
+        self.prev_pos_x = numpy.zeros(num_cars)
+        self.prev_pos_z = numpy.zeros(num_cars)
+        self.tyre_rotation = numpy.zeros(num_cars)
+
+        # Rather than counting down a timer for each car in every update, we store the time at which each car will
+        # next change its target speed and X position, and the earliest of those times
+        self.time = 0
+        self.change_time = numpy.zeros(num_cars)
+        self.next_change_time = math.inf
+
+    def add_car(self, pos, accel, speed):
+        car = FleetCPUCar(self, len(self.cars), pos, accel, speed)
+        self.cars.append(car)
+        return car
+
+    def store_prev_positions(self):
+        # Remember where the cars were before this update, see Game.update
+        self.prev_pos_x[:] = self.pos_x
+        self.prev_pos_z[:] = self.pos_z
+
+    @staticmethod
+    def move_towards(n, target, max_change):
+        # NumPy version of the move_towards function, for arrays of values. Changes n in place
+        lower = n - max_change
+        upper = n + max_change
+        numpy.maximum(target, lower, out=lower)
+        numpy.minimum(lower, upper, out=n)
+
+    def update(self, delta_time):
+        if game.race_complete:
+            self.target_speed[:] = game.player_car.speed
+
+        # Move the cars - see CPUCar.update and Car.update
+        self.move_towards(self.motion, self.motion_targets, self.motion_rates * delta_time)
+        distance = self.speed * delta_time
+        self.pos_z -= distance
+        distance *= 0.75
+        self.tyre_rotation += distance
+
+        # Every few seconds each car changes its target speed and X position
+        self.time += delta_time
+        if self.time >= self.next_change_time and not game.race_complete:
+            for i in numpy.flatnonzero(self.change_time <= self.time).tolist():
+                car = self.cars[i]
+                track_piece_idx, _ = game.get_first_track_piece_ahead(car.pos.z)
+                car.change_target_speed_and_x(track_piece_idx)
+                car.change_speed_timer = uniform(2, 4)
+            self.next_change_time = self.change_time.min()
+
+# The position of a FleetCPUCar. It can be used in the same ways as the Vector3 positions of other cars - its x, y
+# and z attributes can be read and changed, and it can be copied with Vector3(pos) - but the X and Z values are
+# stored in the fleet's arrays. Cars are always on the ground, so Y is always zero
+class FleetCarPosition:
+    # The fleet's arrays are always changed in place, never replaced, so we can keep references to them
+    __slots__ = ("pos_x", "pos_z", "idx")
+
+    def __init__(self, fleet, idx):
+        self.pos_x = fleet.pos_x
+        self.pos_z = fleet.pos_z
+        self.idx = idx
+
+    @property
+    def x(self):
+        return self.pos_x.item(self.idx)
+
+    @x.setter
+    def x(self, value):
+        self.pos_x[self.idx] = value
+
+    @property
+    def y(self):
+        return 0
+
+    @y.setter
+    def y(self, value):
+        pass
+
+    @property
+    def z(self):
+        return self.pos_z.item(self.idx)
+
+    @z.setter
+    def z(self, value):
+        self.pos_z[self.idx] = value
+
+    # These two methods let Vector3 treat the position as a sequence of three numbers
+    def __len__(self):
+        return 3
+
+    def __getitem__(self, i):
+        return (self.x, self.y, self.z)[i]
+
+# A CPU car which belongs to a CPUCarFleet. It behaves exactly like a CPUCar, but the values which the fleet updates
+# are looked up in (and changed in) the fleet's arrays, rather than being stored in the car
+class FleetCPUCar(CPUCar):
+    def __init__(self, fleet, idx, pos, accel, speed):
+        # These must be set before CPUCar.__init__ runs, as it sets the values which are stored in the fleet
+        self.fleet = fleet
+        self.fleet_idx = idx
+        fleet.pos_x[idx] = pos.x
+        fleet.pos_z[idx] = pos.z
+        super().__init__(FleetCarPosition(fleet, idx), accel, speed)
+
+    @property
+    def prev_pos(self):
+        # The fleet stores the previous positions, see CPUCarFleet.store_prev_positions
+        return Vector3(self.fleet.prev_pos_x.item(self.fleet_idx), 0, self.fleet.prev_pos_z.item(self.fleet_idx))
+
+    @property
+    def speed(self):
+        return self.fleet.speed.item(self.fleet_idx)
+
+    @speed.setter
+    def speed(self, value):
+        self.fleet.speed[self.fleet_idx] = value
+
+    @property
+    def target_speed(self):
+        return self.fleet.target_speed.item(self.fleet_idx)
+
+    @target_speed.setter
+    def target_speed(self, value):
+        self.fleet.target_speed[self.fleet_idx] = value
+
+    @property
+    def target_x(self):
+        return self.fleet.target_x.item(self.fleet_idx)
+
+    @target_x.setter
+    def target_x(self, value):
+        self.fleet.target_x[self.fleet_idx] = value
+
+    @property
+    def accel(self):
+        return self.fleet.accel.item(self.fleet_idx)
+
+    @accel.setter
+    def accel(self, value):
+        self.fleet.accel[self.fleet_idx] = value
+
+    @property
+    def change_speed_timer(self):
+        return self.fleet.change_time.item(self.fleet_idx) - self.fleet.time
+
+    @change_speed_timer.setter
+    def change_speed_timer(self, value):
+        fleet = self.fleet
+        fleet.change_time[self.fleet_idx] = fleet.time + value
+        fleet.next_change_time = min(fleet.next_change_time, fleet.time + value)
+
+    @property
+    def tyre_rotation(self):
+        return self.fleet.tyre_rotation.item(self.fleet_idx)
+
+    @tyre_rotation.setter
+    def tyre_rotation(self, value):
+        self.fleet.tyre_rotation[self.fleet_idx] = value
+
 class PlayerCar(Car):
     def __init__(self, pos, controls):
-        super().__init__(pos, 'a')
+        super().__init__(pos, PLAYER_CAR_LETTER)
         self.pos = pos
         self.controls = controls
         self.offset_x_change = 0
@@ -496,8 +1628,8 @@ class PlayerCar(Car):
         self.grass_sound_repeat_timer = 0
         self.on_grass = False
 
-        # Last known position in the race, indexed from 0 - used to decide when to play overtaking sounds
-        self.prev_position = NUM_CARS - 1
+        # Position in the race when the race finished, indexed from 0
+        self.final_position = None
 
     def stop_engine_sound(self):
         if self.current_engine_sound is not None:
@@ -507,8 +1639,12 @@ class PlayerCar(Car):
                 # Ignore errors - e.g. no sound hardware, or sound mixer has been shut down
                 pass
 
+    def race_over(self):
+        # In a two player race, each player's race is over once they've finished, even if the other player hasn't
+        return game.race_complete or self.final_position is not None
+
     def update(self, delta_time):
-        if not game.race_complete:
+        if not self.race_over():
             self.lap_time += delta_time
             self.race_time += delta_time
 
@@ -516,15 +1652,6 @@ class PlayerCar(Car):
 
         self.update_engine_sound()
 
-        # Play overtaking sounds? See if our position in the race has changed since last frame
-        current_position = game.cars.index(self)
-        if current_position != self.prev_position:
-            # Only play sound if speed difference is high enough
-            if abs(self.speed - game.cars[self.prev_position].speed) > 4:
-                game.play_sound("overtake",6)
-
-            self.prev_position = current_position
-
         if self.resetting:
             if self.explode_timer is not None:
                 self.explode_timer += 1
@@ -544,7 +1671,7 @@ class PlayerCar(Car):
             self.braking = False
 
             # Only get control inputs if race is not complete
-            if not game.race_complete:
+            if not self.race_over():
                 self.controls.update()
                 if self.controls.button_down(0):
                     accel = PLAYER_ACCELERATION_MAX if self.speed < HIGH_ACCEL_THRESHOLD else PLAYER_ACCELERATION_MIN
@@ -579,7 +1706,7 @@ class PlayerCar(Car):
                 # We don't multiply by delta_time here as offset_x_change is partly based on the total amount of forward
                 # motion that has taken place since the previous frame, which already takes delta_time into account
                 # We don't do this if the race is complete - just let car go around the corners with no steering needed
-                if not game.race_complete:
+                if not self.race_over():
                     self.pos.x -= self.offset_x_change * CORNER_OFFSET_MULTIPLIER
 
             else:
@@ -590,99 +1717,56 @@ class PlayerCar(Car):
             previous_track_piece_idx, _ = game.get_first_track_piece_ahead(self.pos.z)
 
             # Apply steering
-            if self.speed > 0 and not game.race_complete:
+            if self.speed > 0 and not self.race_over():
                 x_move = self.get_x_input() * self.speed * STEERING_STRENGTH * self.grip * delta_time
                 self.pos.x -= x_move
 
             # Call parent (Car) update method, which includes applying motion
             super().update(delta_time)
 
-            # Check for collisions with other cars
-            for car in game.cars:
-                if car is not self:
-                    # Note - axes are not uniform in scale (1 unit in X axis is much smaller than 1 unit in Z axis),
-                    # so we can't do a normal distance calculation.
-                    # Instead we just check X and Z differences separately (Y is irrelevant as cars are always
-                    # on the ground)
-                    vec = self.pos - car.pos
-                    COLLIDE_FRONT_DISTANCE_Z = 0.6
-                    COLLIDE_BACK_DISTANCE_Z = 1.2
-                    if abs(vec.x) < 260 and vec.z < COLLIDE_FRONT_DISTANCE_Z and vec.z > -COLLIDE_BACK_DISTANCE_Z:
-                        midpoint = (self.pos.z - car.pos.z) / 2 + car.pos.z
-                        # Which side did we collide on?
-                        # An alternative way to do this would be to use the speed difference, e.g. if player speed
-                        # is faster, we hit the car in front
-                        if abs(vec.z) < 0.2:
-                            # Side collision
-                            self.pos.x += sign(vec.x) * 50
-                            car.pos.x -= sign(vec.x) * 50
-
-                        elif vec.z > 0:
-                            # Colliding with the back of the car in front
-                            self.speed = max(car.speed - 3, 0)
-                            car.speed = max(car.speed, self.speed + 3)
-                            car.target_speed = car.speed
-
-                            # Shift us back and other car forward so we're not longer overlapping
-                            self.pos.z = midpoint + COLLIDE_FRONT_DISTANCE_Z * 0.6
-                            car.pos.z = midpoint - COLLIDE_FRONT_DISTANCE_Z * 0.6
-
-                            game.play_sound("bump", 6)
+            # Check for collisions with other cars. Collisions between CPU cars are dealt with separately by
+            # Game.update_car_collisions, once all cars have moved
+            game.update_player_car_collisions(self)
 
+            # Check for collisions with scenery, driving on grass and passing a checkpoint
+            track_piece_idx, _ = game.get_first_track_piece_ahead(self.pos.z)
+            if track_piece_idx is not None:
+                if game.track.in_scenery_collision_zone(track_piece_idx, self.pos.x):
+                    self.speed = 0
+                    self.resetting = True
+                    self.explode_timer = 0  # Start explosion animation
+                    game.play_sound("explosion")
+
+                # Are we on, or have we passed, a checkpoint? Rather than checking each track piece we've passed, we
+                # look up the first checkpoint at or after the track piece we were on before moving
+                i = game.track.get_next_checkpoint(previous_track_piece_idx)
+                while i is not None and i <= track_piece_idx:
+                    # It's a checkpoint. If it's the first one, ignore it (passing the start line at the start of
+                    # the race is not of interest). If we've already dealt with this checkpoint, ignore it.
+                    # Otherwise update lap count and lap time
+                    if self.last_checkpoint_idx is not None and self.last_checkpoint_idx != i:
+                        self.lap += 1
+
+                        # Was this the fastest lap?
+                        if self.fastest_lap is None or self.lap_time < self.fastest_lap:
+                            self.fastest_lap = self.lap_time
+                            self.last_lap_was_fastest = True
+                            game.play_sound("fastlap")
                         else:
-                            # Car behind collided with us - get a speed boost
-                            self.speed = max(self.speed, car.speed + 3)
-                            car.speed = max(self.speed - 3, 0)
+                            self.last_lap_was_fastest = False
 
-                            # Shift other car back and us forward so we're not longer overlapping
-                            self.pos.z = midpoint - COLLIDE_BACK_DISTANCE_Z * 0.6
-                            car.pos.z = midpoint + COLLIDE_BACK_DISTANCE_Z * 0.6
+                        # Play final lap sound effect?
+                        if self.lap == NUM_LAPS:
+                            game.play_sound("final_lap")
 
-                            game.play_sound("bump_behind")
+                        # Set lap time back to 0 for new lap
+                        self.lap_time = 0
 
-            # Check for collisions with scenery, driving on grass and passing a checkpoint
-            track_piece_idx, _ = game.get_first_track_piece_ahead(self.pos.z)
-            if track_piece_idx is not None:
-                track_piece = game.track[track_piece_idx]
-
-                for scenery in track_piece.scenery:
-                    for collision_zone in scenery.collision_zones:
-                        zone_left = scenery.x + collision_zone[0]
-                        zone_right = scenery.x + collision_zone[1]
-                        if zone_left < self.pos.x < zone_right:
-                            self.speed = 0
-                            self.resetting = True
-                            self.explode_timer = 0  # Start explosion animation
-                            game.play_sound("explosion")
-
-                # Are we on, or have we passed, a checkpoint?
-                for i in range(previous_track_piece_idx, track_piece_idx+1):
-                    if isinstance(game.track[i], TrackPieceStartLine):
-                        # It's a checkpoint. If it's the first one, ignore it (passing the start line at the start of
-                        # the race is not of interest). If we've already dealt with this checkpoint, ignore it.
-                        # Otherwise update lap count and lap time
-                        if self.last_checkpoint_idx is not None and self.last_checkpoint_idx != i:
-                            self.lap += 1
-
-                            # Was this the fastest lap?
-                            if self.fastest_lap is None or self.lap_time < self.fastest_lap:
-                                self.fastest_lap = self.lap_time
-                                self.last_lap_was_fastest = True
-                                game.play_sound("fastlap")
-                            else:
-                                self.last_lap_was_fastest = False
-
-                            # Play final lap sound effect?
-                            if self.lap == NUM_LAPS:
-                                game.play_sound("final_lap")
-
-                            # Set lap time back to 0 for new lap
-                            self.lap_time = 0
-
-                        self.last_checkpoint_idx = i
+                    self.last_checkpoint_idx = i
+                    i = game.track.get_next_checkpoint(i + 1)
 
                 # Are we on the grass?
-                if abs(self.pos.x) + 100 > track_piece.width / 2:
+                if abs(self.pos.x) + 100 > game.track.width[track_piece_idx % game.track.lap_length] / 2:
                     self.on_grass = True
                     if self.grass_sound_repeat_timer <= 0:
                         game.play_sound("hit_grass")
@@ -708,8 +1792,8 @@ class PlayerCar(Car):
 
                 # Scale volume based on track curvature - higher volume for tighter corners
                 if track_piece_idx is not None:
-                    track_piece = game.track[track_piece_idx]
-                    volume *= remap_clamp(abs(track_piece.offset_x), 0, 15, 0, 1)
+                    offset_x = game.track.offset_x[track_piece_idx % game.track.lap_length]
+                    volume *= remap_clamp(abs(offset_x), 0, 15, 0, 1)
 
             if volume > 0:
                 if not self.skid_sound_playing:
@@ -723,7 +1807,7 @@ class PlayerCar(Car):
 
         # Set sprite
         if self.explode_timer is not None:
-            self.image = f"explode{self.explode_timer//2:02}"
+            self.sprite = EXPLOSION_SPRITE_START + self.explode_timer // 2
         else:
             direction = 0
             if x_move < 0:
@@ -733,6 +1817,10 @@ class PlayerCar(Car):
             boost = accel > 0 and self.speed < HIGH_ACCEL_THRESHOLD and self.speed > 0
             self.update_sprite(direction, self.braking, boost)
 
+    def can_collide(self):
+        # No collisions with other cars while we're being reset after crashing or going off the track
+        return not self.resetting
+
     def update_engine_sound(self):
         sound_index = min(int(self.speed * 0.6), len(self.engine_sounds) - 1)
         if sound_index != self.current_engine_sound_idx:
@@ -756,114 +1844,950 @@ class PlayerCar(Car):
         self.offset_x_change = value
 
 
-def generate_scenery(track_i, image=images.billboard00, interval=40, lamps=True):
+# Time trial mode - the player races on their own against 'ghosts', which are replays of the fastest laps they've done.
+# While the player drives, LapRecorder samples the player car's position, speed and sprite once per update (updates
+# happen every FIXED_TIMESTEP seconds, see update). The samples go into a buffer which is created once, big enough for
+# the longest lap allowed, so recording doesn't need to create any new objects as the race goes on.
+# When a lap is completed, it's added to the list of fastest laps and saved to the ghost file. As the car moves
+# smoothly, each sample is very similar to the one before, so rather than storing the values themselves we store the
+# difference from the previous sample - this is called delta encoding. The values are first converted to whole numbers
+# of small units (e.g. 1/4096ths of a track piece), so the differences fit in 16 bit integers. A ghost file contains:
+#   A header - file ID, version number, the number of laps (fastest first) and the hash of the code which made the
+#   track the laps were driven on (see get_track_generator_hash). Laps driven on a different track can't be replayed
+#   For each lap, the number of samples and the first sample, followed by the differences between each sample and the
+#   one before it - first for all the Z positions, then the X positions, speeds, and finally the sprite handles
+# The Z positions are relative to the start line, so a lap can be replayed starting from any lap of the track.
+# A GhostCar replays a lap just by looking up the sample for the current update, which is much less work than a CPU
+# car making decisions about steering and speed, so we can show a ghost for every lap in the list.
+GHOST_FILE = "tracks/leadingedge.ghosts"
+GHOST_FILE_ID = b"LEGHOST\0"
+GHOST_FILE_VERSION = 2
+GHOST_HEADER_FORMAT = "<8sII16s"
+GHOST_HEADER_SIZE = struct.calcsize(GHOST_HEADER_FORMAT)
+GHOST_LAP_HEADER_FORMAT = "<Iiiii"      # Number of samples, then the first sample's Z, X, speed and sprite handle
+GHOST_LAP_HEADER_SIZE = struct.calcsize(GHOST_LAP_HEADER_FORMAT)
+GHOST_SAMPLE_FORMAT = "=fffH2x"         # Z, X, speed, sprite handle and 2 bytes of padding - 16 bytes per sample
+GHOST_UNITS = (4096, 8, 64, 1)          # Number of units per track piece (Z), X unit, speed unit and sprite handle
+GHOST_MAX_LAP_TIME = 60 * 4             # Laps which take longer than this aren't recorded
+GHOST_MAX_LAPS = 10                     # How many of the fastest laps to keep, and show as ghosts
+
+class LapRecorder:
+    def __init__(self, max_samples):
+        self.sample_struct = struct.Struct(GHOST_SAMPLE_FORMAT)
+        self.buffer = bytearray(max_samples * self.sample_struct.size)
+        self.max_samples = max_samples
+        self.num_samples = 0
+
+        # Z position of the start line at the beginning of the lap being recorded, or None if we're not recording
+        self.start_z = None
+
+    def start(self, start_z):
+        self.start_z = start_z
+        self.num_samples = 0
+
+    def stop(self):
+        self.start_z = None
+
+    def record(self, car):
+        if self.start_z is None:
+            return
+        if self.num_samples == self.max_samples:
+            # The lap has taken too long, so stop recording it
+            self.stop()
+            return
+        self.sample_struct.pack_into(self.buffer, self.num_samples * self.sample_struct.size,
+                                     car.pos.z - self.start_z, car.pos.x, car.speed, car.sprite)
+        self.num_samples += 1
+
+    def get_lap_data(self):
+        # Returns the lap recorded so far in the ghost file format, or None if there isn't one, or its values change
+        # too much from one sample to the next to be stored as 16 bit differences
+        if self.start_z is None or self.num_samples == 0:
+            return None
+
+        # Columns of the samples - see the notes on memoryview in the Track class
+        samples = memoryview(self.buffer)[:self.num_samples * self.sample_struct.size]
+        floats, shorts = samples.cast("f"), samples.cast("H")
+        columns = (floats[0::4], floats[1::4], floats[2::4], shorts[6::8])
+
+        first_values = []
+        deltas_data = bytearray()
+        for column, units in zip(columns, GHOST_UNITS):
+            values = [round(value * units) for value in column]
+            first_values.append(values[0])
+            try:
+                deltas = array("h", [b - a for a, b in zip(values, values[1:])])
+            except OverflowError:
+                return None
+            if sys.byteorder == "big":
+                deltas.byteswap()
+            deltas_data += deltas.tobytes()
+
+        return struct.pack(GHOST_LAP_HEADER_FORMAT, self.num_samples, *first_values) + deltas_data
+
+class GhostLap:
+    def __init__(self, data, offset=0):
+        # Reads a lap in the ghost file format, starting at offset in data, and turns it back into arrays of samples.
+        # The data for the lap is kept, so that it can be saved again without having to encode it again
+        num_samples, *first_values = struct.unpack_from(GHOST_LAP_HEADER_FORMAT, data, offset)
+        pos = offset + GHOST_LAP_HEADER_SIZE
+        if num_samples == 0 or pos + (num_samples - 1) * 2 * len(GHOST_UNITS) > len(data):
+            raise ValueError("Ghost lap data is missing or incomplete")
+        columns = []
+        for first_value, units, typecode in zip(first_values, GHOST_UNITS, "fffH"):
+            deltas = array("h", data[pos:pos + (num_samples - 1) * 2])
+            if sys.byteorder == "big":
+                deltas.byteswap()
+            pos += len(deltas) * 2
+            # Adding up the differences gives us back the values
+            values = accumulate(chain((first_value,), deltas))
+            columns.append(array(typecode, values if units == 1 else (value / units for value in values)))
+
+        self.z, self.x, self.speed, self.sprite = columns
+        self.data = bytes(data[offset:pos])
+        self.time = num_samples * FIXED_TIMESTEP
+
+    def __len__(self):
+        return len(self.z)
+
+class GhostCar(Car):
+    def __init__(self, ghost_lap):
+        super().__init__(Vector3(0, 0, 0), PLAYER_CAR_LETTER)
+        self.ghost_lap = ghost_lap
+        self.prev_pos = Vector3(self.pos)
+
+        # Z position of the start line at the beginning of the lap being replayed, or None if we're not replaying
+        self.start_z = None
+        self.sample_idx = 0
+
+    def start(self, start_z):
+        self.start_z = start_z
+        self.sample_idx = 0
+
+    def update(self, delta_time):
+        # Move to the next sample of the lap. Samples were recorded every FIXED_TIMESTEP seconds, which is also how
+        # often we're called, so delta_time isn't needed
+        if self.start_z is None:
+            return
+
+        lap = self.ghost_lap
+        i = self.sample_idx
+        if i == len(lap):
+            # The lap is finished - disappear until the player starts another lap
+            self.start_z = None
+            return
+
+        self.pos.z = self.start_z + lap.z[i]
+        self.pos.x = lap.x[i]
+        self.speed = lap.speed[i]
+        self.sprite = get_ghost_sprite(lap.sprite[i])
+        if i == 0:
+            # Don't interpolate from wherever we were before the lap started, see Game.draw
+            self.prev_pos = Vector3(self.pos)
+        self.sample_idx += 1
+
+    def is_visible(self):
+        # Ghosts are only shown while they're replaying a lap
+        return self.start_z is not None
+
+    def can_collide(self):
+        # Ghosts just pass through the player
+        return False
+
+def save_ghost_file(filename, laps):
+    data = bytearray(struct.pack(GHOST_HEADER_FORMAT, GHOST_FILE_ID, GHOST_FILE_VERSION, len(laps),
+                                 get_track_generator_hash()))
+    for lap in laps:
+        data += lap.data
+    with open(filename, "wb") as file:
+        file.write(data)
+
+def load_ghost_file(filename):
+    with open(filename, "rb") as file:
+        data = file.read()
+    file_id, version, num_laps, generator_hash = struct.unpack_from(GHOST_HEADER_FORMAT, data)
+    if file_id != GHOST_FILE_ID or version != GHOST_FILE_VERSION:
+        raise ValueError("Not a ghost file, or unsupported version")
+    if generator_hash != get_track_generator_hash():
+        raise ValueError("Ghost laps were recorded on a different track")
+    laps = []
+    offset = GHOST_HEADER_SIZE
+    for i in range(num_laps):
+        lap = GhostLap(data, offset)
+        laps.append(lap)
+        offset += len(lap.data)
+    return laps
+
+# The fastest laps, fastest first. This is None until the ghost file has been loaded by get_ghost_laps
+ghost_laps = None
+
+def get_ghost_laps():
+    global ghost_laps
+    if ghost_laps is None:
+        filename = os.path.join(pgzero.loaders.root, GHOST_FILE)
+        try:
+            ghost_laps = load_ghost_file(filename) if os.path.exists(filename) else []
+        except (OSError, ValueError, struct.error) as e:
+            # e.g. the file was only partly written, has been damaged, or was recorded on a different version of the
+            # track. Carry on without ghosts - the file will be replaced when the next lap fast enough to be a ghost is
+            # saved
+            print("Unable to load ghost file:", e)
+            ghost_laps = []
+    return ghost_laps
+
+def add_ghost_lap(lap):
+    # If the lap is one of the GHOST_MAX_LAPS fastest, add it to the list and save the ghost file
+    laps = get_ghost_laps()
+    idx = bisect_right([other.time for other in laps], lap.time)
+    if idx >= GHOST_MAX_LAPS:
+        return
+    laps.insert(idx, lap)
+    del laps[GHOST_MAX_LAPS:]
+    try:
+        save_ghost_file(os.path.join(pgzero.loaders.root, GHOST_FILE), laps)
+    except OSError as e:
+        # e.g. the game's folder is read-only. The lap will still be used as a ghost until the game is closed
+        print("Unable to save ghost file:", e)
+
+# Each track piece has a group of scenery objects, which is identified by a name - such as "lamps", or "billboards"
+# followed by the name of the billboard image. This means that the scenery can be stored in a track file (see Track),
+# and as scenery objects don't change once they've been created, track pieces with the same scenery can share the same
+# objects rather than each having their own copies. This dictionary stores the tuples of scenery objects which have
+# been created so far, so that they can be reused
+scenery_groups = {}
+
+def get_scenery_group(name):
+    # Returns a tuple of scenery objects for the given scenery group name
+    if name not in scenery_groups:
+        if name == "lamps":
+            scenery_groups[name] = (LampLeft(), LampRight())
+        elif name == "start gantry":
+            scenery_groups[name] = (StartGantry(),)
+        elif name.startswith("billboards "):
+            image = getattr(images, name.split()[1])
+            scenery_groups[name] = (Billboard(BILLBOARD_X, image), Billboard(-BILLBOARD_X, image))
+        else:
+            raise ValueError(f"Unknown scenery group: {name}")
+    return scenery_groups[name]
+
+def generate_scenery(track_i, image="billboard00", interval=40, lamps=True):
+    # Returns the name of the scenery group for a track piece, or None if there's no scenery
     if track_i % interval == 0:
-        # Billboards
-        return [Billboard(BILLBOARD_X, image), Billboard(-BILLBOARD_X, image)]
+        return "billboards " + image
     elif lamps and track_i % 30 == 0:
-        # Lamps
-        return [LampLeft(), LampRight()]
+        return "lamps"
     else:
-        return []
+        return None
 
-def make_track():
+def make_track_lap():
     # Each track piece in the list represents a line with a particular width, with optional attached scenery.
     # When the track is drawn, we draw a polygon for each track piece, connecting this line with the line of the
     # previous track piece.
+    # Every lap of the track is the same, so we only make the track pieces for one lap - see Track
     track = []
-    for lap in range(NUM_LAPS + 1):
-        track.extend([TrackPiece(scenery=generate_scenery(i,images.billboard02)) for i in range(15)])
+    track.extend([TrackPiece(scenery=generate_scenery(i, "billboard02")) for i in range(15)])
 
-        # Start gantry
-        track.append(TrackPieceStartLine())
+    # Start gantry
+    track.append(TrackPieceStartLine())
 
-        track.extend([TrackPiece() for i in range(SECTION_SHORT)])
+    track.extend([TrackPiece() for i in range(SECTION_SHORT)])
 
-        # Because the camera is pointing down the negative Z axis, negative/positive X mean right/left from
-        # camera's perspective
+    # Because the camera is pointing down the negative Z axis, negative/positive X mean right/left from
+    # camera's perspective
 
-        # Mild right turn followed by short straight
-        track.extend([TrackPiece(offset_x=-4, offset_y=0, scenery=generate_scenery(i)) for i in range(SECTION_MEDIUM)])
-        track.extend([TrackPiece(scenery=generate_scenery(i,images.billboard01)) for i in range(SECTION_SHORT)])
+    # Mild right turn followed by short straight
+    track.extend([TrackPiece(offset_x=-4, offset_y=0, scenery=generate_scenery(i)) for i in range(SECTION_MEDIUM)])
+    track.extend([TrackPiece(scenery=generate_scenery(i, "billboard01")) for i in range(SECTION_SHORT)])
 
-        # Slight downward slope, going into moderate right hand turn
-        track.extend([TrackPiece(offset_x=0, offset_y=-1, scenery=generate_scenery(i)) for i in range(SECTION_VERY_SHORT)])
-        track.extend([TrackPiece(offset_x=0, offset_y=-2, scenery=generate_scenery(i)) for i in range(SECTION_VERY_SHORT)])
-        track.extend([TrackPiece(offset_x=-2, offset_y=-1, scenery=generate_scenery(i)) for i in range(SECTION_VERY_SHORT)])
-        track.extend([TrackPiece(offset_x=-5, offset_y=0, scenery=generate_scenery(i,images.billboard03)) for i in range(SECTION_VERY_SHORT)])
-        track.extend([TrackPiece(offset_x=-10, offset_y=0, scenery=generate_scenery(i,images.billboard03)) for i in range(SECTION_MEDIUM)])
+    # Slight downward slope, going into moderate right hand turn
+    track.extend([TrackPiece(offset_x=0, offset_y=-1, scenery=generate_scenery(i)) for i in range(SECTION_VERY_SHORT)])
+    track.extend([TrackPiece(offset_x=0, offset_y=-2, scenery=generate_scenery(i)) for i in range(SECTION_VERY_SHORT)])
+    track.extend([TrackPiece(offset_x=-2, offset_y=-1, scenery=generate_scenery(i)) for i in range(SECTION_VERY_SHORT)])
+    track.extend([TrackPiece(offset_x=-5, offset_y=0, scenery=generate_scenery(i, "billboard03")) for i in range(SECTION_VERY_SHORT)])
+    track.extend([TrackPiece(offset_x=-10, offset_y=0, scenery=generate_scenery(i, "billboard03")) for i in range(SECTION_MEDIUM)])
 
-        # Short straight
-        track.extend([TrackPiece(scenery=generate_scenery(i)) for i in range(SECTION_SHORT)])
+    # Short straight
+    track.extend([TrackPiece(scenery=generate_scenery(i)) for i in range(SECTION_SHORT)])
 
-        # Medium-sharp turn left, slight upward slope
-        track.extend([TrackPiece(offset_x=13, offset_y=1, scenery=generate_scenery(i, images.arrow_left, interval=10)) for i in range(SECTION_MEDIUM)])
+    # Medium-sharp turn left, slight upward slope
+    track.extend([TrackPiece(offset_x=13, offset_y=1, scenery=generate_scenery(i, "arrow_left", interval=10)) for i in range(SECTION_MEDIUM)])
 
-        track.extend([TrackPiece(offset_x=0, offset_y=0, scenery=generate_scenery(i,images.billboard02)) for i in range(SECTION_MEDIUM)])
+    track.extend([TrackPiece(offset_x=0, offset_y=0, scenery=generate_scenery(i, "billboard02")) for i in range(SECTION_MEDIUM)])
 
-        # Small hill
-        track.extend([TrackPiece(offset_x=0, offset_y=2, scenery=generate_scenery(i,images.billboard02)) for i in range(SECTION_MEDIUM)])
+    # Small hill
+    track.extend([TrackPiece(offset_x=0, offset_y=2, scenery=generate_scenery(i, "billboard02")) for i in range(SECTION_MEDIUM)])
 
-        # Slightly down and to the right
-        track.extend([TrackPiece(offset_x=-3, offset_y=-1, scenery=generate_scenery(i,images.billboard01)) for i in range(SECTION_LONG)])
+    # Slightly down and to the right
+    track.extend([TrackPiece(offset_x=-3, offset_y=-1, scenery=generate_scenery(i, "billboard01")) for i in range(SECTION_LONG)])
 
-        # Crazy downward curve
-        track.extend([TrackPiece(offset_x=0, offset_y=-4, scenery=generate_scenery(i)) for i in range(SECTION_MEDIUM)])
+    # Crazy downward curve
+    track.extend([TrackPiece(offset_x=0, offset_y=-4, scenery=generate_scenery(i)) for i in range(SECTION_MEDIUM)])
 
-        # Upward slope
-        track.extend([TrackPiece(offset_x=0, offset_y=2, scenery=generate_scenery(i,images.billboard03)) for i in range(SECTION_LONG)])
+    # Upward slope
+    track.extend([TrackPiece(offset_x=0, offset_y=2, scenery=generate_scenery(i, "billboard03")) for i in range(SECTION_LONG)])
 
-        # Turn to left and up, gradually increasing curve
-        for j in range(1,10):
-            track.extend([TrackPiece(offset_x=j, offset_y=j, scenery=generate_scenery(i)) for i in range(SECTION_VERY_SHORT)])
+    # Turn to left and up, gradually increasing curve
+    for j in range(1,10):
+        track.extend([TrackPiece(offset_x=j, offset_y=j, scenery=generate_scenery(i)) for i in range(SECTION_VERY_SHORT)])
 
-        # Downward curve, increasing then decreasing in intensity
-        for j in range(1,10):
-            track.extend([TrackPiece(offset_x=0, offset_y=-j, scenery=generate_scenery(i)) for i in range(SECTION_VERY_SHORT)])
+    # Downward curve, increasing then decreasing in intensity
+    for j in range(1,10):
+        track.extend([TrackPiece(offset_x=0, offset_y=-j, scenery=generate_scenery(i)) for i in range(SECTION_VERY_SHORT)])
 
-        # straight with chevron billboards at end, CPU cars will slow down in this section
-        track.extend([TrackPiece(cpu_max_target_speed=60, scenery=[]) for i in range(SECTION_MEDIUM)])
-        track.extend([TrackPiece(cpu_max_target_speed=58, scenery=generate_scenery(i, images.arrow_right, interval=10, lamps=False)) for i in range(SECTION_SHORT)])
-        track.extend([TrackPiece(cpu_max_target_speed=58, scenery=generate_scenery(i, images.arrow_right, interval=10, lamps=False)) for i in range(SECTION_SHORT)])
+    # straight with chevron billboards at end, CPU cars will slow down in this section
+    track.extend([TrackPiece(cpu_max_target_speed=60) for i in range(SECTION_MEDIUM)])
+    track.extend([TrackPiece(cpu_max_target_speed=58, scenery=generate_scenery(i, "arrow_right", interval=10, lamps=False)) for i in range(SECTION_SHORT)])
+    track.extend([TrackPiece(cpu_max_target_speed=58, scenery=generate_scenery(i, "arrow_right", interval=10, lamps=False)) for i in range(SECTION_SHORT)])
 
-        # sharp turn right, easing off slightly at end
-        track.extend([TrackPiece(offset_x=-15, cpu_max_target_speed=55, scenery=generate_scenery(i, images.arrow_right, interval=10, lamps=False)) for i in range(SECTION_SHORT)])
-        track.extend([TrackPiece(offset_x=-13, cpu_max_target_speed=57, scenery=generate_scenery(i, images.arrow_right, interval=10, lamps=False)) for i in range(SECTION_SHORT)])
-        track.extend([TrackPiece(offset_x=-11, offset_y=0, scenery=generate_scenery(i)) for i in range(SECTION_SHORT)])
-        track.extend([TrackPiece(offset_x=-9, offset_y=0, scenery=generate_scenery(i)) for i in range(SECTION_SHORT)])
+    # sharp turn right, easing off slightly at end
+    track.extend([TrackPiece(offset_x=-15, cpu_max_target_speed=55, scenery=generate_scenery(i, "arrow_right", interval=10, lamps=False)) for i in range(SECTION_SHORT)])
+    track.extend([TrackPiece(offset_x=-13, cpu_max_target_speed=57, scenery=generate_scenery(i, "arrow_right", interval=10, lamps=False)) for i in range(SECTION_SHORT)])
+    track.extend([TrackPiece(offset_x=-11, offset_y=0, scenery=generate_scenery(i)) for i in range(SECTION_SHORT)])
+    track.extend([TrackPiece(offset_x=-9, offset_y=0, scenery=generate_scenery(i)) for i in range(SECTION_SHORT)])
 
-        # straight
-        track.extend([TrackPiece(offset_x=0, offset_y=0, scenery=generate_scenery(i)) for i in range(SECTION_MEDIUM)])
+    # straight
+    track.extend([TrackPiece(offset_x=0, offset_y=0, scenery=generate_scenery(i)) for i in range(SECTION_MEDIUM)])
 
-        # cosine hills
-        track.extend([TrackPiece(offset_y=math.cos(i/20) * 5, scenery=generate_scenery(i)) for i in range(SECTION_LONG)])
+    # cosine hills
+    track.extend([TrackPiece(offset_y=math.cos(i/20) * 5, scenery=generate_scenery(i)) for i in range(SECTION_LONG)])
 
-        # Mild upward slope - the purpose is to reset the Y scrolling of the background so it roughly matches the
-        # background position at the start of the lap
-        track.extend([TrackPiece(offset_x=0, offset_y=0.25, scenery=generate_scenery(i,images.billboard03)) for i in range(SECTION_LONG)])
+    # Mild upward slope - the purpose is to reset the Y scrolling of the background so it roughly matches the
+    # background position at the start of the lap
+    track.extend([TrackPiece(offset_x=0, offset_y=0.25, scenery=generate_scenery(i, "billboard03")) for i in range(SECTION_LONG)])
 
-        # short straight
-        track.extend([TrackPiece(offset_x=0, offset_y=0, scenery=generate_scenery(i,images.billboard03)) for i in range(SECTION_SHORT)])
+    # short straight
+    track.extend([TrackPiece(offset_x=0, offset_y=0, scenery=generate_scenery(i, "billboard03")) for i in range(SECTION_SHORT)])
 
     return track
 
-class Game:
-    def __init__(self, controls=None):
-        self.track = make_track()
+# The Track class holds the track, along with some information about the shape of the track which is worked out
+# when the track is made.
+# Every lap of the track is the same, so the track only stores one lap, and a track piece index from any lap is mapped
+# onto the corresponding piece of that lap using the % (modulo) operator. As the track doesn't change, one Track object
+# is shared by all games - see get_track.
+# When the track is drawn, the X and Y offsets of the track pieces accumulate twice over: each piece's offset is added
+# to a running 'offset delta', and the offset delta is added to a running 'offset' which gives the actual position of
+# the piece. Rather than adding these up for every track piece on every frame, we store running totals (known as
+# prefix sums) for one lap. As each lap adds the same amounts, the running totals for any piece on any lap can be
+# worked out from these, and the total of the offsets between any two track pieces can then be found with a
+# subtraction, however far apart the pieces are.
+#
+# Rather than keeping a TrackPiece object for each track piece, the track is stored in a compact binary format, which
+# is saved to a file the first time the game runs (see get_track). The format is:
+#   A header: TRACK_FILE_ID, format version, number of track pieces, size of the scenery group names (see below), and
+#   a hash of the code which made the track (see get_track_generator_hash)
+#   For each track piece, a record of TRACK_RECORD_FIELDS numbers, each stored as a double-precision floating point
+#   number (8 bytes). The fields are listed in TRACK_RECORD_FIELDS. The colour is stored as a single number in the form
+#   0xRRGGBB, CPU_MAX_TARGET_SPEED is NaN ('not a number') for pieces without a CPU car speed limit, and SCENERY is an
+#   index into the list of scenery group names, or -1 for no scenery
+#   The scenery group names, as text, separated by newlines
+# Because every record is the same size, the value of any field for any track piece can be found directly in the data,
+# with no need to read through it and convert it into objects first. When the track is loaded from a file, the file is
+# memory mapped - the operating system makes the contents of the file directly accessible as if they were in memory,
+# and only actually reads the parts that are used.
+# Python's memoryview lets us treat the data as a list of numbers, and taking every nth number from that gives us a
+# 'column' containing one field for all of the track pieces, still without copying any data
+TRACK_FILE_ID = b"LETRACK\0"
+TRACK_FILE_VERSION = 2
+TRACK_HEADER_FORMAT = "<8sIII4x16s"    # See the struct module documentation. 4x is 4 bytes of padding
+TRACK_HEADER_SIZE = struct.calcsize(TRACK_HEADER_FORMAT)
+TRACK_RECORD_FIELDS = ("OFFSET_X", "OFFSET_Y", "WIDTH", "COLOUR", "CPU_MAX_TARGET_SPEED", "SCENERY", "START_LINE",
+                       "CUMULATIVE_DELTA_X", "CUMULATIVE_DELTA_Y", "CUMULATIVE_OFFSET_X", "CUMULATIVE_OFFSET_Y")
+TRACK_RECORD_SIZE = len(TRACK_RECORD_FIELDS) * 8
+
+def get_track_generator_hash():
+    # The track is made by make_track_lap, using classes and constants which are all in this file. The track file
+    # header stores a hash of this file, so that when the code is changed, get_track knows to make the track file again
+    # rather than loading an out of date one
+    with open(__file__, "rb") as file:
+        return hashlib.blake2b(file.read(), digest_size=16).digest()
+
+def track_pieces_to_bytes(pieces):
+    # Converts a list of TrackPiece objects into the binary track format
+    scenery_names = sorted(set(piece.scenery for piece in pieces if piece.scenery is not None))
+    scenery_ids = {name: i for i, name in enumerate(scenery_names)}
+    scenery_data = "\n".join(scenery_names).encode("utf-8")
+
+    # Running totals, as described above
+    cumulative_delta_x = list(accumulate(piece.offset_x for piece in pieces))
+    cumulative_delta_y = list(accumulate(piece.offset_y for piece in pieces))
+    cumulative_offset_x = list(accumulate(cumulative_delta_x))
+    cumulative_offset_y = list(accumulate(cumulative_delta_y))
+
+    data = bytearray(struct.pack(TRACK_HEADER_FORMAT, TRACK_FILE_ID, TRACK_FILE_VERSION, len(pieces),
+                                 len(scenery_data), get_track_generator_hash()))
+    record_format = "<" + "d" * len(TRACK_RECORD_FIELDS)
+    for i, piece in enumerate(pieces):
+        r, g, b = piece.col
+        data += struct.pack(record_format, piece.offset_x, piece.offset_y, piece.width, (r << 16) | (g << 8) | b,
+                            math.nan if piece.cpu_max_target_speed is None else piece.cpu_max_target_speed,
+                            -1 if piece.scenery is None else scenery_ids[piece.scenery],
+                            1 if piece.start_line else 0,
+                            cumulative_delta_x[i], cumulative_delta_y[i],
+                            cumulative_offset_x[i], cumulative_offset_y[i])
+    data += scenery_data
+    return data
+
+def save_track_file(filename, data):
+    # Saves a track in the binary track format. The data is written to a temporary file which then replaces the track
+    # file, so that a game or race farm process loading the track at the same time never sees a partly written file
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    temp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(temp_filename, "wb") as file:
+        file.write(data)
+    os.replace(temp_filename, filename)
+
+def load_track_file(filename):
+    # Memory maps a track file, and returns an object which can be used to access its contents as if it were bytes.
+    # The file can be closed once it's been mapped
+    with open(filename, "rb") as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def is_current_track_file(data):
+    # Checks that track data has a header for this version of the format, and was made by this version of the code
+    if len(data) < TRACK_HEADER_SIZE:
+        return False
+    file_id, version, _, _, generator_hash = struct.unpack_from(TRACK_HEADER_FORMAT, data)
+    return file_id == TRACK_FILE_ID and version == TRACK_FILE_VERSION and generator_hash == get_track_generator_hash()
+
+class Track:
+    def __init__(self, data, num_laps):
+        # data is the track in the binary track format, either as bytes or a memory mapped file
+        self.data = data
+        file_id, version, num_pieces, scenery_data_size, _ = struct.unpack_from(TRACK_HEADER_FORMAT, data)
+        if file_id != TRACK_FILE_ID or version != TRACK_FILE_VERSION:
+            raise ValueError("Not a track file, or unsupported version")
+
+        self.lap_length = num_pieces
+        self.num_laps = num_laps
+
+        # Scenery group names are stored after the track piece records
+        scenery_start = TRACK_HEADER_SIZE + num_pieces * TRACK_RECORD_SIZE
+        scenery_data = bytes(data[scenery_start:scenery_start + scenery_data_size])
+        self.scenery_groups = [get_scenery_group(name) for name in scenery_data.decode("utf-8").split("\n") if name]
+
+        # Make a column for each field, e.g. self.offset_x[5] is the X offset of track piece 5 of the lap
+        num_fields = len(TRACK_RECORD_FIELDS)
+        records = memoryview(data)[TRACK_HEADER_SIZE:scenery_start].cast("d")
+        (self.offset_x, self.offset_y, self.width, self.colour, self.cpu_max_target_speed, self.scenery,
+         self.start_line, self.cumulative_delta_x, self.cumulative_delta_y, self.cumulative_offset_x,
+         self.cumulative_offset_y) = [records[field::num_fields] for field in range(num_fields)]
+
+        # Colours are converted to (red, green, blue) tuples when needed. There are only a few different colours, so
+        # we remember the tuples to save converting them again
+        self.colour_tuples = {}
+
+        if USE_NUMPY:
+            # NumPy versions of the columns we need for working with many track pieces at once. These are also views
+            # of the original data, rather than copies
+            np_records = numpy.frombuffer(data, dtype=float, count=num_pieces * num_fields,
+                                          offset=TRACK_HEADER_SIZE).reshape(num_pieces, num_fields)
+            (self.np_offset_x, _, self.np_width, _, _, _, _, self.np_cumulative_delta_x, self.np_cumulative_delta_y,
+             self.np_cumulative_offset_x, self.np_cumulative_offset_y) = np_records.T
+
+        # Lookup tables for the questions the cars ask about the track on every update, so that they can be answered
+        # straight away rather than by looking through track pieces and scenery objects.
+        # next_checkpoint gives, for each track piece of the lap, the index of the first start line piece at or after
+        # it. If that's on the next lap, the index is lap_length or more. It's None if there are no start lines
+        self.next_checkpoint = [None] * num_pieces
+        next_idx = None
+        for i in range(num_pieces * 2 - 1, -1, -1):
+            if self.start_line[i % num_pieces]:
+                next_idx = i
+            if i < num_pieces:
+                self.next_checkpoint[i] = next_idx
+
+        # For each scenery group, the collision zones of all of its objects, as X positions relative to the centre of
+        # the track. Overlapping zones are merged, and the zones are sorted from left to right. The left and right
+        # edges are stored in separate lists, so we can use bisection to find the only zone a position could be in
+        self.scenery_collision_zones = []
+        for scenery_group in self.scenery_groups:
+            zones = sorted((scenery.x + zone[0], scenery.x + zone[1])
+                           for scenery in scenery_group for zone in scenery.collision_zones)
+            lefts, rights = [], []
+            for left, right in zones:
+                # A car is only in a zone if it's strictly between the edges, so zones which just touch aren't merged
+                if rights and left < rights[-1]:
+                    rights[-1] = max(rights[-1], right)
+                else:
+                    lefts.append(left)
+                    rights.append(right)
+            self.scenery_collision_zones.append((lefts, rights))
+
+    # Allow a Track object to be used like a list of track pieces, e.g. track[5] or len(track). Each track piece is
+    # returned as a TrackPieceView object
+    def __len__(self):
+        return self.lap_length * self.num_laps
+
+    def __getitem__(self, idx):
+        return TrackPieceView(self, idx % self.lap_length)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield TrackPieceView(self, idx % self.lap_length)
+
+    def get_next_checkpoint(self, idx):
+        # Returns the index of the first start line at or after track piece idx
+        lap, i = divmod(idx, self.lap_length)
+        next_idx = self.next_checkpoint[i]
+        return None if next_idx is None else lap * self.lap_length + next_idx
+
+    def get_cpu_max_target_speed(self, idx):
+        # Returns the speed limit for CPU cars on track piece idx, or None if there isn't one
+        speed = self.cpu_max_target_speed[idx % self.lap_length]
+        return None if math.isnan(speed) else speed
+
+    def in_scenery_collision_zone(self, idx, x):
+        # Returns True if X position x is inside the collision zone of a piece of scenery on track piece idx
+        scenery_id = int(self.scenery[idx % self.lap_length])
+        if scenery_id < 0:
+            return False
+        lefts, rights = self.scenery_collision_zones[scenery_id]
+        zone_idx = bisect_right(lefts, x) - 1
+        return zone_idx >= 0 and lefts[zone_idx] < x < rights[zone_idx]
+
+    def get_colour(self, lap_idx):
+        colour = self.colour[lap_idx]
+        if colour not in self.colour_tuples:
+            colour_int = int(colour)
+            self.colour_tuples[colour] = ((colour_int >> 16) & 255, (colour_int >> 8) & 255, colour_int & 255)
+        return self.colour_tuples[colour]
+
+    def get_cumulative(self, idx):
+        # Returns the running totals of the X and Y offset deltas and offsets at track piece idx, on any lap.
+        # On each full lap, the offset delta goes up by the lap's total offset, and the offset goes up by the lap's
+        # total offset delta - plus the offset delta from all the earlier laps, for each piece of the lap
+        lap, i = divmod(idx, self.lap_length)
+        lap_delta_x, lap_delta_y = self.cumulative_delta_x[-1], self.cumulative_delta_y[-1]
+        earlier_laps = lap * (lap - 1) // 2 * self.lap_length + lap * (i + 1)
+        return (lap * lap_delta_x + self.cumulative_delta_x[i],
+                lap * lap_delta_y + self.cumulative_delta_y[i],
+                lap * self.cumulative_offset_x[-1] + earlier_laps * lap_delta_x + self.cumulative_offset_x[i],
+                lap * self.cumulative_offset_y[-1] + earlier_laps * lap_delta_y + self.cumulative_offset_y[i])
+
+    def get_np_cumulative(self, first_idx, end_idx):
+        # NumPy version of get_cumulative, for the range of track pieces from first_idx up to but not including
+        # end_idx. Also returns the indices of those pieces within the lap
+        lap, i = numpy.divmod(numpy.arange(first_idx, end_idx), self.lap_length)
+        lap_delta_x, lap_delta_y = self.cumulative_delta_x[-1], self.cumulative_delta_y[-1]
+        earlier_laps = lap * (lap - 1) // 2 * self.lap_length + lap * (i + 1)
+        return (lap * lap_delta_x + self.np_cumulative_delta_x[i],
+                lap * lap_delta_y + self.np_cumulative_delta_y[i],
+                lap * self.cumulative_offset_x[-1] + earlier_laps * lap_delta_x + self.np_cumulative_offset_x[i],
+                lap * self.cumulative_offset_y[-1] + earlier_laps * lap_delta_y + self.np_cumulative_offset_y[i],
+                i)
+
+    def get_offset_change(self, first_idx, last_idx):
+        # Returns the total X and Y offsets of the track pieces from first_idx to last_idx inclusive, or zero if
+        # first_idx is after last_idx
+        if first_idx > last_idx:
+            return 0, 0
+        last_delta_x, last_delta_y, _, _ = self.get_cumulative(last_idx)
+        if first_idx <= 0:
+            return last_delta_x, last_delta_y
+        before_delta_x, before_delta_y, _, _ = self.get_cumulative(first_idx - 1)
+        return last_delta_x - before_delta_x, last_delta_y - before_delta_y
+
+    def get_relative_offset(self, base_idx, base_fraction, idx):
+        # Returns the accumulated X and Y offsets and offset deltas for track piece idx, as seen from track piece
+        # base_idx, where only base_fraction of the offsets of base_idx itself have been applied. This gives the same
+        # results as starting at base_idx and adding up the offsets one piece at a time, as Game.draw used to do.
+        base_lap_idx = base_idx % self.lap_length
+        base_x = self.offset_x[base_lap_idx] * base_fraction
+        base_y = self.offset_y[base_lap_idx] * base_fraction
+        pieces_after_base = idx - base_idx
+        base_delta_x, base_delta_y, base_offset_x, base_offset_y = self.get_cumulative(base_idx)
+        cumulative_delta_x, cumulative_delta_y, cumulative_offset_x, cumulative_offset_y = self.get_cumulative(idx)
+        delta_x = base_x + cumulative_delta_x - base_delta_x
+        delta_y = base_y + cumulative_delta_y - base_delta_y
+        offset_x = (base_x * (pieces_after_base + 1) + cumulative_offset_x - base_offset_x
+                    - base_delta_x * pieces_after_base)
+        offset_y = (base_y * (pieces_after_base + 1) + cumulative_offset_y - base_offset_y
+                    - base_delta_y * pieces_after_base)
+        return offset_x, offset_y, delta_x, delta_y
+
+# A TrackPieceView gives access to the values for one track piece of a Track, with the same attribute names as the
+# TrackPiece class which was used to define it. The values aren't copied - they're looked up in the track's data
+# when they're needed
+class TrackPieceView:
+    # __slots__ tells Python that objects of this class will only ever have these attributes, which means they can
+    # be created more quickly and use less memory
+    __slots__ = ("track", "lap_idx")
+
+    def __init__(self, track, lap_idx):
+        self.track = track
+        self.lap_idx = lap_idx
+
+    @property
+    def offset_x(self):
+        return self.track.offset_x[self.lap_idx]
+
+    @property
+    def offset_y(self):
+        return self.track.offset_y[self.lap_idx]
+
+    @property
+    def width(self):
+        return self.track.width[self.lap_idx]
+
+    @property
+    def col(self):
+        return self.track.get_colour(self.lap_idx)
+
+    @property
+    def cpu_max_target_speed(self):
+        speed = self.track.cpu_max_target_speed[self.lap_idx]
+        return None if math.isnan(speed) else speed
+
+    @property
+    def scenery(self):
+        scenery_id = int(self.track.scenery[self.lap_idx])
+        return self.track.scenery_groups[scenery_id] if scenery_id >= 0 else ()
+
+    @property
+    def start_line(self):
+        return self.track.start_line[self.lap_idx] != 0
+
+# Tracks are stored in this dictionary by number of laps, so they only need to be loaded or made once (NUM_LAPS may
+# be changed by the race farm)
+tracks = {}
+
+def get_track():
+    # The track file is loaded if it exists and is up to date. Otherwise, the track is made from the definition in
+    # make_track_lap and saved to the track file, so that next time it can just be loaded
+    num_laps = NUM_LAPS + 1
+    if num_laps not in tracks:
+        filename = os.path.join(pgzero.loaders.root, TRACK_FILE)
+        try:
+            data = load_track_file(filename)
+        except (OSError, ValueError):
+            # The file doesn't exist, or is empty (mmap can't map an empty file)
+            data = None
+        if data is None or not is_current_track_file(data):
+            if data is not None:
+                data.close()
+            data = track_pieces_to_bytes(make_track_lap())
+            try:
+                save_track_file(filename, data)
+            except OSError as e:
+                # The game can still run if the file can't be saved, e.g. if the game folder is read-only
+                print("Couldn't save track file:", e)
+        tracks[num_laps] = Track(data, num_laps)
+    return tracks[num_laps]
+
+# TrackProjection transforms the edges of a range of track pieces into screen space, for a given camera position.
+# Rather than transforming each point separately as it's needed, all the points for all the visible track pieces are
+# done together, so that NumPy (if it's available) can process them as whole arrays. The results are stored as lists,
+# with one entry per track piece. All of the points on a track piece have the same Y and Z positions, so they all
+# end up with the same screen Y position - so for each track piece we store one screen Y position, and a screen X
+# position for each of the points along the track piece (left and right edges, central stripe, rumble strips and
+# yellow lines)
+# When using NumPy, a TrackProjection can be given a TrackRange, which holds the parts of the calculation which don't
+# depend on the camera for a range of track pieces. In split screen mode, Game.draw makes one TrackRange covering the
+# track pieces which can be seen from either player's camera, and each view's TrackProjection takes the part it needs
+class TrackProjection:
+    def __init__(self, track, camera, first_idx, end_idx, first_piece_z, first_piece_fraction, track_range=None):
+        if USE_NUMPY:
+            if track_range is None or not track_range.contains(first_idx, end_idx):
+                track_range = TrackRange(track, first_idx, end_idx)
+            self.project_numpy(track, camera, first_idx, end_idx, first_piece_z, first_piece_fraction, track_range)
+        else:
+            self.project_python(track, camera, first_idx, end_idx, first_piece_z, first_piece_fraction)
+
+    def project_numpy(self, track, camera, first_idx, end_idx, first_piece_z, first_piece_fraction, track_range):
+        # Numbers of pieces after the first piece, e.g. 0, 1, 2, 3...
+        ahead = numpy.arange(end_idx - first_idx)
+
+        # Work out offsets in the same way as Track.get_relative_offset, but for all track pieces at once
+        base_x = track[first_idx].offset_x * first_piece_fraction
+        base_y = track[first_idx].offset_y * first_piece_fraction
+        cumulative_delta_x, cumulative_delta_y, cumulative_offset_x, cumulative_offset_y, width = \
+            track_range.get(first_idx, end_idx)
+        offset_x = (base_x * (ahead + 1) + cumulative_offset_x - cumulative_offset_x[0]
+                    - cumulative_delta_x[0] * ahead)
+        offset_y = (base_y * (ahead + 1) + cumulative_offset_y - cumulative_offset_y[0]
+                    - cumulative_delta_y[0] * ahead)
+        offset_delta_x = base_x + cumulative_delta_x - cumulative_delta_x[0]
+        offset_delta_y = base_y + cumulative_delta_y - cumulative_delta_y[0]
+        piece_z = first_piece_z - ahead * SPACING
+
+        # Position of each track piece relative to the camera. Points which are not in front of the clipping plane
+        # won't be drawn
+        relative_y = offset_y - camera.y
+        relative_z = piece_z - camera.z
+        visible = relative_z <= CLIPPING_PLANE
 
-        # We only create a player car (in setup_cars) when there is a controls object
-        self.player_car = None
-        self.camera_follow_car = None
+        # Because the camera is pointing down the negative Z axis, negative/positive X mean right/left from
+        # camera's perspective
+        left = width / 2 + offset_x
+        right = -width / 2 + offset_x
+        relative_edges_x = numpy.array((left, right,
+                                        HALF_STRIPE_W + offset_x, -HALF_STRIPE_W + offset_x,
+                                        left + HALF_RUMBLE_STRIP_W, right - HALF_RUMBLE_STRIP_W,
+                                        left - YELLOW_LINE_DISTANCE_FROM_EDGE,
+                                        left - YELLOW_LINE_DISTANCE_FROM_EDGE - HALF_YELLOW_LINE_W,
+                                        right + YELLOW_LINE_DISTANCE_FROM_EDGE,
+                                        right + YELLOW_LINE_DISTANCE_FROM_EDGE + HALF_YELLOW_LINE_W)) - camera.x
+
+        # Apply perspective and centre on the screen. A track piece exactly level with the camera would cause a
+        # division by zero, but such a piece is behind the clipping plane so won't be drawn - so we tell NumPy not to
+        # warn us about it
+        # Dividing by a larger Z makes everything smaller, so we apply PROJECTION_SCALE by dividing Z by it
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            projected_z = relative_z / PROJECTION_SCALE
+            screen_y = relative_y / projected_z + HALF_HEIGHT
+            screen_x = relative_edges_x / projected_z + HALF_WIDTH
+
+        # Convert results back to ordinary Python lists, which are quicker to access one item at a time
+        visible = visible.tolist()
+        self.store_results(visible, piece_z.tolist(), offset_x.tolist(), offset_y.tolist(),
+                           offset_delta_x.tolist(), offset_delta_y.tolist(), screen_y.tolist(), screen_x.tolist())
+        self.clip_near_plane(visible, relative_z.tolist(), relative_y.tolist(), relative_edges_x.tolist())
+
+    def project_python(self, track, camera, first_idx, end_idx, first_piece_z, first_piece_fraction):
+        # Same as project_numpy, but working through the track pieces one at a time
+        visible, piece_z, offsets_x, offsets_y, offset_deltas_x, offset_deltas_y, screen_y = [], [], [], [], [], [], []
+        screen_x = [[] for _ in range(10)]
+        relative_zs, relative_ys = [], []
+        relative_edges_x = [[] for _ in range(10)]
+        for i in range(first_idx, end_idx):
+            z = first_piece_z - (i - first_idx) * SPACING
+            offset_x, offset_y, offset_delta_x, offset_delta_y = \
+                track.get_relative_offset(first_idx, first_piece_fraction, i)
+            piece_z.append(z)
+            offsets_x.append(offset_x)
+            offsets_y.append(offset_y)
+            offset_deltas_x.append(offset_delta_x)
+            offset_deltas_y.append(offset_delta_y)
+
+            relative_z = z - camera.z
+            relative_y = offset_y - camera.y
+            visible.append(relative_z <= CLIPPING_PLANE)
+            relative_zs.append(relative_z)
+            relative_ys.append(relative_y)
+            if relative_z == 0:
+                # Behind the clipping plane anyway, avoid division by zero
+                relative_z = -1
+
+            left = track[i].width / 2 + offset_x
+            right = -track[i].width / 2 + offset_x
+            edges_x = (left, right,
+                       HALF_STRIPE_W + offset_x, -HALF_STRIPE_W + offset_x,
+                       left + HALF_RUMBLE_STRIP_W, right - HALF_RUMBLE_STRIP_W,
+                       left - YELLOW_LINE_DISTANCE_FROM_EDGE, left - YELLOW_LINE_DISTANCE_FROM_EDGE - HALF_YELLOW_LINE_W,
+                       right + YELLOW_LINE_DISTANCE_FROM_EDGE, right + YELLOW_LINE_DISTANCE_FROM_EDGE + HALF_YELLOW_LINE_W)
+
+            projected_z = relative_z / PROJECTION_SCALE
+            screen_y.append(relative_y / projected_z + HALF_HEIGHT)
+            for edge, edge_x in enumerate(edges_x):
+                relative_edges_x[edge].append(edge_x - camera.x)
+                screen_x[edge].append((edge_x - camera.x) / projected_z + HALF_WIDTH)
+
+        self.store_results(visible, piece_z, offsets_x, offsets_y, offset_deltas_x, offset_deltas_y, screen_y, screen_x)
+        self.clip_near_plane(visible, relative_zs, relative_ys, relative_edges_x)
+
+    def store_results(self, visible, piece_z, offset_x, offset_y, offset_delta_x, offset_delta_y, screen_y, screen_x):
+        self.visible = visible
+        self.piece_z = piece_z
+        self.offset_x = offset_x
+        self.offset_y = offset_y
+        self.offset_delta_x = offset_delta_x
+        self.offset_delta_y = offset_delta_y
+        self.screen_y = screen_y
+        self.screen_x = screen_x
+        (self.left_x, self.right_x,
+         self.stripe_left_x, self.stripe_right_x,
+         self.rumble_left_outer_x, self.rumble_right_outer_x,
+         self.yellow_line_left_outer_x, self.yellow_line_left_inner_x,
+         self.yellow_line_right_outer_x, self.yellow_line_right_inner_x) = screen_x
+
+    def clip_near_plane(self, visible, relative_z, relative_y, relative_edges_x):
+        # Track pieces closer to the camera than CLIPPING_PLANE aren't drawn, as they would be enormous (or behind the
+        # camera). But the polygons joining the first visible piece to the one before it would also be missing, leaving
+        # a gap just in front of the camera, which can be seen when the track rises towards the camera. So we clip
+        # those polygons against the clipping plane: we find where the track crosses the plane, by interpolating
+        # between the track pieces either side of it, and project that. The first visible piece's polygons are joined
+        # to this row, which is stored in near_screen_y and near_screen_x (in the same order as screen_x), along with
+        # the index of the first visible piece.
+        # If even the first piece is visible, the plane is between it and the piece behind the camera, which isn't in
+        # the projection, so we extend the line from the second piece to the first instead
+        self.first_visible = visible.index(True) if True in visible else len(visible)
+        self.near_screen_y = self.near_screen_x = None
+        if self.first_visible == len(visible) or len(visible) < 2:
+            return
+
+        a, b = (self.first_visible - 1, self.first_visible) if self.first_visible > 0 else (0, 1)
+        fraction = (CLIPPING_PLANE - relative_z[a]) / (relative_z[b] - relative_z[a])
+        projected_z = CLIPPING_PLANE / PROJECTION_SCALE
+        self.near_screen_y = (relative_y[a] + (relative_y[b] - relative_y[a]) * fraction) / projected_z + HALF_HEIGHT
+        self.near_screen_x = [(xs[a] + (xs[b] - xs[a]) * fraction) / projected_z + HALF_WIDTH
+                              for xs in relative_edges_x]
+
+class TrackRange:
+    def __init__(self, track, first_idx, end_idx):
+        # Running totals of the track offsets (see Track) and widths of the track pieces from first_idx up to but not
+        # including end_idx, as NumPy arrays
+        self.first_idx = first_idx
+        self.end_idx = end_idx
+        (self.cumulative_delta_x, self.cumulative_delta_y, self.cumulative_offset_x, self.cumulative_offset_y,
+         lap_idx) = track.get_np_cumulative(first_idx, end_idx)
+        self.width = track.np_width[lap_idx]
+
+    def contains(self, first_idx, end_idx):
+        return self.first_idx <= first_idx and end_idx <= self.end_idx
+
+    def get(self, first_idx, end_idx):
+        # Returns the values for a range of track pieces within this range. Slicing a NumPy array gives a view of
+        # the same data rather than a copy, so this is very quick
+        start, end = first_idx - self.first_idx, end_idx - self.first_idx
+        return (self.cumulative_delta_x[start:end], self.cumulative_delta_y[start:end],
+                self.cumulative_offset_x[start:end], self.cumulative_offset_y[start:end], self.width[start:end])
+
+# RaceOrder keeps a list of cars sorted by Z position, which is also their order in the race - the car with the lowest
+# Z position is in the lead. Rather than sorting the whole list every update, it does an insertion sort, where each
+# car is moved forward past any cars which are now behind it. Cars very rarely change more than one place in a single
+# update, so the list is almost always sorted already and this takes very little time. Each car's race_position
+# attribute is updated as it moves, so it's always possible to find out a car's position without searching the list.
+# Each time a car moves past another, the pair of cars is recorded as an overtake
+class RaceOrder:
+    def __init__(self, cars, cpu_car_fleet=None):
+        # The list is fully sorted to begin with, as the cars are not created in race order
+        self.cars = sorted(cars, key=lambda car: car.pos.z)
+        for i, car in enumerate(self.cars):
+            car.race_position = i
+
+        # The Z positions of the cars, in the same order as self.cars, as they were when the list was last sorted
+        self.z_keys = [car.pos.z for car in self.cars]
+
+        # If there's a CPU car fleet, the Z positions of its cars are fetched from its array all at once, which is much
+        # quicker than asking each car in turn. The other cars (the players) are asked as usual - see update
+        self.cpu_car_fleet = cpu_car_fleet
+        if cpu_car_fleet is not None:
+            self.other_cars = [car for car in cars if not isinstance(car, FleetCPUCar)]
+            self.update_z_indices()
+
+    def update_z_indices(self):
+        # For each car in race order, the position of its Z position in the list made by update: the fleet's cars'
+        # positions in fleet order, followed by those of the other cars
+        other_car_indices = {car: i for i, car in enumerate(self.other_cars, len(self.cpu_car_fleet.cars))}
+        self.z_indices = [car.fleet_idx if isinstance(car, FleetCPUCar) else other_car_indices[car]
+                          for car in self.cars]
 
-        self.setup_cars(controls)
+    def update(self):
+        # Re-sort the list after cars have moved, and return a list of (overtaking car, overtaken car) tuples
+        overtakes = []
+        cars = self.cars
+
+        # Each car's Z position is only looked up once. The Z positions are sorted along with the cars, and kept for
+        # Game.get_cars_in_z_range
+        if self.cpu_car_fleet is None:
+            z_keys = [car.pos.z for car in cars]
+        else:
+            z_positions = self.cpu_car_fleet.pos_z.tolist() + [car.pos.z for car in self.other_cars]
+            z_keys = [z_positions[i] for i in self.z_indices]
+        for i in range(1, len(cars)):
+            z = z_keys[i]
+            if z_keys[i - 1] <= z:
+                # Still behind the car in front, which is by far the most common case
+                continue
+            car = cars[i]
+            j = i
+            while j > 0 and z_keys[j - 1] > z:
+                # The car in front of this one is now behind it, so move that car back one place
+                overtaken_car = cars[j - 1]
+                cars[j] = overtaken_car
+                z_keys[j] = z_keys[j - 1]
+                overtaken_car.race_position = j
+                overtakes.append((car, overtaken_car))
+                j -= 1
+            cars[j] = car
+            z_keys[j] = z
+            car.race_position = j
+        self.z_keys = z_keys
+        if overtakes and self.cpu_car_fleet is not None:
+            self.update_z_indices()
+        return overtakes
+
+# Each player has a View, which is their camera and background position, and the area of the window (the viewport)
+# that their view of the race is drawn to. Normally there's only one view, which uses the whole window. In a two
+# player game, each player gets half of the window. On the title screen, the camera follows one of the CPU cars
+class View:
+    def __init__(self, follow_car, rect, background):
+        self.follow_car = follow_car
+
+        # rect is a pygame.Rect giving the area of the window to draw to, or None for the whole window. A viewport
+        # which is less than the full height of the window shows the view which the whole window would show, scaled
+        # down to fit - which also means it sees further to the sides
+        self.rect = rect
+        height = HEIGHT if rect is None else rect.height
+        self.projection_scale = height / HEIGHT
 
         self.camera = Vector3(0, 400, 0)
 
+        # The background is positioned for a full height view. In a shorter viewport, the horizon is higher up, so the
+        # background needs to move up to match it
+        self.bg_offset = Vector2(-background.get_width() // 2, 30 - (HEIGHT - height) // 2)
+
+        # Camera and background positions from before the most recent update, for INTERPOLATE_RENDERING. These
+        # are None until the first update
+        self.prev_camera = None
+        self.prev_bg_offset = None
+
+def set_screen(new_screen, projection_scale=1):
+    # Changes the screen size settings to match a Pygame Zero Screen object, and makes it the screen that everything
+    # is drawn to
+    global WIDTH, HEIGHT, HALF_WIDTH, HALF_HEIGHT, MAX_SCENERY_SCALED_WIDTH, MAX_CAR_SCALED_WIDTH, PROJECTION_SCALE
+    global screen
+    screen = new_screen
+    PROJECTION_SCALE = projection_scale
+    WIDTH, HEIGHT = screen.surface.get_size()
+    HALF_WIDTH, HALF_HEIGHT = WIDTH // 2, HEIGHT // 2
+    MAX_SCENERY_SCALED_WIDTH = WIDTH * 2
+    MAX_CAR_SCALED_WIDTH = WIDTH * 1
+
+class Game:
+    def __init__(self, controls=None, time_trial=False, player2_controls=None):
+        self.track = get_track()
+
+        # In time trial mode there are no CPU cars - instead there are ghosts of the player's fastest laps
+        self.time_trial = time_trial
+        self.ghosts = []
+        self.lap_recorder = LapRecorder(round(GHOST_MAX_LAP_TIME / FIXED_TIMESTEP)) if time_trial else None
+        self.lap_start_checkpoint_idx = None
+
+        # We only create player cars (in setup_cars) when there are controls objects. player_car is the first
+        # player's car, and player_cars is a list of all of the players' cars
+        self.player_car = None
+        self.player_cars = []
+
+        follow_cars = self.setup_cars(controls, player2_controls)
+
+        # Give each player a view of the race, one above the other - or on the title screen, a single view
+        # following a CPU car. self.view is the view which is currently being updated or drawn
         self.background = images.background
-        self.bg_offset = Vector2(-self.background.get_width() // 2, 30)
+        if len(follow_cars) == 1:
+            rects = [None]
+        else:
+            rects = [pygame.Rect(0, 0, WIDTH, HEIGHT // 2), pygame.Rect(0, HEIGHT // 2, WIDTH, HEIGHT - HEIGHT // 2)]
+        self.views = [View(car, rect, self.background) for car, rect in zip(follow_cars, rects)]
+        self.view = self.views[0]
+
+        # In split screen mode, a TrackRange which is shared by the views while they're being drawn, see Game.draw
+        self.track_range = None
+
+        # While a view is being drawn, how far the cars are drawn between their positions before the last update and
+        # their current positions, see draw_view
+        self.draw_alpha = 1
 
         self.first_frame = True
+
         self.on_screen_debug_strs = []
+        # Draw commands are stored in one of two buffers, which are reused every frame. When RENDER_THREAD is
+        # enabled, pending_draw_commands is the buffer which was filled during the previous frame and is waiting to
+        # be drawn
+        self.draw_command_buffers = (DrawCommandBuffer(), DrawCommandBuffer())
+        self.pending_draw_commands = None
+        self.overtakes = []
         self.frame_counter = 0
         self.timer = 0
         self.race_complete = False
@@ -876,35 +2800,164 @@ class Game:
             # Race starts immediately on title screen
             self.start_timer = 0
 
-    def setup_cars(self, controls):
+    def setup_cars(self, controls, player2_controls=None):
+        # The title screen demo race can optionally have many more cars than a normal race
+        if MASS_START_DEMO and controls is None:
+            num_cars, lanes = MASS_START_NUM_CARS, MASS_START_GRID_LANES
+        elif self.time_trial:
+            num_cars, lanes = 1, 1
+        else:
+            num_cars, lanes = NUM_CARS, GRID_LANES
+
+        # The CPU cars' values are stored in the fleet's arrays, so the fleet has to be created before the cars
+        if USE_CPU_CAR_FLEET and USE_NUMPY and not self.time_trial:
+            num_players = sum(1 for player_controls in (controls, player2_controls) if player_controls is not None)
+            self.cpu_car_fleet = CPUCarFleet(num_cars - num_players)
+        else:
+            self.cpu_car_fleet = None
+
         self.cars = []  # Will be kept in sorted order of position
-        for i in range(NUM_CARS):
-            z = -3 - i * GRID_CAR_SPACING
-            x = -400 if i % 2 == 0 else 400
+        for i in range(num_cars):
+            # Cars are staggered, so that each car is a bit further forward than the one before it
+            z = -3 - i * GRID_CAR_SPACING * 2 / lanes
+            x = (i % lanes - (lanes - 1) / 2) * GRID_LANE_SPACING
             if i == 0 and controls is not None:
                 # Don't create player car on title screen
                 self.player_car = PlayerCar(Vector3(x, 0, z), controls)
+                self.player_cars.append(self.player_car)
                 self.cars.append(self.player_car)
+            elif i == 1 and player2_controls is not None:
+                # The second player starts alongside the first
+                self.player_cars.append(PlayerCar(Vector3(x, 0, z), player2_controls))
+                self.cars.append(self.player_cars[-1])
             else:
-                target_speed = remap(i, 0, NUM_CARS - 1, CPU_CAR_MIN_TARGET_SPEED, CPU_CAR_MAX_TARGET_SPEED)
-                accel = remap(i, 0, NUM_CARS - 1, 1.5, 2)
-                self.cars.append(CPUCar(Vector3(x, 0, z), speed=target_speed, accel=accel))
-
-        if self.player_car is not None:
-            self.camera_follow_car = self.player_car
-        else:
-            self.camera_follow_car = self.cars[0]
+                target_speed = remap(i, 0, num_cars - 1, CPU_CAR_MIN_TARGET_SPEED, CPU_CAR_MAX_TARGET_SPEED)
+                accel = remap(i, 0, num_cars - 1, 1.5, 2)
+                if self.cpu_car_fleet is not None:
+                    self.cars.append(self.cpu_car_fleet.add_car(Vector3(x, 0, z), speed=target_speed, accel=accel))
+                else:
+                    self.cars.append(CPUCar(Vector3(x, 0, z), speed=target_speed, accel=accel))
+
+        # Returns the cars for the cameras to follow - the player cars, or on the title screen, the first car to be
+        # created
+        follow_cars = self.player_cars if self.player_cars else [self.cars[0]]
+
+        # From now on, self.cars is kept in race order by self.race_order
+        self.race_order = RaceOrder(self.cars, self.cpu_car_fleet)
+        self.cars = self.race_order.cars
+        self.car_z_keys = self.race_order.z_keys
+        return follow_cars
+
+    def setup_ghosts(self, start_z):
+        # Replace the ghosts with new ones for the current list of fastest laps, all starting a lap from start_z.
+        # Ghosts aren't in self.cars, as they don't take part in the race - see get_cars_on_track_pieces for how they
+        # get drawn
+        self.ghosts = [GhostCar(lap) for lap in get_ghost_laps()]
+        for ghost in self.ghosts:
+            ghost.start(start_z)
+
+    def update_time_trial(self, delta_time):
+        # Each time the player crosses the start line, the lap they've just done is added to the fastest laps (if it's
+        # fast enough), and we start recording a new lap and replaying the ghosts from the start line
+        player = self.player_car
+        if player.last_checkpoint_idx != self.lap_start_checkpoint_idx:
+            self.lap_start_checkpoint_idx = player.last_checkpoint_idx
+            lap_data = self.lap_recorder.get_lap_data()
+            if lap_data is not None:
+                add_ghost_lap(GhostLap(lap_data))
+            if player.lap <= NUM_LAPS:
+                start_z = -self.lap_start_checkpoint_idx * SPACING
+                self.lap_recorder.start(start_z)
+                self.setup_ghosts(start_z)
+            else:
+                self.lap_recorder.stop()
+
+        self.lap_recorder.record(player)
+        for ghost in self.ghosts:
+            ghost.update(delta_time)
+
+    def get_cars_in_z_range(self, min_z, max_z):
+        # Returns a list of the cars whose Z positions are between min_z and max_z. car_z_keys is a list of the Z
+        # positions of all cars, in the same order as self.cars, kept up to date by RaceOrder. As the cars are sorted
+        # by Z position, this lets us find nearby cars using a binary search instead of checking every car. The Z
+        # positions in car_z_keys may be slightly out of date if cars have moved since RaceOrder was last updated, so
+        # we search a slightly wider range and then check the current positions
+        start = bisect_left(self.car_z_keys, min_z - NEIGHBOUR_QUERY_MARGIN_Z)
+        end = bisect_right(self.car_z_keys, max_z + NEIGHBOUR_QUERY_MARGIN_Z)
+        return [car for car in self.cars[start:end] if min_z <= car.pos.z <= max_z]
+
+    def get_car_positions(self, cars, alpha=1):
+        # Returns two lists, of the X and Z positions of the given cars. If alpha is less than 1, the positions are
+        # interpolated that fraction of the way from the cars' positions before the last update to their current
+        # positions - see draw_view.
+        # Asking each CPU car in a CPUCarFleet for its position would mean looking up each value in the fleet's arrays
+        # separately, so instead we interpolate the whole of the fleet's arrays at once if necessary, convert them to
+        # lists, and pick the values out of those
+        fleet = self.cpu_car_fleet
+        if fleet is not None:
+            fleet_x, fleet_z = fleet.pos_x, fleet.pos_z
+            if alpha < 1:
+                fleet_x = fleet.prev_pos_x + (fleet_x - fleet.prev_pos_x) * alpha
+                fleet_z = fleet.prev_pos_z + (fleet_z - fleet.prev_pos_z) * alpha
+            fleet_x, fleet_z = fleet_x.tolist(), fleet_z.tolist()
+
+        xs, zs = [], []
+        for car in cars:
+            if isinstance(car, FleetCPUCar):
+                xs.append(fleet_x[car.fleet_idx])
+                zs.append(fleet_z[car.fleet_idx])
+            else:
+                pos = car.pos if alpha >= 1 else car.prev_pos.lerp(car.pos, alpha)
+                xs.append(pos.x)
+                zs.append(pos.z)
+        return xs, zs
+
+    def get_cars_on_track_pieces(self, first_idx, end_idx):
+        # Returns a dictionary of lists of (car, X position, Z position) tuples for the cars on each track piece from
+        # first_idx up to (but not including) end_idx, indexed by track piece index. Track pieces with no cars on them
+        # aren't included. The lists are only needed for drawing, so rather than keeping lists for every track piece
+        # up to date every time the cars move, we make them for just the track pieces in view when a frame is drawn.
+        # Cars beyond the end of the track are treated as being on the last track piece
+        # The positions are looked up once here, so that drawing doesn't have to ask each car for its position again.
+        # They're interpolated by draw_alpha (see draw_view), and each car goes on the track piece for its interpolated
+        # position. Otherwise a car could be drawn as part of a track piece it has already left (or not yet reached),
+        # and would jump when it caught up with the piece.
+        # As in get_cars_in_z_range, we use car_z_keys to find the cars which might be in range. The Z positions in it
+        # are from during the last update, and an interpolated position is between a car's positions before and after
+        # that update, so NEIGHBOUR_QUERY_MARGIN_Z covers the difference. Only the cars found this way (and any visible
+        # ghosts) are interpolated
+        min_z = -end_idx * SPACING if end_idx < len(self.track) else -math.inf
+        max_z = -first_idx * SPACING
+        start = bisect_left(self.car_z_keys, min_z - NEIGHBOUR_QUERY_MARGIN_Z)
+        end = bisect_right(self.car_z_keys, max_z + NEIGHBOUR_QUERY_MARGIN_Z)
+        cars = [car for car in self.cars[start:end] + self.ghosts if car.is_visible()]
+        last_idx = len(self.track) - 1
+        cars_on_track_pieces = {}
+        for car, x, z in zip(cars, *self.get_car_positions(cars, self.draw_alpha)):
+            idx = min(-int(z / SPACING), last_idx)
+            if first_idx <= idx < end_idx:
+                cars_on_track_pieces.setdefault(idx, []).append((car, x, z))
+        return cars_on_track_pieces
 
     def update(self, delta_time):
         self.timer += delta_time
         self.frame_counter += 1
 
+        # Remember where everything was before this update, so that Game.draw can draw things in between
+        for view in self.views:
+            view.prev_camera = Vector3(view.camera)
+            view.prev_bg_offset = Vector2(view.bg_offset)
+        if self.cpu_car_fleet is not None:
+            # The fleet keeps the CPU cars' previous positions in arrays, along with their current positions
+            self.cpu_car_fleet.store_prev_positions()
+            cars = self.player_cars + self.ghosts
+        else:
+            cars = self.cars + self.ghosts
+        for car in cars:
+            car.prev_pos = Vector3(car.pos)
+
         # Race start sequence
         if self.start_timer > 0:
-            # Ensure cars are added to the appropriate track piece's car list, so that
-            # they're displayed during the start countdown (during which time their update is not called)
-            for car in self.cars:
-                car.update_current_track_piece()
             timer_old = self.start_timer
             self.start_timer = max(0, self.start_timer - delta_time)
             # Every second of the countdown, make a sound effect
@@ -917,16 +2970,33 @@ class Game:
             elif int(timer_old) != int(self.start_timer):
                 game.play_sound("startbeep")
 
-        old_camera_z = self.camera.z
-        prev_ahead, _ = self.get_first_track_piece_ahead(old_camera_z)
+        old_camera_zs = [view.camera.z for view in self.views]
 
         # If race has started, update all cars
         if self.start_timer == 0:
-            for car in self.cars:
-                car.update(delta_time)
+            if self.cpu_car_fleet is not None:
+                self.cpu_car_fleet.update(delta_time)
+                for player_car in self.player_cars:
+                    player_car.update(delta_time)
+            else:
+                for car in self.cars:
+                    car.update(delta_time)
+
+            self.update_player_vs_player_collisions()
+
+        # Update race positions. The overtakes are stored so that they can be counted by run_race_farm. This also
+        # puts self.cars back in order of Z position, which update_car_collisions relies on
+        self.overtakes = self.race_order.update()
+        self.car_z_keys = self.race_order.z_keys
+
+        if self.start_timer == 0:
+            self.update_car_collisions()
+
+            if self.time_trial:
+                self.update_time_trial(delta_time)
 
         # Is the race complete?
-        if not self.race_complete and self.player_car is not None :
+        if not self.race_complete and self.player_cars:
             # End the game if lap time reaches 4 mins
             # This serves two purposes:
             # 1) Prevent lap time text from overflowing its area (would happen after 10 mins)
@@ -934,29 +3004,68 @@ class Game:
             #    a race, the game will eventually end so that the next player can start a fresh race without having
             #    to quit and re-run the game
             # Also allow player to end the game by pressing Escape
-            if self.player_car.lap_time >= 60 * 4 or keyboard.escape:
+            if any(car.lap_time >= 60 * 4 for car in self.player_cars if not car.race_over()) or keyboard.escape:
                 stop_music()
                 self.time_up = True
                 self.race_complete = True
 
-            elif self.player_car.lap > NUM_LAPS:
-                stop_music()
-                self.race_complete = True
+            else:
+                # Remember each player's position at the moment they finished, as cars will keep moving after that.
+                # The race is complete once all of the players have finished
+                for player_car in self.player_cars:
+                    if player_car.final_position is None and player_car.lap > NUM_LAPS:
+                        player_car.final_position = player_car.race_position
+                        self.play_sound("game_complete")
+
+                if all(player_car.final_position is not None for player_car in self.player_cars):
+                    stop_music()
+                    self.race_complete = True
+
+            # If time ran out, players who hadn't finished are given the position they were in at the time
+            if self.race_complete:
+                for player_car in self.player_cars:
+                    if player_car.final_position is None:
+                        player_car.final_position = player_car.race_position
+
+        # Play overtaking sound if the player overtook or was overtaken by another car, but only if the speed
+        # difference is high enough
+        if self.player_car is not None and not self.race_complete:
+            for car, overtaken_car in self.overtakes:
+                if (isinstance(car, PlayerCar) or isinstance(overtaken_car, PlayerCar)) \
+                        and abs(car.speed - overtaken_car.speed) > 4:
+                    game.play_sound("overtake", 6)
+                    break
 
-                self.play_sound("game_complete")
+        for view, old_camera_z in zip(self.views, old_camera_zs):
+            self.view = view
 
-            # Sort cars in the list based on race positions
-            self.cars.sort(key=lambda car: car.pos.z)
+            # Update camera position to follow player car
+            view.camera.x = view.follow_car.pos.x
+            view.camera.z = view.follow_car.pos.z + CAMERA_FOLLOW_DISTANCE
 
-        # Update camera position to follow player car
-        self.camera.x = self.camera_follow_car.pos.x
-        self.camera.z = self.camera_follow_car.pos.z + CAMERA_FOLLOW_DISTANCE
+            # As camera moves around corners, add to bg_offset and shift car X position so that steering is required on corners
+            prev_ahead, _ = self.get_first_track_piece_ahead(old_camera_z)
+            offset_change = self.update_background(old_camera_z, prev_ahead)
+
+            # Shift player car's X offset - this means the car will go off the track if you go around a corner without
+            # steering. Without this, the car would magically stick to the track as if the corner wasn't there - because
+            # the curvature is really just a visual effect!
+            if isinstance(view.follow_car, PlayerCar):
+                view.follow_car.set_offset_x_change(offset_change.x)
+
+        if self.views:
+            self.view = self.views[0]
+        self.first_frame = False
 
-        # As camera moves around corners, add to bg_offset and shift car X position so that steering is required on corners
+    def update_background(self, old_camera_z, prev_ahead):
+        # Called after the camera has moved from old_camera_z, where the first track piece ahead was prev_ahead.
+        # Returns the X and Y offsets of the track covered by the camera's movement. Uses the camera and background of
+        # the current view (self.view)
+        bg_offset = self.view.bg_offset
 
         # Get the new camera pos and determine which track piece it's on. The logic is different depending on whether
         # the position change goes from one track piece to the next, or is within one track piece
-        new_camera_z = self.camera.z
+        new_camera_z = self.view.camera.z
         new_ahead, _ = self.get_first_track_piece_ahead(new_camera_z)
 
         # We need to deal with not just interpolating during movement within one track piece, but also when we pass the
@@ -1019,11 +3128,10 @@ class Game:
 
                 # If difference between prev_ahead and new_ahead is more than 1, that means the movement involves
                 # three or more track pieces. We will have passed 100% of each of the in-between track pieces, so we
-                # fully add their offsets
+                # fully add their offsets. The track keeps running totals of the offsets, so we don't need to loop
+                # through the in-between pieces to add them up
                 if new_ahead - prev_ahead > 1:
-                    for i in range(prev_ahead + 1, new_ahead):
-                        piece = self.track[i]
-                        offset_change += Vector2(piece.offset_x, piece.offset_y)
+                    offset_change += Vector2(self.track.get_offset_change(prev_ahead + 1, new_ahead - 1))
 
             else:
                 # Movement was just within one track piece
@@ -1032,237 +3140,355 @@ class Game:
                 offset_change = Vector2(prev_track.offset_x, prev_track.offset_y) * fraction
 
             # Shift background by the calculated offset
-            self.bg_offset += offset_change
+            bg_offset += offset_change
 
             # Keep bg_offset.x within the range -backgroundwidth to +backgroundwidth
-            while self.bg_offset.x < -self.background.get_width():
-                self.bg_offset.x += self.background.get_width()
-            while self.bg_offset.x > self.background.get_width():
-                self.bg_offset.x -= self.background.get_width()
-
-        # Shift player car's X offset - this means the car will go off the track if you go around a corner without
-        # steering. Without this, the car would magically stick to the track as if the corner wasn't there - because
-        # the curvature is really just a visual effect!
-        if self.player_car is not None:
-            self.player_car.set_offset_x_change(offset_change.x)
+            while bg_offset.x < -self.background.get_width():
+                bg_offset.x += self.background.get_width()
+            while bg_offset.x > self.background.get_width():
+                bg_offset.x -= self.background.get_width()
 
         # This deals with moving the background when the camera is moving backwards, which will only happen if the
         # player uses the down arrow key debug mode
         if new_ahead < prev_ahead:
-            self.bg_offset.x -= self.track[prev_ahead].offset_x
-            self.bg_offset.y -= self.track[prev_ahead].offset_y
+            bg_offset.x -= self.track[prev_ahead].offset_x
+            bg_offset.y -= self.track[prev_ahead].offset_y
+
+        return offset_change
+
+    def draw(self, alpha=1):
+        if len(self.views) == 1:
+            self.draw_view(alpha)
+            return
+
+        # Split screen - draw each view into its own viewport, see set_screen. Drawing to a subsurface (an image which
+        # shares its pixels with an area of another image) draws straight into that area of the window.
+        # Only the work which depends on the camera is done separately for each view. The running totals of the track
+        # offsets are looked up once for all of the track pieces that either view can see (see TrackRange), and the
+        # scaled image cache is shared, so a car or piece of scenery which appears at the same size in both views is
+        # only scaled once
+        full_screen = screen
+        self.track_range = self.get_shared_track_range()
+        try:
+            for view in self.views:
+                self.view = view
+                set_screen(pgzero.screen.Screen(full_screen.surface.subsurface(view.rect)), view.projection_scale)
+                self.draw_view(alpha)
+        finally:
+            set_screen(full_screen)
+            self.view = self.views[0]
+            self.track_range = None
+
+        # Draw a line between the views
+        for view in self.views[1:]:
+            screen.surface.fill((0, 0, 0), (0, view.rect.top - 1, WIDTH, 2))
+
+    def get_shared_track_range(self):
+        # Returns a TrackRange covering all of the track pieces which any of the views can see, or None if we're not
+        # using NumPy or the views are so far apart that there's nothing to be gained by sharing
+        if not USE_NUMPY:
+            return None
 
-        self.first_frame = False
+        # The views may be drawn anywhere between their previous and current camera positions
+        first_indices = [self.get_first_track_piece_ahead(camera.z)[0] for view in self.views
+                         for camera in (view.camera, view.prev_camera) if camera is not None]
+        first_idx = min(first_indices)
+        end_idx = min(max(first_indices) + VIEW_DISTANCE, len(self.track))
+        if end_idx - first_idx > VIEW_DISTANCE * 2:
+            return None
+        return TrackRange(self.track, first_idx, end_idx)
+
+    def draw_view(self, alpha):
+        # Draws the current view (self.view).
+        # alpha is the fraction of the way from the positions before the last update to the current positions, at
+        # which to draw the camera, cars and background. To do this, we temporarily replace the camera and background
+        # positions with interpolated ones, and put back the real positions after drawing
+        # The render thread is only used when there's a single view, as it draws each frame's commands during the
+        # next frame
+        view = self.view
+        draw_func = self.draw_pipelined if RENDER_THREAD and len(self.views) == 1 else self.draw_frame
+        if not INTERPOLATE_RENDERING or alpha >= 1 or view.prev_camera is None:
+            draw_func()
+            return
+
+        camera, bg_offset = view.camera, view.bg_offset
+        view.camera = view.prev_camera.lerp(camera, alpha)
+
+        # bg_offset.x wraps around when it goes past the width of the background, so if it's wrapped during the last
+        # update, we need to interpolate from the equivalent unwrapped position
+        prev_bg_offset = Vector2(view.prev_bg_offset)
+        background_width = self.background.get_width()
+        if bg_offset.x - prev_bg_offset.x > background_width / 2:
+            prev_bg_offset.x += background_width
+        elif prev_bg_offset.x - bg_offset.x > background_width / 2:
+            prev_bg_offset.x -= background_width
+        view.bg_offset = prev_bg_offset.lerp(bg_offset, alpha)
+
+        # The cars' positions aren't changed. Only the cars which are in view need to be drawn, so
+        # get_cars_on_track_pieces interpolates just their positions, using draw_alpha
+        self.draw_alpha = alpha
 
-    def draw(self):
-        # Fill background with single colour
-        # We use a different background colour depending on the Y offset of the background image, because
-        # the top and bottom of that image are different colours
-        if self.bg_offset.y > 0:
-            screen.fill( (0,20,117) )
+        try:
+            draw_func()
+        finally:
+            view.camera, view.bg_offset = camera, bg_offset
+            self.draw_alpha = 1
+
+    def draw_frame(self):
+        # Work out what to draw, then draw it
+        times = {}
+        draw_commands = self.draw_command_buffers[0]
+        self.build_draw_commands(draw_commands, times)
+        draw_commands.execute(times)
+        self.draw_hud(times)
+
+    def draw_pipelined(self):
+        # Used instead of draw_frame when RENDER_THREAD is enabled. The draw commands for this frame are built on the
+        # render thread, while this thread draws the commands which were built during the previous frame. So what's
+        # on the screen is always one frame behind the game.
+        # Times for building and drawing are recorded separately, then combined
+        times, build_times = {}, {}
+
+        # On the first frame, there's nothing waiting to be drawn, so build the commands for it straight away
+        if self.pending_draw_commands is None:
+            self.pending_draw_commands = self.draw_command_buffers[0]
+            self.build_draw_commands(self.pending_draw_commands, build_times)
+
+        # Build this frame's commands into whichever buffer isn't waiting to be drawn
+        if self.pending_draw_commands is self.draw_command_buffers[0]:
+            draw_commands = self.draw_command_buffers[1]
         else:
-            screen.fill( (0,77,180) )
-
-        # Profiling times
-        times = {"scenery_scale": 0, "car_scale": 0, "prepare_draw_cars": 0}
-
-        # Draw background
-        # Need to draw either one or two backgrounds - second copy is for wrapping (when bg_offset.x changes enough that
-        # we'd see the edge of the image)
-        profile_bg = Profiler()
-        self.on_screen_debug_strs.append(str(self.bg_offset))
-        screen.blit(self.background, self.bg_offset)
-        if self.bg_offset.x > 0:
-            screen.blit(self.background, self.bg_offset - Vector2(self.background.get_width(), 0))
-        if self.bg_offset.x + self.background.get_width() < WIDTH:
-            screen.blit(self.background, self.bg_offset + Vector2(self.background.get_width(), 0))
-        times["bg"] = profile_bg.get_ms()
-
-        def transform(point_v3, w=None, h=None, clipping_plane=CLIPPING_PLANE):
-            # This local function receives a point as a Vector3 and transforms it into a Vector2 point in screen space
-            # When called for a car or scenery item, w and h are specified, referring to the size of the original
-            # sprite, so it also calculates and returns the scaled width and height, based on the distance from the camera
-            newpoint = point_v3 - self.camera
+            draw_commands = self.draw_command_buffers[0]
+        future = get_render_thread().submit(self.build_draw_commands, draw_commands, build_times)
+
+        self.pending_draw_commands.execute(times)
+
+        # Wait for the render thread to finish, as the game will be updated after this method returns, and the render
+        # thread must not be looking at the game while it changes. If building the commands raised an exception,
+        # result() raises it again here
+        profile_wait = Profiler()
+        future.result()
+        times["render_wait"] = profile_wait.get_ms()
+        self.pending_draw_commands = draw_commands
+
+        for category, ms in build_times.items():
+            times[category] = times.get(category, 0) + ms
+        self.draw_hud(times)
+
+    def build_draw_commands(self, draw_commands, times):
+        # Works out what needs to be drawn, and adds draw commands for it to draw_commands. This method doesn't draw
+        # anything itself, so it can be run on the render thread (see RENDER_THREAD)
+        # Times for profiling are added to times
+        for category in ("scenery_scale", "car_scale", "prepare_draw_cars"):
+            times[category] = 0
+
+        # Remember scaled image cache counters, so we can see how many hits and misses there were during this frame
+        cache_hits_before = scaled_image_cache.hits
+        cache_misses_before = scaled_image_cache.misses
+
+        # The camera of the view being drawn
+        camera = self.view.camera
+
+        self.on_screen_debug_strs.append(str(self.view.bg_offset))
+
+        def transform(point_v3, w, h, clipping_plane=CLIPPING_PLANE):
+            # This local function receives the position of a car or scenery item as a Vector3 and transforms it into a
+            # Vector2 point in screen space. w and h refer to the size of the original sprite, and the function also
+            # calculates and returns the scaled width and height, based on the distance from the camera.
+            # Track pieces are transformed separately, by TrackProjection
+            newpoint = point_v3 - camera
             if newpoint.z > clipping_plane:
-                return None if w is None else (None, None, None)
+                return None, None, None
 
             # Apply perspective and centre on the screen
-            point_v2 = pygame.math.Vector2((newpoint.x / newpoint.z) + HALF_WIDTH,
-                                           (newpoint.y / newpoint.z) + HALF_HEIGHT)
+            projected_z = newpoint.z / PROJECTION_SCALE
+            point_v2 = pygame.math.Vector2((newpoint.x / projected_z) + HALF_WIDTH,
+                                           (newpoint.y / projected_z) + HALF_HEIGHT)
 
-            if w is None:
-                return point_v2
-            else:
-                return point_v2, w / -newpoint.z, h / -newpoint.z
-
-        # offset and offset_delta keep track of the cumulative changes in track offsets (X and Y - Z remains as 0), so
-        # that each track piece is drawn in the correct position
-        offset = Vector3(0, 0, 0)
-        offset_delta = Vector3(0, 0, 0)
+            return point_v2, w / -projected_z, h / -projected_z
 
-        # Tuples of pairs of Vector2s storing screen positions of left and right edges of the track, central
-        # stripes and left/right rumble strips. We remember them so they don't need to be recalculated when joining up
-        # a track piece or stripe with the previous one
+        # Tuples of pairs of screen positions of left and right edges of the track, central stripes and left/right
+        # rumble strips. We remember them so they don't need to be looked up again when joining up a track piece or
+        # stripe with the previous one
         prev_track_screen = None
         prev_stripe_screen = None
         prev_rumble_left_outer_screen = None
         prev_rumble_right_outer_screen = None
 
-        # Instead of drawing track pieces etc as we come across them, we store draw calls in this list. Then we once
-        # we've finished going through track pieces, we execute the draw calls in reverse order, so that track
-        # pieces, cars and scenery in the distance are drawn before things which are closer
-        draw_list = []
-
-        def add_to_draw_list(drawcall, type="?"):
-            draw_list.append((drawcall, type))
-
-        is_first_track_piece_ahead = True
+        # Draw commands are stored in a buffer and executed in reverse order once it's been filled - see
+        # DrawCommandBuffer
+        draw_commands.clear()
 
         prof_track = Profiler("track")
 
         # Get index of first track piece that starts at or just in front of the camera Z position
         # This means the track piece we're currently part-way through won't be displayed, but that doesn't matter
         # as it would be off the bottom of the camera.
-        first_track_piece_idx, current_piece_z = self.get_first_track_piece_ahead(self.camera.z)
-
-        # Index of the track piece that we're drawing, relative to first_track_piece_idx
-        track_ahead_i = 0
+        first_track_piece_idx, first_piece_z = self.get_first_track_piece_ahead(camera.z)
+        frame_profile.track_piece_idx = first_track_piece_idx % self.track.lap_length
+
+        # Interpolate for X offset between first and next track piece. Without this, going around corners would
+        # look very juddery
+        # Get fraction between this and next
+        # First track piece is actually the first track piece IN FRONT of Z
+        # And next is the one after that
+        # So to find the fraction we need to add spacing
+        adjusted_camera_z = camera.z - SPACING
+        first_piece_fraction = inverse_lerp(first_piece_z - SPACING, first_piece_z, adjusted_camera_z)
+
+        # We display VIEW_DISTANCE number of track pieces, or fewer if we're near the end of the track
+        last_track_piece_idx = min(first_track_piece_idx + VIEW_DISTANCE, len(self.track))
+
+        # Calculate the screen positions of the track boundaries, central stripe, outer parts of the left/right rumble
+        # strips and left and right yellow lines (which are just inside the outer edges of the track), for all of the
+        # track pieces we're going to display. We always work out stripe points even for pieces which don't need them,
+        # because the next track piece may make use of the calculated points to connect up to
+        projection = TrackProjection(self.track, camera, first_track_piece_idx, last_track_piece_idx,
+                                     first_piece_z, first_piece_fraction, self.track_range)
+
+        # Polygons for consecutive track pieces are joined into longer strips where possible, see TrackStrips. The
+        # scanline renderer fills rows of pixels instead - see TrackScanlines. It relies on the trackside covering the
+        # rest of each row, and writes 32-bit pixel values
+        scanline_road = (SCANLINE_ROAD and USE_NUMPY and SHOW_TRACKSIDE and OUTLINE_W == 0
+                         and screen.surface.get_bytesize() == 4)
+        strips = TrackScanlines(projection, screen.surface) if scanline_road else TrackStrips()
+
+        # Hill occlusion culling - see the comments above the track piece loop
+        clip_y = HEIGHT
+        use_clip_y = HILL_OCCLUSION_CULLING and SHOW_TRACKSIDE and OUTLINE_W == 0
+
+        def going_up_screen(proj_i):
+            # Returns True if the polygon joining the given track piece to the previous one goes up the screen. The
+            # first visible piece is joined to where the track crosses the clipping plane, see TrackProjection
+            if not projection.first_visible <= proj_i < len(projection.screen_y):
+                return False
+            if proj_i == projection.first_visible:
+                prev_y = projection.near_screen_y
+                return prev_y is not None and projection.screen_y[proj_i] < prev_y
+            return projection.screen_y[proj_i] < projection.screen_y[proj_i - 1]
+
+        # The first visible track piece's polygons are joined to where the track crosses the clipping plane, so we
+        # start with that as the previous track piece's screen positions
+        if projection.near_screen_y is not None:
+            near_y = projection.near_screen_y
+            (near_left_x, near_right_x, near_stripe_left_x, near_stripe_right_x, near_rumble_left_outer_x,
+             near_rumble_right_outer_x, near_yellow_line_left_outer_x, near_yellow_line_left_inner_x,
+             near_yellow_line_right_outer_x, near_yellow_line_right_inner_x) = projection.near_screen_x
+            prev_track_screen = ((near_left_x, near_y), (near_right_x, near_y))
+            prev_stripe_screen = ((near_stripe_left_x, near_y), (near_stripe_right_x, near_y))
+            prev_rumble_left_outer_screen = (near_rumble_left_outer_x, near_y)
+            prev_rumble_right_outer_screen = (near_rumble_right_outer_x, near_y)
+            prev_yellow_line_left_outer_screen = (near_yellow_line_left_outer_x, near_y)
+            prev_yellow_line_left_inner_screen = (near_yellow_line_left_inner_x, near_y)
+            prev_yellow_line_right_outer_screen = (near_yellow_line_right_outer_x, near_y)
+            prev_yellow_line_right_inner_screen = (near_yellow_line_right_inner_x, near_y)
+
+        # Find the cars which are in view, so that each car can be drawn along with the track piece it's on
+        cars_on_track_pieces = self.get_cars_on_track_pieces(first_track_piece_idx, last_track_piece_idx)
+
+        # Go through each track piece ahead, starting with the one nearest the camera
+        # As we go, clip_y keeps track of the highest screen row which is already covered by the track pieces we've
+        # seen so far. Together, the track and the trackside polygons cover the whole width of the screen, so when the
+        # track goes over a hill crest, everything from clip_y to the bottom of the screen is hidden by the track in
+        # front of the crest. Track pieces, scenery and cars behind the crest which are entirely below clip_y won't be
+        # seen, so we don't draw them. This is the 'clip Y' technique used by many classic pseudo-3D racing games.
+        # It only works if the trackside is being drawn and polygons are filled - otherwise we leave clip_y at HEIGHT,
+        # which means nothing is culled
+        for i in range(first_track_piece_idx, last_track_piece_idx):
+            # If the whole screen is covered, nothing further ahead can be seen
+            if clip_y <= 0:
+                break
 
-        # At the start of the loop body below, we subtract SPACING from current_piece_z. Therefore we must add SPACING
-        # before the loop so that current_piece_z is correct for the first track piece.
-        current_piece_z += SPACING
+            # Scenery and cars on this track piece are drawn on top of this track piece's polygons, so they can only
+            # be hidden by the track pieces in front of it
+            sprite_clip_y = clip_y
 
-        # Go through each track piece ahead
-        for i in range(first_track_piece_idx, len(self.track)):
-            # Stop when we've displayed VIEW_DISTANCE number of track pieces
-            track_ahead_i += 1
-            if track_ahead_i > VIEW_DISTANCE:
-                break
+            # Position of this track piece in the projection lists, counting from 0 for the piece at
+            # first_track_piece_idx
+            proj_i = i - first_track_piece_idx
+            track_ahead_i = proj_i + 1
 
             track_piece = self.track[i]
-            current_piece_z -= SPACING
-
-            # Because the camera is pointing down the negative Z axis, negative/positive X mean right/left from
-            # camera's perspective
-            left = Vector3(track_piece.width / 2, 0, current_piece_z)
-            right = Vector3(-track_piece.width / 2, 0, current_piece_z)
-
-            # Interpolate for X offset between first and next track piece. Without this, going around corners would
-            # look very juddery
-            if is_first_track_piece_ahead:
-                # Get fraction between this and next
-                # Current track piece is actually the first track piece IN FRONT of Z
-                # And next is the one after that
-                # So to find the fraction we need to add spacing
-                adjusted_camera_z = self.camera.z - SPACING
-                fraction = inverse_lerp(current_piece_z - SPACING, current_piece_z, adjusted_camera_z)
-                offset_delta = Vector3(fraction * track_piece.offset_x, fraction * track_piece.offset_y, 0)
-            else:
-                offset_delta += Vector3(track_piece.offset_x, track_piece.offset_y, 0)
-
-            is_first_track_piece_ahead = False
-
-            offset += offset_delta
-
-            left += offset
-            right += offset
-
-            # Calculate screen positions of track boundaries
-            left_screen = transform(left)
-            right_screen = transform(right)
-
-            # Calculate screen pos of central stripe
-            # Always work out stripe points even for pieces which don't need them, because the next track piece may
-            # make use of the calculated points to connect up to
-            stripe_left = Vector3(HALF_STRIPE_W, 0, current_piece_z) + offset
-            stripe_right = Vector3(-HALF_STRIPE_W, 0, current_piece_z) + offset
-            stripe_left_screen = transform(stripe_left)
-            stripe_right_screen = transform(stripe_right)
-
-            # Calculate screen pos of outer parts of left/right rumble strips (can just use left/right track positions
-            # for inner part that touches track)
-            rumble_strip_left_outer = left + Vector3(HALF_RUMBLE_STRIP_W, 0, 0)
-            rumble_strip_right_outer = right - Vector3(HALF_RUMBLE_STRIP_W, 0, 0)
-            rumble_strip_left_outer_screen = transform(rumble_strip_left_outer)
-            rumble_strip_right_outer_screen = transform(rumble_strip_right_outer)
-
-            # Calculate screen pos of left and right yellow lines, which are just inside the outer edges of the track
-            yellow_line_left_outer = left - Vector3(YELLOW_LINE_DISTANCE_FROM_EDGE, 0, 0)
-            yellow_line_left_inner = yellow_line_left_outer - Vector3(HALF_YELLOW_LINE_W, 0, 0)
-            yellow_line_right_outer = right + Vector3(YELLOW_LINE_DISTANCE_FROM_EDGE, 0, 0)
-            yellow_line_right_inner = yellow_line_right_outer + Vector3(HALF_YELLOW_LINE_W, 0, 0)
-            yellow_line_left_outer_screen = transform(yellow_line_left_outer)
-            yellow_line_left_inner_screen = transform(yellow_line_left_inner)
-            yellow_line_right_outer_screen = transform(yellow_line_right_outer)
-            yellow_line_right_inner_screen = transform(yellow_line_right_inner)
-
-            # Only draw if both points are in front of clipping plane
-            if left_screen is not None and right_screen is not None:
-                # To draw, there must be a previous track piece that we can connect to
-                if prev_track_screen is not None:
-                    def any_on_screen(points):
-                        # point[1] gets Y for both tuple pair and Vector2
-                        on_screen = [point for point in points if point[1] < HEIGHT]
-                        return any(on_screen)
-
-                    def draw_polygon(points, col):
-                        if USE_GFXDRAW:
-                            if OUTLINE_W == 0:
-                                pygame.gfxdraw.filled_polygon(screen.surface, points, col)
-                            else:
-                                pygame.gfxdraw.polygon(screen.surface, points, col)
-                        else:
-                            pygame.draw.polygon(screen.surface, col, points, OUTLINE_W)
-
-                    def draw_points(points, col, id):
-                        if any_on_screen(points):
-                            add_to_draw_list( lambda col=col, points=points: draw_polygon(points, col), id)
-
-                    # Draw stripe (3m on/off)
-                    if i // 3 % 2 == 0:
-                        points = (stripe_left_screen, stripe_right_screen, prev_stripe_screen[1], prev_stripe_screen[0])
-                        draw_points(points, STRIPE_COLOUR, "stripe")
-
-                    # Draw yellow lines
-                    # This is before the drawing of the track as we want to draw on top of the track, and items in the
-                    # draw list are drawn in reverse order
-                    if SHOW_YELLOW_LINES:
-                        left_yellow_line_points = (prev_yellow_line_left_outer_screen,
-                                                     yellow_line_left_outer_screen,
-                                                     yellow_line_left_inner_screen,
-                                                     prev_yellow_line_left_inner_screen)
-                        draw_points(left_yellow_line_points, YELLOW_LINE_COL, "yellow line L")
-
-                        right_yellow_line_points = (prev_yellow_line_right_outer_screen,
-                                                     yellow_line_right_outer_screen,
-                                                     yellow_line_right_inner_screen,
-                                                     prev_yellow_line_right_inner_screen)
-                        draw_points(right_yellow_line_points, YELLOW_LINE_COL, "yellow line R")
-
-
-                    # Draw track
-                    points = (prev_track_screen[0], left_screen, right_screen, prev_track_screen[1])
-                    draw_points(points, track_piece.col, "track")
-
-                    # Draw rumble strip
-                    # This is before trackside as it draws on top of trackside, and items in the draw list are drawn
-                    # in reverse order
-                    if SHOW_RUMBLE_STRIPS:
-                        # Alternating colours
-                        rumble_col = RUMBLE_COLOUR_1 if (i // 2) % 2 == 0 else RUMBLE_COLOUR_2
-                        rumble_left_points = (prev_rumble_left_outer_screen, prev_track_screen[0], left_screen, rumble_strip_left_outer_screen)
-                        rumble_right_points = (prev_rumble_right_outer_screen, prev_track_screen[1], right_screen, rumble_strip_right_outer_screen)
-                        draw_points(rumble_left_points, rumble_col, "rumble L")
-                        draw_points(rumble_right_points, rumble_col, "rumble R")
-
-                    # Draw trackside
-                    if SHOW_TRACKSIDE:
-                        # Alternating colours
-                        trackside_col = TRACKSIDE_COLOUR_1 if (i // 5) % 2 == 0 else TRACKSIDE_COLOUR_2
-                        trackside_left_points = (points[2], points[3], (0, points[3].y), (0, points[2].y))
-                        trackside_right_points = (points[0], points[1], (WIDTH - 1, points[1].y), (WIDTH - 1, points[0].y))
-                        draw_points(trackside_left_points, trackside_col, "trackside left")
-                        draw_points(trackside_right_points, trackside_col, "trackside right")
+            current_piece_z = projection.piece_z[proj_i]
+
+            # The cumulative changes in track offsets (X and Y - Z remains as 0) up to this track piece, which are
+            # used to place scenery and cars in the correct position
+            offset_x = projection.offset_x[proj_i]
+            offset_y = projection.offset_y[proj_i]
+
+            # Only draw if the track piece is in front of clipping plane
+            if projection.visible[proj_i]:
+                # Screen positions of the points along this track piece, which all have the same Y position
+                screen_y = projection.screen_y[proj_i]
+                left_screen = (projection.left_x[proj_i], screen_y)
+                right_screen = (projection.right_x[proj_i], screen_y)
+                stripe_left_screen = (projection.stripe_left_x[proj_i], screen_y)
+                stripe_right_screen = (projection.stripe_right_x[proj_i], screen_y)
+                rumble_strip_left_outer_screen = (projection.rumble_left_outer_x[proj_i], screen_y)
+                rumble_strip_right_outer_screen = (projection.rumble_right_outer_x[proj_i], screen_y)
+                yellow_line_left_outer_screen = (projection.yellow_line_left_outer_x[proj_i], screen_y)
+                yellow_line_left_inner_screen = (projection.yellow_line_left_inner_x[proj_i], screen_y)
+                yellow_line_right_outer_screen = (projection.yellow_line_right_outer_x[proj_i], screen_y)
+                yellow_line_right_inner_screen = (projection.yellow_line_right_inner_x[proj_i], screen_y)
+
+                # To draw, there must be a previous track piece that we can connect to. We also don't draw if the
+                # polygon would be entirely below the bottom of the screen, or entirely hidden by nearer track pieces.
+                # All of the polygons for this track piece are at the same Y positions, so we can just check the track
+                # edges
+                if prev_track_screen is not None and min(screen_y, prev_track_screen[0][1]) < min(clip_y, HEIGHT):
+                    # If this track piece's polygons reach down to clip_y, there's no gap between them and the
+                    # area already covered, so the covered area now extends up to the top of this track piece.
+                    # We add 1 to the Y position so that the row of pixels along the top edge, which may be only
+                    # partly covered, doesn't count
+                    if use_clip_y:
+                        top_y, bottom_y = sorted((screen_y, prev_track_screen[0][1]))
+                        if bottom_y + 1 >= clip_y:
+                            clip_y = min(clip_y, top_y + 1)
+
+                    # The stripe is 3m on/off, and the rumble strips and trackside have alternating colours
+                    show_stripe = i // 3 % 2 == 0
+                    rumble_col = RUMBLE_COLOUR_1 if (i // 2) % 2 == 0 else RUMBLE_COLOUR_2
+                    trackside_col = TRACKSIDE_COLOUR_1 if (i // 5) % 2 == 0 else TRACKSIDE_COLOUR_2
+
+                    if scanline_road:
+                        # The scanline renderer gets the positions of the edges from the projection itself
+                        strips.add(proj_i, track_piece.col, show_stripe, rumble_col, trackside_col)
+                    else:
+                        # The order in which the layers are added doesn't matter, as TrackStrips.flush puts them in the
+                        # correct order for drawing
+
+                        # Draw stripe
+                        if show_stripe:
+                            strips.add("stripe", i, STRIPE_COLOUR, prev_stripe_screen[0], prev_stripe_screen[1],
+                                       stripe_left_screen, stripe_right_screen)
+
+                        # Draw yellow lines, on top of the track
+                        if SHOW_YELLOW_LINES:
+                            strips.add("yellow line L", i, YELLOW_LINE_COL,
+                                       prev_yellow_line_left_outer_screen, prev_yellow_line_left_inner_screen,
+                                       yellow_line_left_outer_screen, yellow_line_left_inner_screen)
+                            strips.add("yellow line R", i, YELLOW_LINE_COL,
+                                       prev_yellow_line_right_outer_screen, prev_yellow_line_right_inner_screen,
+                                       yellow_line_right_outer_screen, yellow_line_right_inner_screen)
+
+                        # Draw track
+                        strips.add("track", i, track_piece.col, prev_track_screen[0], prev_track_screen[1],
+                                   left_screen, right_screen)
+
+                        # Draw rumble strip, on top of the trackside
+                        if SHOW_RUMBLE_STRIPS:
+                            strips.add("rumble L", i, rumble_col, prev_rumble_left_outer_screen, prev_track_screen[0],
+                                       rumble_strip_left_outer_screen, left_screen)
+                            strips.add("rumble R", i, rumble_col, prev_rumble_right_outer_screen, prev_track_screen[1],
+                                       rumble_strip_right_outer_screen, right_screen)
+
+                        # Draw trackside, which goes from the edge of the track to the edge of the screen
+                        if SHOW_TRACKSIDE:
+                            prev_y = prev_track_screen[0][1]
+                            strips.add("trackside left", i, trackside_col, prev_track_screen[1], (0, prev_y),
+                                       right_screen, (0, screen_y))
+                            strips.add("trackside right", i, trackside_col, prev_track_screen[0], (WIDTH - 1, prev_y),
+                                       left_screen, (WIDTH - 1, screen_y))
 
                 # Store screen positions of various parts of the track, as they form half of the polygon for the next
                 # track piece
@@ -1283,29 +3509,37 @@ class Game:
                     if SHOW_TRACK_PIECE_OFFSETS:
                         items.extend([str(track_piece.offset_x), str(track_piece.offset_y)])
                     text = ",".join(items)
-                    add_to_draw_list(lambda left_screen=left_screen, text=text:
-                                        screen.draw.text(text, (left_screen[0], left_screen[1] - 30)))
+                    draw_commands.add_text(text, (left_screen[0], left_screen[1] - 30), "debug_text", debug=True)
+
+            # If the track stops going up the screen after this track piece (e.g. because there's a hill crest, or
+            # the track goes beyond VIEW_DISTANCE), draw the track strips we've built up so far. We must do this
+            # before the scenery and cars on this track piece, as they need to be drawn after (on top of) all the
+            # track pieces behind them. It's fine for scenery and cars on earlier track pieces to be drawn after the
+            # strips, as the track pieces in front of them are lower on the screen so they won't overlap
+            if not (going_up_screen(proj_i) and going_up_screen(proj_i + 1)):
+                strips.flush(draw_commands)
 
             # Draw scenery for the current track piece
             if SHOW_SCENERY:
                 for obj in track_piece.scenery:
-                    if track_ahead_i * SPACING < obj.max_draw_distance:
-                        pos_v3 = Vector3(obj.x, 0, current_piece_z) + offset
-                        if self.camera.z - current_piece_z > obj.min_draw_distance:
+                    if track_ahead_i * SPACING < obj.max_draw_distance * SCENERY_DRAW_DISTANCE_SCALE:
+                        pos_v3 = Vector3(obj.x + offset_x, offset_y, current_piece_z)
+                        if camera.z - current_piece_z > obj.min_draw_distance:
                             billboard = obj.get_image()
                             pos, scaled_w, scaled_h = transform(pos_v3, billboard.get_width() * obj.scale,
                                                                 billboard.get_height() * obj.scale)
                             # If a piece of scenery is very close to the camera, the scaled size may become enormous.
-                            # Don't try to draw such scenery, due to memory and frame rate issues
-                            if pos is not None and scaled_w < MAX_SCENERY_SCALED_WIDTH:
-                                # Anchor point at bottom
-                                pos -= Vector2(scaled_w // 2, scaled_h)
+                            # Don't try to draw such scenery, due to memory and frame rate issues. We also skip
+                            # scenery which is hidden behind a hill crest, before going to the trouble of scaling it
+                            if pos is not None and scaled_w < MAX_SCENERY_SCALED_WIDTH \
+                                    and pos.y - scaled_h < sprite_clip_y:
                                 try:
                                     profile_scale = Profiler()
-                                    scaled = SCALE_FUNC(billboard, (int(scaled_w), int(scaled_h)))
+                                    scaled = scaled_image_cache.get(billboard, scaled_w, scaled_h)
                                     times["scenery_scale"] += profile_scale.get_ms()
-                                    add_to_draw_list(lambda scaled=scaled, pos=pos: screen.blit(scaled, pos),
-                                                     "scenery_draw")
+                                    # Anchor point at bottom
+                                    pos -= Vector2(scaled.get_width() // 2, scaled.get_height())
+                                    draw_commands.add_blit(scaled, pos, "scenery_draw")
                                 except pygame.error:
                                     # Have experienced out of memory errors with a too-small clipping plane, due to trying to
                                     # scale to too big a size. In extreme cases Pygame may try to allocate bitmaps over 1GB
@@ -1315,35 +3549,36 @@ class Game:
             # Draw cars
             profile_prepare_draw_cars = Profiler()
             cars_to_draw = []
-            for car in track_piece.cars:
+            for car, car_x, car_z in cars_on_track_pieces.get(i, ()):
                 # Each car needs to be drawn during the track piece it is on, but with an additional offset interpolated
                 # towards the next track piece, so that it starts turning a corner as it reaches the piece
                 # Also, the order of  drawing needs to be correct if there is more than one car per track piece
-                car_offset = Vector3(offset)
-                if car.pos.z % SPACING != 0:
+                car_offset = Vector3(offset_x, offset_y, 0)
+                if car_z % SPACING != 0:
                     # Interpolate offset between this and next track piece
                     # Note that "Interpolate for X offset between first and next track piece"
                     # will already have happened! Does that matter?
 
                     # The following lines deal with the car when it's moving onto a track piece with an offset
-                    fraction = inverse_lerp(current_piece_z, current_piece_z - SPACING, car.pos.z)
+                    fraction = inverse_lerp(current_piece_z, current_piece_z - SPACING, car_z)
                     next_track_piece = self.track[i + 1]
                     car_offset += Vector3(fraction * next_track_piece.offset_x,
                                           fraction * next_track_piece.offset_y, -fraction * SPACING)
 
                     # This ensures that the car's forward motion is correct on pieces following a piece with an offset
-                    car_offset += offset_delta * fraction
+                    car_offset += Vector3(projection.offset_delta_x[proj_i] * fraction,
+                                          projection.offset_delta_y[proj_i] * fraction, 0)
 
                 # The rules for drawing the player car (or whichever car the camera is following, in demo mode) are
                 # a bit different. If we drew it in the same way, its position on the screen would be a bit off as
                 # it would start going around corners before the camera does. So don't apply any offset.
                 # (For Y offset, you can achieve an interesting effect by changing 0 to -car_offset.y / 2, but
                 # it is a bit glitchy sometimes so we've left it at zero)
-                if car is self.camera_follow_car:
+                if car is self.view.follow_car:
                     car_offset.x = 0
                     car_offset.y = 0
 
-                pos_v3 = Vector3(car.pos.x, 0, current_piece_z) + car_offset
+                pos_v3 = Vector3(car_x, 0, current_piece_z) + car_offset
                 scale = 2
 
                 # For CPU cars, choose the sprite to use based on the car's angle in relation to the camera
@@ -1352,77 +3587,113 @@ class Game:
                     # The further the car is ahead, the smaller the effect
                     # The car sprite filenames end in a number in the range -4 to 4, where 0 is the car not turning,
                     # -1 is the car turning slightly to the left, 1 is turning slightly to the right, etc
-                    z_distance = max(1, -(pos_v3.z - self.camera.z))
-                    offset_for_angle = (pos_v3.x - self.camera.x) / z_distance
+                    z_distance = max(1, -(pos_v3.z - camera.z))
+                    offset_for_angle = (pos_v3.x - camera.x) / z_distance
                     offset_for_angle += -car.steering * 10
                     angle_sprite_idx = int(remap_clamp(offset_for_angle, -200, 200, -4, 4))
 
                     # If this is the camera follow car (which for a CPU car will only be the case during
                     # the title screen), limit to only the shallowest angles (-1 to 1), as this car is a stand-in
                     # for the plyaer car and the player car only uses angles between -1 and 1
-                    if car is self.camera_follow_car:
+                    if car is self.view.follow_car:
                         angle_sprite_idx = min(max(angle_sprite_idx, -1), 1)
 
                     car.update_sprite(angle_sprite_idx, braking=False)
 
                 # Calculate screen pos and scaled sprite size for car
-                img = getattr(images, car.image)
+                img = sprite_table[car.sprite]
                 pos, scaled_w, scaled_h = transform(pos_v3,
                                                     img.get_width() * scale,
                                                     img.get_height() * scale,
                                                     clipping_plane=CLIPPING_PLANE_CARS)
 
-                if pos is not None and scaled_w < MAX_CAR_SCALED_WIDTH:
-                    # Anchor point at bottom, centre
-                    pos -= Vector2(scaled_w // 2, scaled_h)
+                # Skip cars which are hidden behind a hill crest
+                if pos is not None and scaled_w < MAX_CAR_SCALED_WIDTH and pos.y - scaled_h < sprite_clip_y:
                     profile_scale = Profiler()
-                    scaled = SCALE_FUNC(img, (int(scaled_w), int(scaled_h)))
+                    scaled = scaled_image_cache.get(img, scaled_w, scaled_h)
                     times["car_scale"] += profile_scale.get_ms()
+                    # Anchor point at bottom, centre
+                    pos -= Vector2(scaled.get_width() // 2, scaled.get_height())
 
                     # We can't send it to the draw list just yet as there might be more than one car on this track
                     # piece and we need to draw them in order starting from the one furthest from the camera.
                     # So we'll add it to a list to sort and draw later
-                    cars_to_draw.append({"z": car.pos.z, "drawcall": lambda scaled=scaled, pos=pos: screen.blit(scaled, pos)})
+                    cars_to_draw.append((car_z, scaled, pos))
 
                     if SHOW_CPU_CAR_SPEEDS and isinstance(car, CPUCar):
                         output = f"{car.target_speed:.0f}"
-                        add_to_draw_list(lambda pos=pos, output=output: draw_text(output, pos.x, pos.y - 40))
+                        draw_commands.add_text(output, (pos.x, pos.y - 40))
 
             times["prepare_draw_cars"] += profile_prepare_draw_cars.get_ms()
 
             # Draw the cars that are on the current track piece,starting from the one with the lowest Z position
-            cars_to_draw.sort(key=lambda entry: entry["z"], reverse=True)
-            for entry in cars_to_draw:
-                add_to_draw_list(entry["drawcall"], "cars")
-
-        # Draw everything in draw_list, in reverse order - so that items furthest ahead are drawn first
-        for draw_call, type in reversed(draw_list):
-            profiler = Profiler()
-            draw_call()
-            if type not in times:
-                times[type] = profiler.get_ms()
-            else:
-                times[type] += profiler.get_ms()
+            cars_to_draw.sort(key=lambda entry: entry[0], reverse=True)
+            for _, scaled, pos in cars_to_draw:
+                draw_commands.add_blit(scaled, pos, "cars")
+
+        # If we stopped early because the screen was fully covered, there may be strips which haven't been added to the
+        # draw command buffer yet
+        strips.flush(draw_commands)
+        if scanline_road:
+            strips.add_rows(draw_commands)
+
+        # Make the categories separate, so that they add up to the total time. Car scaling is timed within the car
+        # preparation, and everything else in the loop above is working out what to draw
+        times["prepare_draw_cars"] -= times["car_scale"]
+        times["prepare_track"] = (prof_track.get_ms() - times["scenery_scale"] - times["car_scale"]
+                                  - times["prepare_draw_cars"])
+
+        # Draw background
+        # As the commands are drawn in reverse order, the background must be added last so that it's drawn first.
+        # Need to draw either one or two backgrounds - second copy is for wrapping (when bg_offset.x changes enough that
+        # we'd see the edge of the image). The position is copied, as bg_offset may change before the commands are
+        # drawn
+        bg_offset = Vector2(self.view.bg_offset)
+        background_width = self.background.get_width()
+        if bg_offset.x + background_width < WIDTH:
+            draw_commands.add_blit(self.background, bg_offset + Vector2(background_width, 0), "bg")
+        if bg_offset.x > 0:
+            draw_commands.add_blit(self.background, bg_offset - Vector2(background_width, 0), "bg")
+        draw_commands.add_blit(self.background, bg_offset, "bg")
+
+        # Fill background with single colour
+        # We use a different background colour depending on the Y offset of the background image, because
+        # the top and bottom of that image are different colours
+        if bg_offset.y > 0:
+            draw_commands.add_fill((0,20,117), "bg")
+        else:
+            draw_commands.add_fill((0,77,180), "bg")
+
+        self.scale_cache_hits = scaled_image_cache.hits - cache_hits_before
+        self.scale_cache_misses = scaled_image_cache.misses - cache_misses_before
+
+    def draw_hud(self, times):
+        # Draws the status bar and messages on top of everything else, and records the profiling times for the frame
+        profile_hud = Profiler()
 
         # Is there an actual player car, or are we in demo mode?
         if self.player_car is not None:
-            # Show info text
+            # Show info text for the player whose view is being drawn
             # Adapt to varying window widths by using fractions of WIDTH instead of absolute coordinates
+            player_car = self.view.follow_car
 
-            player_pos = self.cars.index(self.player_car) + 1
+            if player_car.final_position is not None:
+                player_pos = player_car.final_position + 1
+            else:
+                player_pos = player_car.race_position + 1
 
             # Show race complete or time up screens if relevant
             if self.time_up:
                 draw_text("TIME UP!", WIDTH // 2, HEIGHT * 0.4, centre=True)
 
-            elif self.race_complete:
+            elif player_car.race_over():
                 draw_text("RACE COMPLETE!", WIDTH // 2, HEIGHT * 0.15, centre=True)
                 draw_text("POSITION", WIDTH // 2, HEIGHT * 0.3, centre=True)
                 draw_text(str(player_pos), WIDTH // 2, HEIGHT * 0.42, centre=True)
                 draw_text("FASTEST LAP", WIDTH * 0.25, HEIGHT * 0.55, centre=True)
-                draw_text(format_time(self.player_car.fastest_lap), WIDTH * 0.25, HEIGHT * 0.68, centre=True)
+                draw_text(format_time(player_car.fastest_lap), WIDTH * 0.25, HEIGHT * 0.68, centre=True)
                 draw_text("RACE TIME", WIDTH * 0.75, HEIGHT * 0.55, centre=True)
-                draw_text(format_time(self.player_car.race_time), WIDTH * 0.75, HEIGHT * 0.68, centre=True)
+                draw_text(format_time(player_car.race_time), WIDTH * 0.75, HEIGHT * 0.68, centre=True)
 
             else:
                 # Race not complete - show status text at top of screen
@@ -1432,31 +3703,31 @@ class Game:
                 screen.blit("status", (status_x, 0))
 
                 # Show lap
-                draw_text(f"{self.player_car.lap:02}", status_x + 30, 37, font="status1b_")
+                draw_text(f"{player_car.lap:02}", status_x + 30, 37, font="status1b_")
 
                 # Show position
                 draw_text(f"{player_pos:02}", status_x + 116, 37, font="status1b_")
 
                 # Show speed
-                draw_text(f"{int(self.player_car.speed):03}", status_x + 197, 37, font="status1b_")
+                draw_text(f"{int(player_car.speed):03}", status_x + 197, 37, font="status1b_")
 
                 # Show lap time
-                draw_text(format_time(self.player_car.lap_time), status_x + 299, 37, font="status2_")
+                draw_text(format_time(player_car.lap_time), status_x + 299, 37, font="status2_")
 
                 # Show fastest lap
-                if self.player_car.last_lap_was_fastest and self.player_car.lap_time < 4:
+                if player_car.last_lap_was_fastest and player_car.lap_time < 4:
                     y = HEIGHT * 0.4
                     draw_text("FASTEST LAP!", WIDTH // 2, y, centre=True)
-                    draw_text(format_time(self.player_car.fastest_lap), WIDTH // 2, y + 60, centre=True)
+                    draw_text(format_time(player_car.fastest_lap), WIDTH // 2, y + 60, centre=True)
 
                 # Show final lap text
                 # If we're currently showing fastest lap text, wait for that to disappear before showing the final
                 # lap text
-                if self.player_car.last_lap_was_fastest:
+                if player_car.last_lap_was_fastest:
                     begin_time, end_time = 4, 8
                 else:
                     begin_time, end_time = 0, 4
-                if self.player_car.lap == NUM_LAPS and begin_time < self.player_car.lap_time < end_time:
+                if player_car.lap == NUM_LAPS and begin_time < player_car.lap_time < end_time:
                     y = HEIGHT * 0.4
                     draw_text("FINAL LAP!", WIDTH // 2, y, centre=True)
 
@@ -1466,8 +3737,15 @@ class Game:
                 screen.draw.text(self.on_screen_debug_strs[i], (0, 50 + i * 20))
         self.on_screen_debug_strs.clear()
 
+        times["hud"] = profile_hud.get_ms()
+        frame_profile.add_times(times)
+
         if SHOW_PROFILE_TIMINGS:
-            print(prof_track, sum(times.values()))
+            print("total", sum(times.values()))
+
+            # Cache hit/miss counts are added after the total time is calculated, as they're not times
+            times["scale_cache_hits"] = self.scale_cache_hits
+            times["scale_cache_misses"] = self.scale_cache_misses
 
             # if sum(times.values()) > 16:
             print(self.frame_counter, times)
@@ -1475,15 +3753,74 @@ class Game:
             # test drawing a very large polygon
             # pygame.draw.polygon(screen.surface, (255,0,0), (Vector2(-4000,test), Vector2(WIDTH*4,test), Vector2(0,test+500)))
 
-    # Returns index of track piece at the specified Z position, or None if the specified position is off the end
-    # of the track
-    # e.g. track piece 0 goes from Z 0 to -0.999, etc
-    def get_track_piece_for_z(self, z):
-        idx = -int(z / SPACING)
-        if idx >= len(self.track):
-            return None
-        else:
-            return idx
+    def update_player_car_collisions(self, player_car):
+        # Called from PlayerCar.update once the player's car has moved, so that collisions are dealt with before the
+        # scenery and checkpoint checks, as they always have been. Only cars which are close enough in the Z axis to
+        # collide with the player need to be checked, and get_cars_in_z_range can find those without checking every car
+        # In a two player game, the other player's car is skipped. Otherwise each player would check for a collision
+        # with the other during their own update, so the cars would be pushed apart twice - see
+        # update_player_vs_player_collisions
+        if not player_car.can_collide():
+            return
+
+        z = player_car.pos.z
+        for other in self.get_cars_in_z_range(z - COLLIDE_FRONT_DISTANCE_Z, z + COLLIDE_BACK_DISTANCE_Z):
+            if isinstance(other, PlayerCar) or not other.can_collide():
+                continue
+
+            result = player_car.collide(other)
+            if result == "front":
+                self.play_sound("bump", 6)
+            elif result == "back":
+                self.play_sound("bump_behind")
+
+    def update_player_vs_player_collisions(self):
+        # Deal with collisions between the players' cars in a two player game, once both players have moved, so that
+        # each pair of players is only checked once per update. As in update_car_collisions, the car further back is
+        # treated as the one that collided
+        for i, player_car in enumerate(self.player_cars):
+            for other in self.player_cars[i + 1:]:
+                if not player_car.can_collide() or not other.can_collide():
+                    continue
+
+                if other.pos.z > player_car.pos.z:
+                    result = other.collide(player_car)
+                else:
+                    result = player_car.collide(other)
+
+                # Both players hear the bump - one hit the other's back, which the other hears as being hit from behind
+                if result == "front":
+                    self.play_sound("bump", 6)
+                    self.play_sound("bump_behind")
+
+    def update_car_collisions(self):
+        # Deal with collisions between CPU cars, once all cars have moved and RaceOrder has sorted self.cars by Z
+        # position. Collisions involving players are dealt with in update_player_car_collisions.
+        # Checking every car against every other car would mean N*(N-1)/2 checks, which gets slow with lots of cars.
+        # Instead we make use of the fact that the cars are sorted. Cars can only collide if they're close to each
+        # other in the Z axis, so for each car we only need to check the cars after it in the list (the ones behind
+        # it), stopping as soon as we reach one which is too far behind. Cars further ahead will have checked against
+        # this car themselves, so each pair is only checked once. This is known as 'sweep and prune'.
+        # The collision rules aren't symmetrical, so it matters which car we treat as being the one that collided -
+        # it's the car further back, which can only collide with a car less than COLLIDE_FRONT_DISTANCE_Z ahead of it.
+        # But the Z positions in car_z_keys are from before this update's collisions pushed cars apart, so we stop at
+        # the larger COLLIDE_BACK_DISTANCE_Z instead, and collide checks the current positions
+        cars = self.cars
+        z_keys = self.car_z_keys
+        num_cars = len(cars)
+        for i in range(num_cars - 1):
+            z = z_keys[i]
+            j = i + 1
+            while j < num_cars and z_keys[j] - z < COLLIDE_BACK_DISTANCE_Z:
+                car, other = cars[i], cars[j]
+                j += 1
+                if isinstance(car, PlayerCar) or isinstance(other, PlayerCar):
+                    continue
+
+                if other.pos.z > car.pos.z:
+                    other.collide(car)
+                else:
+                    car.collide(other)
 
     # Returns index and Z position of first track piece ahead of or exactly at the specified Z position, or None,None
     # if the specified position is off the end of the track
@@ -1525,6 +3862,7 @@ def setup_joystick_controls():
 
 def update_controls():
     keyboard_controls.update()
+    player2_keyboard_controls.update()
     # Allow a controller to be connected while the game is open
     if joystick_controls is None:
         setup_joystick_controls()
@@ -1557,12 +3895,20 @@ def update(delta_time):
         return None
 
     if state == State.TITLE:
-        # Check for player starting game with either keyboard or controller
+        # Check for player starting game with either keyboard or controller. Button 1 starts a time trial
+        # Player 2's accelerate key starts a two player game, with the first player using the keyboard controls
         controls = button_pressed_controls(0)
+        time_trial_controls = button_pressed_controls(1)
         if controls is not None:
             # Switch to play state, and create a new Game object, passing it a controls object
             state = State.PLAY
             game = Game(controls)
+        elif time_trial_controls is not None:
+            state = State.PLAY
+            game = Game(time_trial_controls, time_trial=True)
+        elif player2_keyboard_controls.button_pressed(0):
+            state = State.PLAY
+            game = Game(keyboard_controls, player2_controls=player2_keyboard_controls)
 
         # If the demo race has been running for a while, reset it, otherwise the AI cars will run out of track!
         demo_reset_timer -= delta_time
@@ -1579,23 +3925,32 @@ def update(delta_time):
     elif state == State.GAME_OVER:
         if button_pressed_controls(0) is not None:
             # Go back into demo/title screen mode - create a new Game object without a player
-            # First stop the player car's skid sound
-            game.player_car.stop_engine_sound()
+            # First stop the player cars' skid sounds
+            for player_car in game.player_cars:
+                player_car.stop_engine_sound()
 
             state = State.TITLE
             game = Game()
             play_music("title_theme")
 
     # Call game.update each time while accumulated_time is above FIXED_TIMESTEP. If it is double or more of FIXED_TIMESTEP,
-    # which would occur if the frame rate is low, we call game.update two or more times per frame
+    # which would occur if the frame rate is low, we call game.update two or more times per frame, up to
+    # MAX_UPDATES_PER_FRAME. If we still haven't caught up, the extra time is dropped
     accumulated_time += delta_time
-    while accumulated_time >= FIXED_TIMESTEP:
+    profile_update = Profiler()
+    updates = 0
+    while accumulated_time >= FIXED_TIMESTEP and updates < MAX_UPDATES_PER_FRAME:
         accumulated_time -= FIXED_TIMESTEP
         game.update(FIXED_TIMESTEP)
+        updates += 1
+    accumulated_time = min(accumulated_time, FIXED_TIMESTEP)
+    frame_profile.add_time("update", profile_update.get_ms())
 
 def draw():
-    game.draw()
+    # The time left over after the updates tells us how far we are between the last update and the next one
+    game.draw(accumulated_time / FIXED_TIMESTEP)
 
+    profile_title = Profiler()
     if state == State.TITLE:
         if demo_reset_timer < 1 or demo_start_timer < 1:
             # Fade out screen prior to resetting demo game, and fade in whenever demo (re)starts
@@ -1610,7 +3965,14 @@ def draw():
         # Construct start game text
         # On macOS, encourage the user to use Z instead of left control to accelerate, because
         # Ctrl+arrow is the keyboard shortcut to switch desktop
-        text = f"PRESS {SPECIAL_FONT_SYMBOLS['xb_a']} OR {'Z' if 'Darwin' in platform.version() else 'LEFT CONTROL'}"
+        # Every few seconds, the text switches to telling the player how to start a time trial or two player game
+        prompt = int(demo_start_timer / 4) % 3
+        if prompt == 0:
+            text = f"PRESS {SPECIAL_FONT_SYMBOLS['xb_a']} OR {'Z' if 'Darwin' in platform.version() else 'LEFT CONTROL'}"
+        elif prompt == 1:
+            text = f"{'X' if 'Darwin' in platform.version() else 'LEFT SHIFT'} FOR TIME TRIAL"
+        else:
+            text = "W FOR TWO PLAYERS"
 
         # Draw start game text
         draw_text(text, WIDTH//2, HEIGHT - 82, True)
@@ -1619,6 +3981,31 @@ def draw():
         logo_img = images.logo
         screen.blit(logo_img, (WIDTH//2 - logo_img.get_width() // 2, HEIGHT//3 - logo_img.get_height() // 2))
 
+        frame_profile.add_time("title", profile_title.get_ms())
+
+    frame_profile.end_frame()
+    if detail_controller is not None:
+        detail_controller.update(frame_profile.last_frame_ms)
+    if SHOW_PROFILE_OVERLAY:
+        frame_profile.draw()
+        if detail_controller is not None:
+            screen.draw.text(f"detail level {detail_controller.level}", (10, HEIGHT - 30), fontsize=20)
+
+# Pygame Zero calls on_key_down when a key is pressed
+def on_key_down(key):
+    global SHOW_PROFILE_OVERLAY, SCANLINE_ROAD
+    if key == keys.F3:
+        SHOW_PROFILE_OVERLAY = not SHOW_PROFILE_OVERLAY
+        if SHOW_PROFILE_OVERLAY:
+            frame_profile.update_overlay()
+    elif key == keys.F4:
+        filename = time.strftime("frame_profile_%Y%m%d_%H%M%S.csv")
+        frame_profile.save_csv(filename)
+        print("Saved frame timings to", filename)
+    elif key == keys.F5:
+        SCANLINE_ROAD = not SCANLINE_ROAD
+        print("Scanline road renderer", "on" if SCANLINE_ROAD else "off")
+
 def play_music(name):
     try:
         music.play(name)
@@ -1633,32 +4020,416 @@ def stop_music():
         # If an error occurs (e.g. no sound hardware), ignore it
         pass
 
+# Race farm - for tuning the CPU car settings
+# Running the game with the command 'python leadingedge.py --race-farm' runs lots of races with only CPU cars, without
+# displaying anything or playing any sound, and then prints a report. Each race is updated with a fixed timestep as fast
+# as possible, rather than in real time, and the races are spread across all of the computer's CPU cores using a pool
+# of processes. Each race uses a different random number seed, so the results can be repeated.
+# Gameplay settings can be changed for the races by adding them to the command line, e.g. CPU_CAR_MIN_TARGET_SPEED=42
+# To compare different values of a setting, separate them with commas - e.g. GRID_CAR_SPACING=0.4,0.55,0.7 runs
+# the full set of races once for each value. If more than one setting has several values, every combination is tried.
+# Other options:
+#   --races N           number of races for each combination of settings (default 100)
+#   --processes N       number of processes to use (default is one per CPU core)
+#   --seed N            random number seed for the first race (default 0)
+#   --timestep T        length of each update in seconds (default FIXED_TIMESTEP) - larger values run faster but
+#                       are less accurate
+#   --json FILENAME     also save the full results of each race in JSON format
+RACE_FARM_MAX_RACE_TIME = 60 * 15    # Races are abandoned after this many seconds of race time
+
+def run_farm_race(task):
+    # Runs a single race in the current process, and returns a dictionary of results. This is called by the process
+    # pool, so it and its argument must be things that can be sent between processes
+    global game
+    settings, race_seed, timestep = task
+
+    # Change the requested gameplay settings. These are global variables which are read when the track and the cars
+    # are created, and while the race runs
+    globals().update(settings)
+
+    random.seed(race_seed)
+    game = Game()
+
+    # Nothing is drawn, so the camera and background don't need to follow the race
+    game.views.clear()
+
+    # Cars are identified by their position on the starting grid, counting from 0 for the car at the front
+    grid_positions = {car: i for i, car in enumerate(game.cars)}
+
+    # Z positions of the start lines. Passing the first one starts lap 1, passing the last one finishes the race
+    start_line_z = [-i * SPACING for i, track_piece in enumerate(game.track)
+                    if track_piece.start_line][:NUM_LAPS + 1]
+
+    # For each car, the times at which it passed each of the start lines so far, and the Z position of the next start
+    # line it has to pass
+    line_times = {car: [] for car in game.cars}
+    next_line_z = {car: start_line_z[0] for car in game.cars}
+
+    num_overtakes = 0
+    race_time = 0
+    cars_finished = 0
+    while cars_finished < len(game.cars) and race_time < RACE_FARM_MAX_RACE_TIME:
+        game.update(timestep)
+        race_time += timestep
+        num_overtakes += len(game.overtakes)
+
+        # game.car_z_keys lets us check all of the cars without looking up each car's position. The Z positions in it
+        # may be slightly out of date (see Game.get_cars_in_z_range), so we only look up the current position of
+        # cars which are close to their next start line
+        for car, z in zip(game.cars, game.car_z_keys):
+            line_z = next_line_z[car]
+            if z - NEIGHBOUR_QUERY_MARGIN_Z <= line_z and car.pos.z <= line_z:
+                times = line_times[car]
+                times.append(race_time)
+                if len(times) == len(start_line_z):
+                    next_line_z[car] = -math.inf
+                    cars_finished += 1
+                else:
+                    next_line_z[car] = start_line_z[len(times)]
+
+    # Cars which didn't finish are given no finish time, and are placed after those which did finish in their final
+    # race order
+    finishers = sorted((car for car in game.cars if len(line_times[car]) == len(start_line_z)),
+                       key=lambda car: line_times[car][-1])
+    non_finishers = [car for car in game.cars if len(line_times[car]) < len(start_line_z)]
+
+    return {"settings": settings,
+            "seed": race_seed,
+            "finish_order": [grid_positions[car] for car in finishers + non_finishers],
+            "finish_times": [line_times[car][-1] - line_times[car][0] for car in finishers],
+            "lap_times": [[b - a for a, b in zip(line_times[car], line_times[car][1:])] for car in game.cars],
+            "overtakes": num_overtakes,
+            "did_not_finish": len(non_finishers)}
+
+# The process pool sends functions to the other processes by name, along with the name of the module they're in.
+# Pygame Zero replaces this module's __name__, so Python gets the module name wrong unless we correct it
+run_farm_race.__module__ = "__main__"
+
+def parse_race_farm_args(args):
+    # Returns the options and a list of settings dictionaries (one for each combination of settings to try), from the
+    # command line arguments following --race-farm
+    options = {"races": 100, "processes": None, "seed": 0, "timestep": FIXED_TIMESTEP, "json": None}
+    settings_list = [{}]
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg.startswith("--") and arg[2:] in options:
+            value = args.pop(0)
+            if arg == "--timestep":
+                options["timestep"] = float(value)
+            elif arg == "--json":
+                options["json"] = value
+            else:
+                options[arg[2:]] = int(value)
+        elif "=" in arg:
+            name, values = parse_setting_values(arg)
+            settings_list = [dict(settings, **{name: value}) for settings in settings_list for value in values]
+        else:
+            raise ValueError(f"Unknown race farm option: {arg}")
+    return options, settings_list
+
+def parse_setting_values(arg):
+    # Splits a command line argument such as VIEW_DISTANCE=100,200 or SHOW_SCENERY=True,False into the name of the
+    # setting and a list of values
+    name, values = arg.split("=", 1)
+    if not name.isupper() or name not in globals():
+        raise ValueError(f"Unknown setting: {name}")
+    parsed_values = []
+    for value in values.split(","):
+        if value in ("True", "False"):
+            parsed_values.append(value == "True")
+        else:
+            parsed_values.append(float(value) if "." in value else int(value))
+    return name, parsed_values
+
+def run_race_farm(args):
+    import json
+    from multiprocessing import Pool
+    from statistics import mean
+
+    options, settings_list = parse_race_farm_args(args)
+    tasks = [(settings, options["seed"] + i, options["timestep"])
+             for settings in settings_list for i in range(options["races"])]
+    print(f"Running {len(tasks)} races...")
+    if not tasks:
+        return
+
+    start_time = time.perf_counter()
+    with Pool(options["processes"]) as pool:
+        # The order in which the results come back doesn't matter, so we use imap_unordered, which lets each process
+        # start a new race as soon as it's finished the previous one
+        results = list(pool.imap_unordered(run_farm_race, tasks, chunksize=4))
+
+        # Let the processes exit by themselves. Leaving the with block would otherwise stop them with the SIGTERM
+        # signal, but Pygame's SDL library catches that signal, so a process which hadn't exited yet would never stop
+        pool.close()
+        pool.join()
+    duration = time.perf_counter() - start_time
+    print(f"Finished in {duration:.1f}s ({duration / len(tasks):.3f}s per race)")
+
+    # Report on the results for each combination of settings
+    for settings in settings_list:
+        races = [result for result in results if result["settings"] == settings]
+        num_cars = len(races[0]["finish_order"])
+
+        print()
+        print(", ".join(f"{name}={value}" for name, value in settings.items()) or "Default settings")
+        print(f"  Races: {len(races)}")
+        print(f"  Overtakes per race: {mean(race['overtakes'] for race in races):.1f}")
+        print(f"  Cars not finishing: {sum(race['did_not_finish'] for race in races)}")
+
+        winning_times = [race["finish_times"][0] for race in races if race["finish_times"]]
+        if winning_times:
+            print(f"  Winning race time: mean {format_time(mean(winning_times))}, "
+                  f"best {format_time(min(winning_times))}, worst {format_time(max(winning_times))}")
+
+        lap_times = [lap_time for race in races for car_lap_times in race["lap_times"] for lap_time in car_lap_times]
+        if lap_times:
+            print(f"  Lap time: mean {format_time(mean(lap_times))}, best {format_time(min(lap_times))}")
+
+        # For each starting grid position, how often did that car win, and what was its average finishing position?
+        print("  Grid  Wins  Mean finish")
+        for grid_position in range(num_cars):
+            wins = sum(race["finish_order"][0] == grid_position for race in races)
+            finish = mean(race["finish_order"].index(grid_position) + 1 for race in races)
+            print(f"  {grid_position + 1:4}  {wins:4}  {finish:11.1f}")
+
+    if options["json"] is not None:
+        with open(options["json"], "w") as file:
+            json.dump(results, file)
+
+# Benchmark - for measuring how long it takes to draw the track
+# Running the game with the command 'python leadingedge.py --benchmark' moves the camera along one lap of the track at
+# a fixed speed, drawing each frame to an image which isn't displayed. The time taken by each part of drawing (see
+# FrameProfile) is recorded for every frame, along with the track piece the camera was at. As the camera always follows
+# the same path, the results can be compared between different versions of the game, to check that a change hasn't made
+# drawing slower, and to find the sections of the track which are slowest to draw.
+# This is done for every combination of the settings in BENCHMARK_SETTINGS and the screen sizes in
+# BENCHMARK_RESOLUTIONS. The values for a setting can be replaced on the command line, e.g. VIEW_DISTANCE=60,120,240
+# Other options:
+#   --speed N               track pieces travelled by the camera each frame (default BENCHMARK_CAMERA_SPEED)
+#   --resolutions WxH,...   screen sizes to try, e.g. 960x540,640x360
+#   --section-length N      number of track pieces in each section of the track, for the report (default 100)
+#   --json FILENAME         also save the results, including the times for every frame, in JSON format
+BENCHMARK_CAMERA_SPEED = 2
+BENCHMARK_SETTINGS = {"VIEW_DISTANCE": [100, 200],
+                      "SHOW_SCENERY": [True, False],
+                      "USE_GFXDRAW": [False, True],
+                      "SCANLINE_ROAD": [False, True]}
+BENCHMARK_RESOLUTIONS = [(960, 540), (640, 360)]
+
+def set_resolution(width, height):
+    # Changes the screen size settings, and everything that depends on them, and creates a Pygame Zero Screen object
+    # which draws to an image of that size rather than to the window
+    set_screen(pgzero.screen.Screen(pygame.Surface((width, height)).convert()))
+
+def run_benchmark_pass(settings, resolution, speed):
+    # Draws one lap of the track with the given settings, and returns the FrameProfile containing the times
+    global game, frame_profile
+    globals().update(settings)
+    set_resolution(*resolution)
+    sprite_table.load()
+
+    # Start each pass with an empty scaled image cache, so that earlier passes don't make later ones look faster
+    scaled_image_cache.clear()
+
+    # The CPU cars stay on the starting grid, as they aren't updated
+    random.seed(0)
+    game = Game()
+
+    num_frames = int(game.track.lap_length / speed)
+    frame_profile = FrameProfile(num_frames)
+
+    camera = game.view.camera
+    camera.x = 0
+    camera.z = CAMERA_FOLLOW_DISTANCE
+    for frame in range(num_frames):
+        # Move the camera in the same way as if it was following a car
+        old_camera_z = camera.z
+        prev_ahead, _ = game.get_first_track_piece_ahead(old_camera_z)
+        camera.z -= speed * SPACING
+        game.update_background(old_camera_z, prev_ahead)
+        game.first_frame = False
+
+        game.draw()
+        frame_profile.end_frame()
+
+    return frame_profile
+
+def summarise_benchmark_pass(profile, section_length):
+    # Returns a dictionary summarising a benchmark pass, including the mean time for each category in each section of
+    # the track, and the times for every frame
+    from statistics import mean
+
+    total_stats = profile.get_stats(FrameProfile.TOTAL)
+    sections = {}
+    for i, track_piece_idx in enumerate(profile.track_piece_indices):
+        sections.setdefault(track_piece_idx // section_length, []).append(i)
+
+    return {"frames": len(profile.frame_numbers),
+            "total_ms": {"mean": mean(profile.history[FrameProfile.TOTAL]), "p50": total_stats[0],
+                         "p95": total_stats[1], "p99": total_stats[2], "max": total_stats[3]},
+            "category_mean_ms": {category: mean(values) for category, values in profile.history.items()
+                                 if category not in (FrameProfile.TOTAL, FrameProfile.INTERVAL)},
+            "sections": [{"first_track_piece": section * section_length,
+                          "mean_ms": {category: mean(values[i] for i in frames)
+                                      for category, values in profile.history.items()
+                                      if category != FrameProfile.INTERVAL}}
+                         for section, frames in sorted(sections.items())],
+            "per_frame": {"track_piece": list(profile.track_piece_indices),
+                          "times_ms": {category: list(values) for category, values in profile.history.items()}}}
+
+def run_benchmark(args):
+    import json
+
+    options = {"speed": BENCHMARK_CAMERA_SPEED, "resolutions": BENCHMARK_RESOLUTIONS, "section_length": 100,
+               "json": None}
+    matrix = dict(BENCHMARK_SETTINGS)
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg == "--speed":
+            options["speed"] = float(args.pop(0))
+        elif arg == "--resolutions":
+            options["resolutions"] = [tuple(int(n) for n in size.split("x")) for size in args.pop(0).split(",")]
+        elif arg == "--section-length":
+            options["section_length"] = int(args.pop(0))
+        elif arg == "--json":
+            options["json"] = args.pop(0)
+        elif "=" in arg:
+            name, values = parse_setting_values(arg)
+            matrix[name] = values
+        else:
+            raise ValueError(f"Unknown benchmark option: {arg}")
+
+    # Make a list of every combination of settings
+    settings_list = [{}]
+    for name, values in matrix.items():
+        settings_list = [dict(settings, **{name: value}) for settings in settings_list for value in values]
+
+    results = []
+    for resolution in options["resolutions"]:
+        for settings in settings_list:
+            profile = run_benchmark_pass(settings, resolution, options["speed"])
+            summary = summarise_benchmark_pass(profile, options["section_length"])
+            results.append(dict(settings=settings, resolution=resolution, **summary))
+
+            total = summary["total_ms"]
+            print()
+            print(f"{resolution[0]}x{resolution[1]}, " + ", ".join(f"{name}={value}" for name, value in settings.items()))
+            print(f"  Frame ms: mean {total['mean']:.2f}, p50 {total['p50']:.2f}, p95 {total['p95']:.2f}, "
+                  f"p99 {total['p99']:.2f}, max {total['max']:.2f}")
+            categories = sorted(summary["category_mean_ms"].items(), key=lambda item: item[1], reverse=True)
+            print("  Slowest categories: " + ", ".join(f"{category} {ms:.2f}" for category, ms in categories[:5]))
+            sections = sorted(summary["sections"], key=lambda section: section["mean_ms"][FrameProfile.TOTAL],
+                              reverse=True)
+            print("  Slowest sections: " + ", ".join(f"{section['first_track_piece']}+ "
+                                                     f"{section['mean_ms'][FrameProfile.TOTAL]:.2f}"
+                                                     for section in sections[:3]))
+
+    if options["json"] is not None:
+        with open(options["json"], "w") as file:
+            json.dump({"options": options, "results": results}, file)
+
+# Collision check - for making sure that the players' cars in a two player game collide correctly
+# Running the game with the command 'python leadingedge.py --collision-check' sets up a two player race with no CPU
+# cars, places the second player's car so that it overlaps the first player's car, and runs a single update. A
+# collision should push the cars apart once, so each check compares the gap between the cars afterwards with the gap
+# that one push leaves. If the cars were pushed apart twice (once during each player's update), the gap would be too
+# big. Nothing is displayed, and the program exits with an error if any of the checks fail
+# Each check is a name, where to put the second car relative to the first, the speeds of the two cars, and the X and Z
+# gaps which the cars should end up with
+COLLISION_CHECKS = [("side", Vector3(100, 0, 0), (0, 0), (100 + 50 * 2, 0)),
+                    ("back", Vector3(0, 0, 0.5), (10, 20), (0, COLLIDE_FRONT_DISTANCE_Z * 0.6 * 2))]
+
+# Controls which don't press anything, so that only the collisions move the cars sideways
+class CollisionCheckControls(Controls):
+    def get_x(self):
+        return 0
+
+    def button_down(self, button):
+        return False
+
+def run_collision_check():
+    global game
+
+    # Only the two players' cars take part
+    globals().update(NUM_CARS=2)
+
+    failed = False
+    for name, offset, speeds, expected_gap in COLLISION_CHECKS:
+        random.seed(0)
+        game = Game(CollisionCheckControls(), player2_controls=CollisionCheckControls())
+        game.start_timer = 0
+        car1, car2 = game.player_cars
+        car2.pos = car1.pos + offset
+        car1.speed, car2.speed = speeds
+
+        game.update(FIXED_TIMESTEP)
+
+        gap = car2.pos - car1.pos
+        ok = math.isclose(gap.x, expected_gap[0], abs_tol=1e-6) and math.isclose(gap.z, expected_gap[1], abs_tol=1e-6)
+        failed = failed or not ok
+        print(f"{name}: gap X {gap.x:.2f} Z {gap.z:.2f}, expected X {expected_gap[0]:.2f} Z {expected_gap[1]:.2f} - "
+              + ("OK" if ok else "FAILED"))
+
+    if failed:
+        sys.exit("Collision check failed")
+    print("Collision check passed")
+
 ##############################################################################
 
-# Set up sound system and start music
-try:
-    # Restart the Pygame audio mixer which Pygame Zero sets up by default. We find that the default settings
-    # cause issues with delayed or non-playing sounds on some devices
-    pygame.mixer.quit()
-    pygame.mixer.init(44100, -16, 2, 1024)
+if RACE_FARM:
+    # Don't start the game. When the race farm processes start up on some operating systems, they run this file again
+    # to set up the same classes and functions. In that case, they just need to wait to be given races to run, rather
+    # than starting a race farm of their own. We can't check __name__ for this as is usually done, because Pygame Zero
+    # replaces it
+    from multiprocessing import current_process
+    if current_process().name == "MainProcess":
+        run_race_farm(sys.argv[sys.argv.index("--race-farm") + 1:])
+
+elif BENCHMARK:
+    run_benchmark(sys.argv[sys.argv.index("--benchmark") + 1:])
+
+elif COLLISION_CHECK:
+    run_collision_check()
+
+elif CONVERT_TRACK:
+    # An optional filename can be given after --convert-track, otherwise TRACK_FILE is used
+    args = sys.argv[sys.argv.index("--convert-track") + 1:]
+    filename = args[0] if args else os.path.join(pgzero.loaders.root, TRACK_FILE)
+    save_track_file(filename, track_pieces_to_bytes(make_track_lap()))
+    print("Saved track to", filename)
+
+else:
+    # Set up sound system and start music
+    try:
+        # Restart the Pygame audio mixer which Pygame Zero sets up by default. We find that the default settings
+        # cause issues with delayed or non-playing sounds on some devices
+        pygame.mixer.quit()
+        pygame.mixer.init(44100, -16, 2, 1024)
+
+        play_music("title_theme")
+    except Exception:
+        # If an error occurs (e.g. no sound hardware), ignore it
+        pass
 
-    play_music("title_theme")
-except Exception:
-    # If an error occurs (e.g. no sound hardware), ignore it
-    pass
+    # Set up controls
+    keyboard_controls = KeyboardControls()
+    player2_keyboard_controls = Player2KeyboardControls()
+    setup_joystick_controls()
 
-# Set up controls
-keyboard_controls = KeyboardControls()
-setup_joystick_controls()
+    # Load the car sprites
+    sprite_table.load()
 
-# Set up initial state and Game object
-state = State.TITLE
-game = Game()
+    # Set up initial state and Game object
+    state = State.TITLE
+    game = Game()
 
-demo_reset_timer = 2 * 60    # Demo race resets after 2 mins
-demo_start_timer = 0
+    demo_reset_timer = 2 * 60    # Demo race resets after 2 mins
+    demo_start_timer = 0
 
-accumulated_time = 0
+    accumulated_time = 0
 
-# Tell Pygame Zero to take over
-pgzrun.go()
+    # Tell Pygame Zero to take over
+    pgzrun.go()